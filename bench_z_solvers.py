@@ -0,0 +1,309 @@
+###
+### Benchmarks the z solvers (throughput, latency, failures and accuracy).
+###
+
+## NOTES:
+## Runs every approach of the 'Z_METHODS' registry on a synthetic (x, y)
+## corpus, with known z values, and optionally on a recorded corpus (an ".npz"
+## file with 'x' and 'y' arrays). Reports, as JSON, to each approach and
+## corpus: throughput, p50/p99 latency per solve, failure rate, residual
+## distribution and agreement with the other approaches (and with the true z,
+## to the synthetic corpus). The production database is only read when a
+## recorded corpus is exported.
+##
+## The degenerate pairs, whose time value (w = y - max(0, x - 1)) is lost to
+## the float rounding, lie on the no-root boundary and no approach can solve
+## them. They are left out of both corpora (the synthetic one is resampled),
+## so every approach is measured on solvable inputs, and only counted
+## ('n_degenerate').
+
+## USAGE:
+##     python bench_z_solvers.py --output bench.json
+##     python bench_z_solvers.py --export-corpus trades.npz --limit 100000
+##     python bench_z_solvers.py --corpus trades.npz --baseline bench.json
+
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from z_solvers import Z_METHODS, funz_batch, softplus
+
+
+##
+## Support functions
+##
+
+def is_degenerate(x, y):
+    """
+    Tests the (x, y) pairs whose time value is lost to the float rounding
+    (y on the no-root boundary).
+    """
+    with np.errstate(all='ignore'):
+        w = y - np.maximum(0.0, x - 1)
+    return ~(w > degenerate_margin * np.finfo(float).eps * y)
+
+
+def synthetic_corpus(n, seed=0):
+    """
+    Returns a reproducible synthetic corpus of n solvable (x, y) pairs with 
+    known z values, in the range of the traded BTC options, and the number 
+    of degenerate pairs drawn (and replaced).
+    """
+    rng = np.random.default_rng(seed)
+    parts = []
+    n_valid = 0
+    n_degenerate = 0
+
+    while n_valid < n:
+        size = n - n_valid
+        x = np.exp(rng.normal(0.0, 0.1, size))         # index / strike
+        z = np.exp(rng.uniform(0.0, np.log(200), size)) # 1 <= z < 200
+        with np.errstate(all='ignore'):
+            y = np.exp(softplus(z * np.log(x)) / z) - 1
+
+        keep = ~is_degenerate(x, y)
+        n_degenerate += int(np.sum(~keep))
+        parts.append((x[keep], y[keep], z[keep]))
+        n_valid += int(np.sum(keep))
+
+    x, y, z = (np.concatenate(arrays) for arrays in zip(*parts))
+    return x, y, z, n_degenerate
+
+
+def export_corpus(path, limit):
+    """
+    Exports the (x, y) pairs of the most recent trades to an ".npz" corpus
+    (read only access to the database).
+    """
+    from pymongo import MongoClient, DESCENDING
+
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+    collection = db['btc_trade_history_5min']
+
+    trades = collection.find({"x": {"$exists": True}, "y": {"$exists": True}},
+                             {"x": 1, "y": 1, "_id": 0},
+                             sort=[('unix_time', DESCENDING)],
+                             limit=limit)
+    pairs = [(trade['x'], trade['y']) for trade in trades]
+
+    x = np.array([p[0] for p in pairs], dtype=float)
+    y = np.array([p[1] for p in pairs], dtype=float)
+    np.savez_compressed(path, x=x, y=y)
+
+    return len(pairs)
+
+
+def run_method(method, x, y, chunk):
+    """
+    Solves the corpus in chunks with an approach. Returns the z values and the
+    latency per solve to each chunk (in seconds).
+    """
+    calculate_z = Z_METHODS[method]
+    z = np.full(len(x), np.nan)
+    latencies = []
+
+    for start in range(0, len(x), chunk):
+        end = min(start + chunk, len(x))
+        t0 = time.perf_counter()
+        z[start:end] = calculate_z(x[start:end], y[start:end])
+        latencies.append((time.perf_counter() - t0) / (end - start))
+
+    return z, np.array(latencies)
+
+
+def percentiles(values, q=(50, 99)):
+    """
+    Returns the given percentiles (and max) of the finite values.
+    """
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return None
+    result = {f"p{p}": float(np.percentile(values, p)) for p in q}
+    result["max"] = float(np.max(values))
+    return result
+
+
+def relative_diff(z_a, z_b):
+    """
+    Returns the relative difference percentiles where both z are solved.
+    """
+    both = np.isfinite(z_a) & np.isfinite(z_b)
+    if not both.any():
+        return None
+    diff = np.abs(z_a[both] - z_b[both]) / np.maximum(1.0, np.abs(z_b[both]))
+    result = percentiles(diff)
+    result["n"] = int(np.sum(both))
+    return result
+
+
+def bench_corpus(x, y, methods, chunk, limits, z_true=None):
+    """
+    Benchmarks the approaches on a corpus. Slow approaches run on the first
+    'limits[method]' pairs only.
+    """
+    report = {"n": len(x), "methods": {}, "agreement": {}}
+    solutions = {}
+
+    for method in methods:
+
+        n = min(len(x), limits.get(method, len(x)))
+        step = 1 if method in per_trade_methods else chunk
+
+        t0 = time.perf_counter()
+        z, latencies = run_method(method, x[:n], y[:n], step)
+        elapsed = time.perf_counter() - t0
+
+        with np.errstate(all='ignore'):
+            fz = np.abs(funz_batch(z, x[:n], y[:n]))
+
+        result = {
+                  "n": n,
+                  "throughput": n / elapsed if elapsed else None,
+                  "latency": percentiles(latencies),
+                  "failure_rate": float(np.mean(np.isnan(z))),
+                  "residual": percentiles(fz),
+                 }
+        if z_true is not None:
+            result["vs_true_z"] = relative_diff(z, z_true[:n])
+
+        report["methods"][method] = result
+        solutions[method] = z
+
+        print(f"{method}: {n} solves | {result['throughput']:.1f} solves/s | "
+              f"failure rate: {result['failure_rate']:.4%}", file=sys.stderr)
+
+    # Agreement between each pair of approaches.
+    for i, a in enumerate(methods):
+        for b in methods[i + 1:]:
+            n = min(len(solutions[a]), len(solutions[b]))
+            report["agreement"][f"{a}/{b}"] = relative_diff(solutions[a][:n],
+                                                            solutions[b][:n])
+
+    return report
+
+
+def check_regressions(report, baseline, tolerance):
+    """
+    Returns a list of regressions of 'report' against a 'baseline' report:
+    lower throughput (beyond 'tolerance'), higher failure rate or higher p99
+    residual. Corpora of different sizes are not compared.
+    """
+    regressions = []
+    for corpus, corpus_report in report["corpora"].items():
+        base_corpus = baseline.get("corpora", {}).get(corpus)
+        if not base_corpus:
+            continue
+        for method, result in corpus_report["methods"].items():
+            base = base_corpus["methods"].get(method)
+            # Only the same corpus (and sample size) can be compared.
+            if not base or base["n"] != result["n"]:
+                continue
+            if (base["throughput"] and result["throughput"] and
+                result["throughput"] < base["throughput"] * (1 - tolerance)):
+                regressions.append(f"{corpus}/{method}: throughput " +
+                                   f"{result['throughput']:.1f} < " +
+                                   f"{base['throughput']:.1f}")
+            if result["failure_rate"] > base["failure_rate"]:
+                regressions.append(f"{corpus}/{method}: failure rate " +
+                                   f"{result['failure_rate']:.4%} > " +
+                                   f"{base['failure_rate']:.4%}")
+            if (base["residual"] and result["residual"] and
+                result["residual"]["p99"] >
+                max(base["residual"]["p99"] * 10, 1e-12)):
+                regressions.append(f"{corpus}/{method}: residual p99 " +
+                                   f"{result['residual']['p99']:.3g} > " +
+                                   f"{base['residual']['p99']:.3g}")
+    return regressions
+
+
+##
+## Main script
+##
+
+# Per trade approaches (timed at each solve, not per chunk).
+per_trade_methods = ["fsolve", "brentq", "bisect", "d_annealing"]
+
+# The minimum time value of a solvable pair, in float epsilons of y.
+degenerate_margin = 4
+
+# Default number of pairs to the slow approaches.
+method_limits = {"brentq": 500, "bisect": 2000, "d_annealing": 200}
+
+
+def main():
+    """
+    Runs the benchmark and writes the JSON report.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks the z solvers.")
+    parser.add_argument("--methods", nargs="+", choices=list(Z_METHODS),
+                        default=list(Z_METHODS))
+    parser.add_argument("--n", type=int, default=20000,
+                        help="size of the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", help="a recorded (.npz) corpus")
+    parser.add_argument("--chunk", type=int, default=1000,
+                        help="pairs per call to the batch approaches")
+    parser.add_argument("--full", action="store_true",
+                        help="runs the slow approaches on the whole corpus")
+    parser.add_argument("--output", help="JSON report file (default: stdout)")
+    parser.add_argument("--baseline", help="a JSON report to compare")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="accepted throughput loss against the baseline")
+    parser.add_argument("--export-corpus",
+                        help="exports a recorded corpus from the database")
+    parser.add_argument("--limit", type=int, default=100000,
+                        help="trades to export")
+    args = parser.parse_args()
+
+    if args.export_corpus:
+        n = export_corpus(args.export_corpus, args.limit)
+        print(f"Exported {n} trades to {args.export_corpus}.")
+        return
+
+    limits = {} if args.full else method_limits
+    report = {
+              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "numpy": np.__version__,
+              "corpora": {},
+             }
+
+    # Synthetic corpus (with the true z values).
+    x, y, z_true, n_degenerate = synthetic_corpus(args.n, args.seed)
+    report["corpora"]["synthetic"] = bench_corpus(x, y, args.methods,
+                                                  args.chunk, limits, z_true)
+    report["corpora"]["synthetic"]["n_degenerate"] = n_degenerate
+
+    # Recorded corpus (without its degenerate pairs).
+    if args.corpus:
+        data = np.load(args.corpus)
+        degenerate = is_degenerate(data['x'], data['y'])
+        report["corpora"]["recorded"] = bench_corpus(data['x'][~degenerate],
+                                                     data['y'][~degenerate],
+                                                     args.methods,
+                                                     args.chunk, limits)
+        report["corpora"]["recorded"]["n_degenerate"] = int(np.sum(degenerate))
+
+    # Regression check.
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = check_regressions(report, baseline, args.tolerance)
+        report["regressions"] = regressions
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    for regression in regressions:
+        print(f"REGRESSION: {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,18 +12,54 @@
 ## (daily, weekly and monthly) contracts expires at 8:00 AM GMT (5:00 AM at 
 ## São Paulo -3 GMT local time), soon the daily average price is calculed to 
 ## 5am-5am interval, at local time.
+##
+## The rollup runs as one aggregation: the 5-minute prices after the last
+## stored day (the watermark) are bucketed by day (5am-5am) with
+## '$dateTrunc', the average, standard deviation (sample), max, min and the
+## price list are computed on the server and the new documents are written
+## with '$merge' (no round trip per bucket, matched on the unique 'datetime'
+## index). The documents keep the former fields and values. Null prices are
+## not counted, and a bucket without source prices is skipped. The run stops
+## at the first bucket with a missing (or null and unchecked) 5min window, so
+## a bucket is only written once its source is complete. Requires MongoDB
+## 5.0+.
+##
+## The price lists aren't stored in the stats documents (they would weigh on
+## every full scan of the collection): they go to the optional detail
+## collection 'btc_avg_index_price_daily_prices' ('datetime', 'prices'),
+## written by a second '$merge'. Fetch them only when needed, ex.:
+##     db['btc_avg_index_price_daily_prices'].find_one({'datetime': dt})
+## (see "db_tools/db_split_price_arrays.py" to move the former lists).
 
 import datetime
-import time
-from pymongo import MongoClient, DESCENDING, ASCENDING
 import sys
-import numpy as np
+from pymongo import MongoClient, DESCENDING, ASCENDING
 
 # DB access.
 client = MongoClient('mongodb://localhost:27017/')
 db = client['deribit_btc_options']
 in_collection = db['btc_index_price_5min'] # source DB.
 out_collection = db['btc_avg_index_price_daily'] # target BD.
+prices_collection = db['btc_avg_index_price_daily_prices'] # detail DB.
+
+# Stores the price lists of the buckets in the detail DB.
+keep_prices = True
+
+# A unique 'datetime' index, as '$merge' matches the buckets on it (it
+# replaces the former non-unique index, once there are no duplicates).
+index = out_collection.index_information().get('datetime_1')
+if (index is not None) and (not index.get('unique')):
+    duplicates = list(out_collection.aggregate([
+        {'$group': {'_id': '$datetime', 'n': {'$sum': 1}}},
+        {'$match': {'n': {'$gt': 1}}},
+        {'$limit': 1},
+    ], allowDiskUse=True))
+    if duplicates:
+        print(f"Duplicated 'datetime' documents (ex.: {duplicates[0]['_id']})."
+              f" Remove them before updating the database.")
+        sys.exit()
+    out_collection.drop_index('datetime_1')
+out_collection.create_index([('datetime', ASCENDING)], unique=True)
 
 # Finds the document with the most recent date value.
 last_document = out_collection.find_one(sort=[('datetime', -1)])
@@ -31,7 +67,6 @@ last_document = out_collection.find_one(sort=[('datetime', -1)])
 # Iteration interval - Initial value.
 if last_document is None:
     # To (re)build the entire database.
-    out_collection.create_index([('datetime', ASCENDING)])
     out_collection.create_index([('datetime', DESCENDING)])
     i_date = datetime.datetime(2017, 1, 1, 5, 0, 0)
 else:
@@ -44,66 +79,121 @@ td = datetime.date.today()
 f_date = datetime.datetime(td.year, td.month, td.day, 5, 0, 0)
 f_date -= datetime.timedelta(days=1)
 
-# Iterates historical hourly index prices to calculate the average daily price.
-while i_date <= f_date:
-
-    # Aggregation pipeline to match documents within the specific day, sum the 
-    # price values, and count the documents.
-    pipeline = [
-        {'$match': 
-            {'datetime': {'$gte': i_date, 
-                          '$lt': (i_date + datetime.timedelta(days=1))}}},
+# Checks if the source DB covers the interval.
+last_source = in_collection.find_one(sort=[('datetime', -1)])
+if (last_source is None) or (last_source['datetime'] < f_date):
+    print("Run 'build_..._index_price_5min.py' to update the source db.")
+
+# The days start at 5am (local time).
+day_offset = 5 * 3600 * 1000 # In milliseconds.
+
+# The bucket (day) of each 5min document.
+bucket = {'$add': [{'$dateTrunc': {
+                        'date': {'$subtract': ['$datetime', day_offset]},
+                        'unit': 'day'}},
+                   day_offset]}
+
+# Aggregation pipeline to bucket the 5min index prices by day (after the
+# watermark), to calculate the daily stats and to insert the new documents.
+end_date = f_date + datetime.timedelta(days=1)
+
+# Stops at the first missing or incomplete day (a 5min window without
+# document, or with a null price not yet confirmed empty by 
+# "fill_gaps_btc_5min_series.py"), so the watermark never passes a hole.
+n_windows = 288 # 5min windows per day.
+filled = {}
+for row in in_collection.aggregate([
+        {'$match': {'datetime': {'$gte': i_date, '$lt': end_date}}},
+        {'$group': {
+            '_id': bucket,
+            'n': {'$sum': {'$cond': [{'$or': [
+                                        {'$gt': ['$index_price', None]},
+                                        {'$eq': ['$checked', True]},
+                                        ]}, 1, 0]}},
+        }},
+        ], allowDiskUse=True):
+    filled[row['_id']] = row['n']
+b_date = i_date
+while b_date < end_date:
+    if filled.get(b_date, 0) < n_windows:
+        print(f"Incomplete source day ({b_date}). Run "
+              f"'fill_gaps_btc_5min_series.py' to update the source db.")
+        end_date = b_date
+        break
+    b_date += datetime.timedelta(days=1)
+
+match_stages = [
+    {'$match': 
+        {'datetime': {'$gte': i_date, '$lt': end_date}}},
+    {'$sort': {'datetime': 1}},
+]
+pipeline = match_stages + [
+    {'$group': {
+        '_id': bucket,
+        'sum_price': {'$sum': '$index_price'},
+        'sum_sq_price': {'$sum': {'$multiply': ['$index_price', 
+                                                '$index_price']}},
+        'max_price': {'$max': '$index_price'},
+        'min_price': {'$min': '$index_price'},
+        # Only the non-null prices are counted.
+        'count': {'$sum': {'$cond': [{'$gt': ['$index_price', None]}, 1, 0]}},
+        'first_datetime': {'$first': '$datetime'},
+        'first_unix_time': {'$first': '$unix_time'},
+    }},
+    {'$match': {'count': {'$gt': 0}}},
+    {'$project': {
+        '_id': 0,
+        'datetime': '$_id',
+        # The Unix date of the day, from the first 5min document.
+        'unix_time': {'$subtract': ['$first_unix_time', 
+                                    {'$subtract': ['$first_datetime', 
+                                                   '$_id']}]},
+        'avg_index_price_daily': {'$divide': ['$sum_price', '$count']},
+        # The sample standard deviation, from the same count.
+        'std_dev_index_price_daily': {'$cond': [
+            {'$gt': ['$count', 1]},
+            {'$sqrt': {'$max': [0, {'$divide': [
+                {'$subtract': ['$sum_sq_price',
+                               {'$divide': [{'$multiply': ['$sum_price',
+                                                           '$sum_price']},
+                                            '$count']}]},
+                {'$subtract': ['$count', 1]}]}]}},
+            None]},
+        'max_index_price_daily': '$max_price',
+        'min_index_price_daily': '$min_price',
+    }},
+    {'$merge': {
+        'into': out_collection.name,
+        'on': 'datetime',
+        'whenMatched': 'keepExisting',
+        'whenNotMatched': 'insert',
+    }},
+]
+
+# Aggregation pipeline to store the price lists of the same buckets (before
+# the stats, which set the watermark).
+if keep_prices:
+    prices_collection.create_index([('datetime', ASCENDING)], unique=True)
+    prices_pipeline = match_stages + [
         {'$group': {
-            '_id': None,
+            '_id': bucket,
             'prices': {'$push': '$index_price'},
-            'sum_price': {'$sum': '$index_price'},
-            'max_price': {'$max': '$index_price'},
-            'min_price': {'$min': '$index_price'},
-            'count': {'$sum': 1},
-        }}
+        }},
+        {'$project': {'_id': 0, 'datetime': '$_id', 'prices': 1}},
+        {'$merge': {
+            'into': prices_collection.name,
+            'on': 'datetime',
+            'whenMatched': 'keepExisting',
+            'whenNotMatched': 'insert',
+        }},
     ]
+    in_collection.aggregate(prices_pipeline, allowDiskUse=True)
 
-    # Executes the aggregation pipeline.
-    result = list(in_collection.aggregate(pipeline))
-
-    if result:
-    
-        # Gets the Unix date.
-        date_unix = int(time.mktime(i_date.timetuple()) * 1000)
-
-        # Calculates the daily average to index prices.
-        sum_price = float(result[0]['sum_price'])
-        count = int(result[0]['count'])
-        avg_index_price_daily = sum_price / count
-
-        # Calculates the daily standard deviation.
-        prices = result[0]['prices']
-        # Note: uses "ddof=1" for a data sample, and "ddof=0" for the population
-        std_dev = np.std(prices, ddof=1)
+# Executes the aggregation pipeline (the documents are written by '$merge').
+in_collection.aggregate(pipeline, allowDiskUse=True)
 
-        document = {
-                   'datetime': i_date,
-                   'unix_time': date_unix,
-                   'avg_index_price_daily': avg_index_price_daily,
-                   'std_dev_index_price_daily' : std_dev,
-                   'max_index_price_daily' : float(result[0]['max_price']),
-                   'min_index_price_daily' : float(result[0]['min_price']),
-                   'prices' : prices,
-                    }
-
-        # Insert the document into the target collection
-        out_collection.insert_one(document)
-
-        # Shows the job execution on terminal.
-        print(i_date, avg_index_price_daily)
-
-        # Sets a new hourly cycle.
-        i_date += datetime.timedelta(days=1)
-
-    else:
-        print("Run 'build_..._index_price_5min.py' to update the source db.")
-        sys.exit()  # This will stop the script entirely
+# Shows the job execution on terminal.
+n_documents = out_collection.count_documents({'datetime': {'$gte': i_date}})
+print(f"{n_documents} days inserted from {i_date}.")
 
 print("The database is updated!")
-
-
@@ -0,0 +1,231 @@
+###
+### Builds the BTC DVOL volatility index database from candles.
+###
+
+## NOTES:
+## The 'datetime' fields from 'btc_dvol_volatility_index_hourly' collection
+## are relative to 'São Paulo -3 GMT local time'. As the Deribit's BTC options
+## (daily, weekly and monthly) contracts expires at 8:00 AM GMT (5:00 AM at
+## São Paulo -3 GMT local time). Unix time are in miliseconds.
+##
+## A bulk ingester to the Deribit's volatility index (DVOL, the 30-day implied
+## volatility of the BTC options, in %) candles, with up to 1000 candles per
+## request. It is a parallel series to 'btc_iv_implied_volatility_5min' (the
+## IV of the last option trade of each window), which stays as a fallback:
+## the DVOL history starts in 2021 and the endpoint has no 5-minute
+## resolution (1, 60, 3600 or 43200 seconds, or '1D'). Each document keeps
+## 'open', 'high', 'low', 'close' and 'dvol' (the close).
+
+## USAGE:
+##     python build_hist_btc_dvol_volatility_index.py
+##     python build_hist_btc_dvol_volatility_index.py --resolution 60 \
+##         --collection btc_dvol_volatility_index_1min
+
+import argparse
+import asyncio
+import datetime
+import time
+from pymongo import MongoClient, DESCENDING, ASCENDING, InsertOne
+from bulk_writer import BulkWriter
+from deribit_client import DeribitClient
+from deribit_fetcher import AsyncFetcher, run_ordered
+
+
+##
+## Support functions
+##
+
+def get_step(resolution):
+    """
+    Returns the candle interval of a resolution.
+    """
+    if resolution == '1D':
+        return datetime.timedelta(days=1)
+    return datetime.timedelta(seconds=int(resolution))
+
+
+def get_chunks(i_date, f_date, resolution):
+    """
+    Yields the (start, params) of the requests from 'i_date' to 'f_date',
+    with up to 'candles_per_request' candles each.
+    """
+    step = get_step(resolution)
+    while i_date <= f_date:
+
+        i_ts_unix = int(time.mktime(i_date.timetuple()) * 1000)
+        e_date = min(i_date + candles_per_request * step, f_date + step)
+        e_ts_unix = int(time.mktime(e_date.timetuple()) * 1000) - 1
+
+        params = {
+                  'currency': "BTC",
+                  'start_timestamp': i_ts_unix,
+                  'end_timestamp': e_ts_unix,
+                  'resolution': resolution,
+                  }
+
+        yield i_date, params
+
+        i_date = e_date
+
+
+async def fetch_chunk(fetcher, url, params):
+    """
+    Fetches the candles of a chunk, following the 'continuation' (backwards)
+    of a truncated response. Returns the candles sorted by time, or None if a
+    request fails.
+    """
+    candles = {}
+    page_params = dict(params)
+    while True:
+        data = await fetcher.get(url, page_params)
+        if data is None:
+            return None
+        result = data.get('result', {})
+        for candle in result.get('data', []):
+            candles[candle[0]] = candle
+
+        continuation = result.get('continuation')
+        if ((not continuation) or
+            (continuation <= params['start_timestamp']) or
+            (continuation >= page_params['end_timestamp'])):
+            break
+        page_params['end_timestamp'] = continuation
+
+    return [candles[ts] for ts in sorted(candles)]
+
+
+def get_dvol_document(candle):
+    """
+    Returns the document of a [timestamp, open, high, low, close] candle.
+    """
+    tick, c_open, c_high, c_low, c_close = candle[:5]
+
+    return {
+            'datetime': datetime.datetime.fromtimestamp(tick / 1000),
+            'unix_time': tick,
+            'dvol': float(c_close),
+            'open': float(c_open),
+            'high': float(c_high),
+            'low': float(c_low),
+            'close': float(c_close),
+            }
+
+
+async def build_history(writer, i_date, f_date, args):
+    """
+    Fetches the chunks concurrently and inserts their candles in order.
+    Returns the number of candles and requests.
+    """
+    fetcher = AsyncFetcher(DeribitClient(pool_size=args.concurrency),
+                           concurrency=args.concurrency,
+                           rate=args.rate)
+    url = f"{args.base_url}{endpoint}"
+
+    async def fetch(chunk):
+        return await fetch_chunk(fetcher, url, chunk[1])
+
+    n_candles = 0
+    try:
+        async for (start, params), candles in run_ordered(
+                                            fetch,
+                                            get_chunks(i_date, f_date,
+                                                       args.resolution),
+                                            lookahead=2 * args.concurrency):
+
+            # Stops at a failed request to keep the resume point correct.
+            if candles is None:
+                print(f"Failed chunk: {start}. Stopping.")
+                break
+
+            for candle in candles:
+                if (params['start_timestamp'] <= candle[0] <=
+                    params['end_timestamp']):
+                    writer.add(InsertOne(get_dvol_document(candle)))
+                    n_candles += 1
+
+            # Shows the job execution on terminal.
+            print(start, len(candles))
+    finally:
+        print(fetcher.client.report())
+        fetcher.close()
+
+    return n_candles, fetcher.n_requests
+
+
+##
+## Main script
+##
+
+# API definitions.
+hist_base_url = "https://www.deribit.com/api/v2/public/"
+endpoint = f"get_volatility_index_data"
+
+# Candle settings.
+candles_per_request = 1000
+
+
+def main():
+    """
+    Updates the DVOL database up to the last closed hour.
+    """
+    parser = argparse.ArgumentParser(
+                description="Builds the BTC DVOL volatility index database.")
+    parser.add_argument("--base-url",
+                        default=hist_base_url,
+                        help="API base URL (ex.: a local stand-in server)")
+    parser.add_argument("--resolution",
+                        choices=['1', '60', '3600', '43200', '1D'],
+                        default='3600',
+                        help="candle resolution (seconds, or '1D')")
+    parser.add_argument("--collection",
+                        default='btc_dvol_volatility_index_hourly')
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=4,
+                        help="maximum requests in flight")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=10,
+                        help="maximum requests per second")
+    args = parser.parse_args()
+
+    # DB access.
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+    collection = db[args.collection]
+
+    # Finds the document with the most recent date value.
+    last_document = collection.find_one(sort=[('datetime', -1)])
+
+    # Iteration interval - Initial value.
+    if last_document is None:
+        # To (re)build the entire database (DVOL starts in 2021).
+        collection.create_index([('datetime', ASCENDING)])
+        collection.create_index([('datetime', DESCENDING)])
+        i_date = datetime.datetime(2021, 1, 1, 0, 0, 0)
+    else:
+        # To update the database.
+        i_date = last_document['datetime'] + get_step(args.resolution)
+
+    # Iteration interval - Final value (the last candle closed up to the 
+    # last closed hour).
+    td = datetime.datetime.now()
+    td -= datetime.timedelta(hours=1)
+    f_date = datetime.datetime(td.year, td.month, td.day, td.hour, 0, 0)
+    f_date += datetime.timedelta(hours=1) - get_step(args.resolution)
+
+    start = time.monotonic()
+    with BulkWriter(collection) as writer:
+        n_candles, n_requests = asyncio.run(build_history(writer,
+                                                          i_date,
+                                                          f_date,
+                                                          args))
+    elapsed = time.monotonic() - start
+
+    print(writer.report())
+    print(f"{n_candles} candles | {n_requests} requests | {elapsed:.1f} s")
+    print("The database is up to date!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+###
+### Builds the BTC index price database from 5-minute OHLC candles.
+###
+
+## NOTES:
+## The 'datetime' fields from 'btc_index_price_5min' collection are
+## relative to 'São Paulo -3 GMT local time'. As the Deribit's BTC options
+## (daily, weekly and monthly) contracts expires at 8:00 AM GMT (5:00 AM at
+## São Paulo -3 GMT local time). Unix time are in miliseconds.
+##
+## An ingestion mode to the index series that pulls thousands of 5-minute
+## candles per request from the chart data endpoint (instead of sampling the
+## last option trade of each window, one request per window). Each document
+## keeps the 'index_price' field (the candle close, as the last value of the
+## window) and adds 'open', 'high', 'low' and 'close'. Windows without a
+## candle aren't stored.
+##
+## Runs before "build_hist_btc_index_price_iv_5min.py": that sampler resumes
+## the index series from its most recent document, so it only samples the
+## windows that the candles didn't cover. To parity checks, write the candles
+## to another collection ('--collection') and compare it with the sampled
+## series.
+
+## USAGE:
+##     python build_hist_btc_index_candles_5min.py
+##     python build_hist_btc_index_candles_5min.py \
+##         --collection btc_index_candles_5min --start 2024-01-01
+
+import argparse
+import asyncio
+import datetime
+import time
+from pymongo import MongoClient, DESCENDING, ASCENDING, InsertOne
+from bulk_writer import BulkWriter
+from deribit_client import DeribitClient
+from deribit_fetcher import AsyncFetcher, run_ordered
+
+
+##
+## Support functions
+##
+
+def get_chunks(i_date, f_date, instrument):
+    """
+    Yields the (start, params) of the requests to the candles of an
+    instrument from the window 'i_date' to the window 'f_date', with up to
+    'candles_per_request' candles each.
+    """
+    while i_date <= f_date:
+
+        i_ts_unix = int(time.mktime(i_date.timetuple()) * 1000)
+        e_date = min(i_date + candles_per_request * window, f_date + window)
+        e_ts_unix = int(time.mktime(e_date.timetuple()) * 1000) - 1
+
+        params = {
+                  'instrument_name': instrument,
+                  'start_timestamp': i_ts_unix,
+                  'end_timestamp': e_ts_unix,
+                  'resolution': 5,
+                  }
+
+        yield i_date, params
+
+        i_date = e_date
+
+
+def get_candle_documents(data, params):
+    """
+    Returns the documents of the candles of a response within the requested
+    interval.
+    """
+    result = data.get('result', {})
+    ticks = result.get('ticks', [])
+
+    documents = []
+    for i, tick in enumerate(ticks):
+        if not (params['start_timestamp'] <= tick <= params['end_timestamp']):
+            continue
+        close = float(result['close'][i])
+        documents.append({
+                          'datetime': datetime.datetime.fromtimestamp(
+                                                                tick / 1000),
+                          'unix_time': tick,
+                          'index_price': close,
+                          'open': float(result['open'][i]),
+                          'high': float(result['high'][i]),
+                          'low': float(result['low'][i]),
+                          'close': close,
+                          })
+    return documents
+
+
+async def build_history(writer, i_date, f_date, args):
+    """
+    Fetches the candle chunks concurrently and inserts them in order. Returns
+    the number of candles and requests.
+    """
+    fetcher = AsyncFetcher(DeribitClient(pool_size=args.concurrency),
+                           concurrency=args.concurrency,
+                           rate=args.rate)
+    url = f"{args.base_url}{endpoint}"
+
+    async def fetch(chunk):
+        return await fetcher.get(url, chunk[1])
+
+    n_candles = 0
+    try:
+        async for (start, params), data in run_ordered(
+                                            fetch,
+                                            get_chunks(i_date, f_date,
+                                                       args.instrument),
+                                            lookahead=2 * args.concurrency):
+
+            # Stops at a failed request to keep the resume point correct.
+            if data is None:
+                print(f"Failed chunk: {start}. Stopping.")
+                break
+
+            documents = get_candle_documents(data, params)
+            for document in documents:
+                writer.add(InsertOne(document))
+            n_candles += len(documents)
+
+            # Shows the job execution on terminal.
+            print(start, len(documents))
+    finally:
+        print(fetcher.client.report())
+        fetcher.close()
+
+    return n_candles, fetcher.n_requests
+
+
+##
+## Main script
+##
+
+# API definitions.
+hist_base_url = "https://history.deribit.com/api/v2/public/"
+endpoint = f"get_tradingview_chart_data"
+
+# Candle settings.
+window = datetime.timedelta(minutes=5)
+candles_per_request = 5000
+index_instrument = "BTC-DERIBIT-INDEX"
+
+
+def main():
+    """
+    Updates the index price database up to the last closed hour.
+    """
+    parser = argparse.ArgumentParser(
+                description="Builds the BTC index price from candles.")
+    parser.add_argument("--base-url",
+                        default=hist_base_url,
+                        help="API base URL (ex.: a local stand-in server)")
+    parser.add_argument("--instrument",
+                        default=index_instrument,
+                        help="chart data instrument of the index")
+    parser.add_argument("--collection",
+                        default='btc_index_price_5min',
+                        help="target collection (ex.: to parity checks)")
+    parser.add_argument("--start",
+                        help="first window (YYYY-MM-DD) of an empty collection")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=4,
+                        help="maximum requests in flight")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=10,
+                        help="maximum requests per second")
+    args = parser.parse_args()
+
+    # DB access.
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+    collection = db[args.collection]
+
+    # Finds the document with the most recent date value.
+    last_document = collection.find_one(sort=[('datetime', -1)])
+
+    # Iteration interval - Initial value.
+    if last_document is None:
+        # To (re)build the entire database.
+        collection.create_index([('datetime', ASCENDING)])
+        collection.create_index([('datetime', DESCENDING)])
+        if args.start:
+            i_date = datetime.datetime.strptime(args.start, "%Y-%m-%d")
+        else:
+            i_date = datetime.datetime(2017, 1, 1, 0, 0, 0)
+    else:
+        # To update the database.
+        i_date = last_document['datetime'] + window
+
+    # Iteration interval - Final value.
+    td = datetime.datetime.now()
+    td -= datetime.timedelta(hours=1)
+    f_date = datetime.datetime(td.year, td.month, td.day, td.hour, 55, 0)
+
+    start = time.monotonic()
+    with BulkWriter(collection) as writer:
+        n_candles, n_requests = asyncio.run(build_history(writer,
+                                                          i_date,
+                                                          f_date,
+                                                          args))
+    elapsed = time.monotonic() - start
+
+    print(writer.report())
+    print(f"{n_candles} candles | {n_requests} requests | {elapsed:.1f} s")
+    print("The database is up to date!")
+
+
+if __name__ == "__main__":
+    main()
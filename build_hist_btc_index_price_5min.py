@@ -10,9 +10,9 @@
 
 import datetime
 import time
-import requests
 import json
 from pymongo import MongoClient, DESCENDING, ASCENDING
+from deribit_client import DeribitClient
 
 
 # API definitions.
@@ -20,6 +20,9 @@ hist_base_url = "https://history.deribit.com/api/v2/public/"
 endpoint_a = f"get_last_trades_by_currency_and_time"
 # endpoint_b = f"get_last_trades_by_instrument" # An alternative source.
 
+# API client.
+deribit = DeribitClient()
+
 # DB access.
 client = MongoClient('mongodb://localhost:27017/')
 db = client['deribit_btc_options']
@@ -66,17 +69,17 @@ while i_date <= f_date:
     #             'count': 1,                           
     #             }
 
-    response = requests.get(f"{hist_base_url}{endpoint_a}", params=params_a)
+    data = deribit.get(f"{hist_base_url}{endpoint_a}", params=params_a)
     
-    if response.status_code == 200:
-
-        data = response.json()
+    if data is not None:
 
         # Handles errors if there aren't trades within the time range.
         try:
             index_price = float(data['result']['trades'][0]['index_price'])
         except:
             index_price = None
+    else:
+        index_price = None
     
     document = {
                 'datetime': i_date,
@@ -93,4 +96,5 @@ while i_date <= f_date:
     # Sets a new hourly cycle.
     i_date += datetime.timedelta(minutes=5)
 
+print(deribit.report())
 print("The database is up to date!")
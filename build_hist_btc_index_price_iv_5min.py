@@ -0,0 +1,206 @@
+###
+### Builds the BTC index price and the BTC IV implied volatility databases.
+###
+
+## NOTES:
+## The 'datetime' fields from 'btc_index_price_5min' and
+## 'btc_iv_implied_volatility_5min' collections are relative to 'São Paulo -3
+## GMT local time'. As the Deribit's BTC options (daily, weekly and monthly)
+## contracts expires at 8:00 AM GMT (5:00 AM at São Paulo -3 GMT local time).
+## Unix time are in miliseconds.
+##
+## Replaces "build_hist_btc_index_price_5min.py" and
+## "build_hist_btc_iv_implied_volatility_5min.py" (kept to parity checks),
+## which query the same last trade of each 5-minute window: each window is
+## fetched once and both the 'index_price' and the 'iv' of its last trade are
+## stored, with bulk inserts. Each collection resumes from its own most
+## recent document. The windows are fetched concurrently (see
+## "deribit_fetcher.py") and committed in order: the run stops at the first
+## window that fails.
+
+## USAGE:
+##     python build_hist_btc_index_price_iv_5min.py --concurrency 8 --rate 20
+
+import argparse
+import asyncio
+import datetime
+import time
+from pymongo import MongoClient, DESCENDING, ASCENDING, InsertOne
+from bulk_writer import BulkWriter
+from deribit_client import DeribitClient
+from deribit_fetcher import AsyncFetcher, run_ordered
+
+
+##
+## Support functions
+##
+
+def get_start(collection):
+    """
+    Returns the first window to be fetched to a collection.
+    """
+    # Finds the document with the most recent date value.
+    last_document = collection.find_one(sort=[('datetime', -1)])
+
+    if last_document is None:
+        # To (re)build the entire database.
+        collection.create_index([('datetime', ASCENDING)])
+        collection.create_index([('datetime', DESCENDING)])
+        return datetime.datetime(2017, 1, 1, 0, 0, 0)
+
+    # To update the database.
+    return last_document['datetime'] + datetime.timedelta(minutes=5)
+
+
+def get_windows(i_date, f_date):
+    """
+    Yields the (datetime, unix_time, params) of the 5-minute windows from
+    'i_date' to 'f_date'.
+    """
+    while i_date <= f_date:
+
+        # Query interval (in milliseconds).
+        i_ts_unix = int(time.mktime(i_date.timetuple()) * 1000)
+        f_ts_unix = i_ts_unix + 299000 #  + 4min59sec
+
+        params = {
+                  'currency': "BTC",
+                  'kind': "option",
+                  #'start_timestamp': i_ts_unix,      # Optional.
+                  'end_timestamp': f_ts_unix,
+                  'count': 1,
+                  }
+
+        yield i_date, i_ts_unix, params
+
+        # Sets a new 5-minute cycle.
+        i_date += datetime.timedelta(minutes=5)
+
+
+def get_trade_value(data, field):
+    """
+    Returns a field of the last trade of a response (None if there aren't
+    trades within the time range).
+    """
+    try:
+        return float(data['result']['trades'][0][field])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+async def build_history(index_writer, iv_writer, index_start, iv_start,
+                        f_date, args):
+    """
+    Fetches the windows concurrently and writes both series in order.
+    Returns the number of committed windows and requests.
+    """
+    fetcher = AsyncFetcher(DeribitClient(pool_size=args.concurrency),
+                           concurrency=args.concurrency,
+                           rate=args.rate)
+    url = f"{args.base_url}{endpoint}"
+
+    async def fetch(window):
+        return await fetcher.get(url, window[2])
+
+    n_windows = 0
+    try:
+        async for (i_date, i_ts_unix, _), data in run_ordered(
+                                        fetch,
+                                        get_windows(min(index_start, iv_start),
+                                                    f_date),
+                                        lookahead=2 * args.concurrency):
+
+            # Stops at a failed window to keep the resume points correct.
+            if data is None:
+                print(f"Failed window: {i_date}. Stopping.")
+                break
+
+            index_price = get_trade_value(data, 'index_price')
+            iv = get_trade_value(data, 'iv')
+
+            if i_date >= index_start:
+                index_writer.add(InsertOne({
+                                            'datetime': i_date,
+                                            'unix_time': i_ts_unix,
+                                            'index_price': index_price
+                                            }))
+            if i_date >= iv_start:
+                iv_writer.add(InsertOne({
+                                         'datetime': i_date,
+                                         'unix_time': i_ts_unix,
+                                         'iv': iv
+                                         }))
+            n_windows += 1
+
+            # Shows the job execution on terminal.
+            print(i_date, index_price, iv)
+    finally:
+        print(fetcher.client.report())
+        fetcher.close()
+
+    return n_windows, fetcher.n_requests
+
+
+##
+## Main script
+##
+
+# API definitions.
+hist_base_url = "https://history.deribit.com/api/v2/public/"
+endpoint = f"get_last_trades_by_currency_and_time"
+
+
+def main():
+    """
+    Updates both databases up to the last closed hour.
+    """
+    parser = argparse.ArgumentParser(
+                description="Builds the BTC index price and IV databases.")
+    parser.add_argument("--base-url",
+                        default=hist_base_url,
+                        help="API base URL (ex.: a local stand-in server)")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=8,
+                        help="maximum requests in flight")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=20,
+                        help="maximum requests per second")
+    args = parser.parse_args()
+
+    # DB access.
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+    index_collection = db['btc_index_price_5min']
+    iv_collection = db['btc_iv_implied_volatility_5min']
+
+    # Iteration interval - Initial values.
+    index_start = get_start(index_collection)
+    iv_start = get_start(iv_collection)
+
+    # Iteration interval - Final value.
+    td = datetime.datetime.now()
+    td -= datetime.timedelta(hours=1)
+    f_date = datetime.datetime(td.year, td.month, td.day, td.hour, 55, 0)
+
+    start = time.monotonic()
+    with BulkWriter(index_collection) as index_writer, \
+         BulkWriter(iv_collection) as iv_writer:
+        n_windows, n_requests = asyncio.run(build_history(index_writer,
+                                                          iv_writer,
+                                                          index_start,
+                                                          iv_start,
+                                                          f_date,
+                                                          args))
+    elapsed = time.monotonic() - start
+
+    print(index_writer.report())
+    print(iv_writer.report())
+    print(f"{n_windows} windows | {n_requests} requests | "
+          f"{n_windows / elapsed if elapsed else 0:.1f} windows/s")
+    print("The database is up to date!")
+
+
+if __name__ == "__main__":
+    main()
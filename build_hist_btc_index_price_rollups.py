@@ -0,0 +1,252 @@
+###
+### Builds the BTC index price rollups (hourly, daily, weekly and monthly).
+###
+
+## IMPORTANT:
+## Is recommended to update the BTC index price database, by running the
+## "build_hist_btc_index_price_iv_5min.py" script before to execute this script.
+
+## NOTES:
+## The 'datetime' fields from 'btc_index_price_rollups' collection are
+## relative to 'São Paulo -3 GMT local time'. As the Deribit's BTC options
+## (daily, weekly and monthly) contracts expires at 8:00 AM GMT (5:00 AM at
+## São Paulo -3 GMT local time), the days start at 5am (local time), the weeks
+## on Monday 5am and the months on the first day 5am.
+##
+## One streaming stage: the new 5-minute prices are read once (in datetime
+## order) and every resolution ('1h', '1d', '1w', '1mo') is updated
+## incrementally. Each bucket document keeps a mergeable partial state
+## ('count', 'sum', 'sum_sq', 'min', 'max') plus the derived 'avg' and
+## 'std_dev' (sample), so a batch of points (or a late point) updates a
+## bucket with one upsert, without rescanning its prices. Null prices are
+## not counted.
+##
+## Each bucket also keeps the 'last_datetime' of its merged points: a
+## resolution resumes after its newest 'last_datetime', and a streamed batch
+## that isn't newer than it is ignored, so a rerun after a crash doesn't
+## count a point twice. The late points (ex.: the windows refetched by
+## "fill_gaps_btc_5min_series.py") are merged with 'update_rollups(...,
+## late=True)', only into the buckets the stream has already passed.
+
+## USAGE:
+##     python build_hist_btc_index_price_rollups.py
+##
+## Reading a rollup (ex.: the monthly means):
+##     db['btc_index_price_rollups'].find({'resolution': '1mo'},
+##                                        {'datetime': 1, 'avg': 1})
+
+import datetime
+import time
+from pymongo import MongoClient, ASCENDING, UpdateOne
+from bulk_writer import BulkWriter
+
+
+##
+## Support functions
+##
+
+def get_bucket(dt, resolution):
+    """
+    Returns the start of the bucket of a datetime.
+    """
+    if resolution == '1h':
+        return dt.replace(minute=0, second=0, microsecond=0)
+
+    # The days start at 5am.
+    day = (dt - day_offset).replace(hour=0, minute=0, second=0,
+                                    microsecond=0) + day_offset
+    if resolution == '1d':
+        return day
+    if resolution == '1w':
+        return day - datetime.timedelta(days=day.weekday())
+    if resolution == '1mo':
+        return day.replace(day=1)
+    raise ValueError(f"Unknown resolution: {resolution}")
+
+
+def get_watermark(collection, resolution):
+    """
+    Returns the datetime of the newest point merged into a resolution (or
+    None).
+    """
+    last_document = collection.find_one({'resolution': resolution},
+                                        sort=[('datetime', -1)])
+    return last_document['last_datetime'] if last_document else None
+
+
+def aggregate_points(points, resolution, after=None, until=None):
+    """
+    Returns the partial state of each bucket of a resolution from the
+    (datetime, price) points (after the datetime 'after' and up to the
+    datetime 'until', if given).
+    """
+    buckets = {}
+    for dt, price in points:
+        if ((price is None) or (after is not None and dt <= after) or
+            (until is not None and dt > until)):
+            continue
+        bucket = get_bucket(dt, resolution)
+        state = buckets.get(bucket)
+        if state is None:
+            buckets[bucket] = {'count': 1, 'sum': price, 'sum_sq': price ** 2,
+                               'min': price, 'max': price,
+                               'first': dt, 'last': dt}
+        else:
+            state['count'] += 1
+            state['sum'] += price
+            state['sum_sq'] += price ** 2
+            state['min'] = min(state['min'], price)
+            state['max'] = max(state['max'], price)
+            state['first'] = min(state['first'], dt)
+            state['last'] = max(state['last'], dt)
+    return buckets
+
+
+def get_bucket_update(resolution, bucket, state, late=False):
+    """
+    Returns the upsert that merges a partial state into a bucket and updates
+    its derived fields. A streamed state is ignored if the bucket already has
+    points from its first datetime on.
+    """
+    def merged(field, expression):
+        if late:
+            return expression
+        # Keeps the stored value to an already merged batch.
+        return {'$cond': [{'$lt': [{'$ifNull': ['$last_datetime',
+                                                datetime.datetime.min]},
+                                   state['first']]},
+                          expression,
+                          f"${field}"]}
+
+    def add(field):
+        return merged(field, {'$add': [{'$ifNull': [f"${field}", 0]},
+                                       state[field]]})
+
+    return UpdateOne(
+        {'resolution': resolution, 'datetime': bucket},
+        [
+         {'$set': {
+            'unix_time': {'$ifNull': ['$unix_time',
+                                      int(time.mktime(bucket.timetuple())
+                                          * 1000)]},
+            'count': add('count'),
+            'sum': add('sum'),
+            'sum_sq': add('sum_sq'),
+            'min': merged('min', {'$min': [{'$ifNull': ['$min',
+                                                        state['min']]},
+                                           state['min']]}),
+            'max': merged('max', {'$max': [{'$ifNull': ['$max',
+                                                        state['max']]},
+                                           state['max']]}),
+            'last_datetime': {'$max': [{'$ifNull': ['$last_datetime',
+                                                    state['last']]},
+                                       state['last']]},
+            }},
+         {'$set': {
+            'avg': {'$divide': ['$sum', '$count']},
+            'std_dev': {'$cond': [
+                {'$gt': ['$count', 1]},
+                {'$sqrt': {'$max': [0, {'$divide': [
+                    {'$subtract': ['$sum_sq',
+                                   {'$divide': [{'$multiply': ['$sum',
+                                                               '$sum']},
+                                                '$count']}]},
+                    {'$subtract': ['$count', 1]}]}]}},
+                None]},
+            }},
+         ],
+        upsert=True)
+
+
+def update_rollups(writer, points, watermarks, late=False):
+    """
+    Merges the (datetime, price) points into every resolution. Streamed
+    points are merged after the 'watermarks' (by resolution, then advanced);
+    late points only up to them. Returns the number of updated buckets.
+
+    Example usage:
+    with BulkWriter(collection) as writer:
+        watermarks = {r: get_watermark(collection, r) for r in resolutions}
+        update_rollups(writer, late_points, watermarks, late=True)
+    """
+    n_buckets = 0
+    for resolution in resolutions:
+        watermark = watermarks.get(resolution)
+        if late:
+            if watermark is None:
+                continue
+            buckets = aggregate_points(points, resolution, until=watermark)
+        else:
+            buckets = aggregate_points(points, resolution, after=watermark)
+
+        for bucket, state in sorted(buckets.items()):
+            writer.add(get_bucket_update(resolution, bucket, state, late))
+            if (not late) and (watermark is None or state['last'] > watermark):
+                watermark = state['last']
+        if not late:
+            watermarks[resolution] = watermark
+        n_buckets += len(buckets)
+
+    return n_buckets
+
+
+##
+## Main script
+##
+
+# Rollup settings.
+resolutions = ['1h', '1d', '1w', '1mo']
+day_offset = datetime.timedelta(hours=5)
+chunk_size = 50000 # 5-minute points per batch.
+
+
+def main():
+    """
+    Merges the new 5-minute prices into the rollups.
+    """
+    # DB access.
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+    in_collection = db['btc_index_price_5min'] # source DB.
+    out_collection = db['btc_index_price_rollups'] # target DB.
+    out_collection.create_index([('resolution', ASCENDING),
+                                 ('datetime', ASCENDING)], unique=True)
+
+    # Resumes each resolution from its own watermark.
+    watermarks = {resolution: get_watermark(out_collection, resolution)
+                  for resolution in resolutions}
+    if None in watermarks.values():
+        query = {}
+    else:
+        query = {'datetime': {'$gt': min(watermarks.values())}}
+
+    # Reads the new points once, in datetime order.
+    cursor = in_collection.find(query,
+                                {'datetime': 1, 'index_price': 1, '_id': 0},
+                                sort=[('datetime', ASCENDING)],
+                                batch_size=chunk_size)
+
+    n_points = 0
+    n_buckets = 0
+    with BulkWriter(out_collection, max_ops=5000) as writer:
+        points = []
+        for document in cursor:
+            points.append((document['datetime'],
+                           document.get('index_price')))
+            if len(points) >= chunk_size:
+                n_buckets += update_rollups(writer, points, watermarks)
+                n_points += len(points)
+                points = []
+
+                # Shows the job execution on terminal.
+                print(f"{document['datetime']} | {n_points} points")
+        n_buckets += update_rollups(writer, points, watermarks)
+        n_points += len(points)
+
+    print(writer.report())
+    print(f"{n_points} points | {n_buckets} bucket updates.")
+    print("The database is updated!")
+
+
+if __name__ == "__main__":
+    main()
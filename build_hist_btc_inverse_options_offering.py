@@ -3,22 +3,95 @@
 ###
 
 ## NOTES:
-## The 'datetime' fields from 'btc_inverse_options_offering' collection are 
-## relative to 'São Paulo -3 GMT local time'. As the Deribit's BTC options 
-## (daily, weekly and monthly) contracts expires at 8:00 AM GMT (5:00 AM at 
+## The 'datetime' fields from 'btc_inverse_options_offering' collection are
+## relative to 'São Paulo -3 GMT local time'. As the Deribit's BTC options
+## (daily, weekly and monthly) contracts expires at 8:00 AM GMT (5:00 AM at
 ## São Paulo -3 GMT local time). Unix time are in miliseconds.
+##
+## A set-based sync: the known 'instrument_id's (with their 'is_active' state)
+## are loaded with one projection query, the new instruments and the
+## active -> expired transitions are computed as set differences against the
+## API lists, and all the changes are applied with one bulk write.
 
 from datetime import datetime
-import requests
 import json
-from pymongo import MongoClient, DESCENDING, ASCENDING
-
+from pymongo import MongoClient, DESCENDING, ASCENDING, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from deribit_client import DeribitClient
+
+
+##
+## Support functions
+##
+
+def get_instruments(url, expired):
+    """
+    Returns the BTC option instruments (created since 2017-01-01) of the
+    API, by 'instrument_id', or None if the request fails.
+    """
+    params = {
+              'currency': "BTC",
+              'kind': "option",
+              'expired': 'true' if expired else 'false',
+              }
+
+    data = deribit.get(f"{url}{endpoint}", params=params)
+    if data is None:
+        return None
+
+    return {int(instrument['instrument_id']): instrument
+            for instrument in data['result']
+            # if (instrument['settlement_period'] == "day" and
+            #     instrument['creation_timestamp'] >= 1483228800000))
+            if (instrument['creation_timestamp'] >= 1483228800000)}
+
+
+def get_instrument_document(item):
+    """
+    Returns the document of an instrument.
+    """
+    creation_dt = datetime.fromtimestamp(
+                        (int(item['creation_timestamp']) / 1000.0))
+    expiration_dt = datetime.fromtimestamp(
+                        (int(item['expiration_timestamp']) / 1000.0))
+
+    return {
+        'instrument_id': int(item['instrument_id']),
+        'instrument_name': item['instrument_name'],
+        'is_active': item['is_active'],
+        'strike': float(item['strike']),
+        'tick_size': float(item['tick_size']),
+        'settlement_period': item['settlement_period'],
+        'creation_datetime': creation_dt,
+        'expiration_datetime': expiration_dt,
+        'creation_unix_timestamp': int(item['creation_timestamp']),
+        'expiration_unix_timestamp': int(item['expiration_timestamp']),
+        'base_currency': item['base_currency'],
+        'counter_currency': item['counter_currency'],
+        'quote_currency': item['quote_currency'],
+        'settlement_currency': item['settlement_currency'],
+        'price_index': item['price_index'],
+        'contract_size': int(item['contract_size']),
+        'min_trade_amount': float(item['min_trade_amount']),
+        'kind': item['kind'],
+        'option_type': item['option_type'],
+        'maker_commission': float(item['maker_commission']),
+        'taker_commission': float(item['taker_commission']),
+        }
+
+
+##
+## Main script
+##
 
 # API definitions.
 hist_base_url = "https://history.deribit.com/api/v2/public/" # Expired options.
 prod_base_url = "https://deribit.com/api/v2/public/" # Active options.
 endpoint = f"get_instruments"
 
+# API client.
+deribit = DeribitClient()
+
 # DB access.
 client = MongoClient('mongodb://localhost:27017/')
 db = client['deribit_btc_options']
@@ -30,167 +103,46 @@ if collection.find_one() is None:
     collection.create_index([('expiration_datetime', ASCENDING)])
     collection.create_index([('instrument_id', ASCENDING)])
 
-
-###
-### Handling expired instruments
-###
-
-# Defines query parameters to expired instruments.
-hist_params = {
-               'currency': "BTC",
-               'kind': "option",
-               'expired': 'true',
-               }
-
-# Gets the expired instrument data.
-hist_response = requests.get(f"{hist_base_url}{endpoint}", params=hist_params)
-
-# Iterates expired instruments.
-if hist_response.status_code == 200:
-    hist_data = hist_response.json()
-    hist_instrument_list = hist_data['result']
-    h_filtered_items = (instrument 
-                        for instrument in hist_instrument_list 
-                        # if (instrument['settlement_period'] == "day" and
-                        #     instrument['creation_timestamp'] >= 1483228800000))
-                        if (instrument['creation_timestamp'] >= 1483228800000)) 
-
-    # A simple counter.
-    c_exp = 0
-
-    for item in h_filtered_items:
-
-        query = {
-                 'instrument_id': int(item['instrument_id']),
-                 'is_active': False,
-                }
-
-        # To test if the expired instrument already was processed.
-        is_exp_doc_stored = collection.find_one(query)
-
-        if is_exp_doc_stored is None:
-
-            creation_dt = datetime.fromtimestamp(
-                                (int(item['creation_timestamp']) / 1000.0))
-            expiration_dt = datetime.fromtimestamp(
-                                (int(item['expiration_timestamp']) / 1000.0))
-
-            new_data = {
-                'instrument_id': int(item['instrument_id']),
-                'instrument_name': item['instrument_name'],
-                'is_active': item['is_active'],
-                'strike': float(item['strike']),
-                'tick_size': float(item['tick_size']),
-                'settlement_period': item['settlement_period'],
-                'creation_datetime': creation_dt,
-                'expiration_datetime': expiration_dt,
-                'creation_unix_timestamp': int(item['creation_timestamp']),
-                'expiration_unix_timestamp': int(item['expiration_timestamp']),
-                'base_currency': item['base_currency'],
-                'counter_currency': item['counter_currency'],
-                'quote_currency': item['quote_currency'],
-                'settlement_currency': item['settlement_currency'],
-                'price_index': item['price_index'],
-                'contract_size': int(item['contract_size']),
-                'min_trade_amount': float(item['min_trade_amount']),
-                'kind': item['kind'],
-                'option_type': item['option_type'],
-                'maker_commission': float(item['maker_commission']),
-                'taker_commission': float(item['taker_commission']),
-                }
-
-            # Updates or stores the instrument data.
-            filter = {'instrument_id': int(item['instrument_id']),}
-            collection.update_one(filter, {'$set': new_data}, upsert=True)
-
-            print(item['instrument_id'], 
-                  item['instrument_name'], 
-                  item['is_active'])
-        
-            c_exp += 1
-
-
-###
-### Handling active instruments
-###
-
-# Defines query parameters to active instruments.
-prod_params = {
-               'currency': "BTC",
-               'kind': "option",
-               'expired': 'false',
-               }
-
-# Gets the active instrument data.
-prod_response = requests.get(f"{prod_base_url}{endpoint}", params=prod_params)
-
-# Iterates active instruments.
-if prod_response.status_code == 200:
-    prod_data = prod_response.json()
-    prod_instrument_list = prod_data['result']
-    p_filtered_items = (instrument 
-                        for instrument in prod_instrument_list 
-                        # if (instrument['settlement_period'] == "day" and
-                        #     instrument['creation_timestamp'] >= 1483228800000))
-                        if (instrument['creation_timestamp'] >= 1483228800000)) 
-
-    # A simple counter.
-    c_act = 0
-
-    for item in p_filtered_items:
-
-        query = {
-                 'instrument_id': int(item['instrument_id']),
-                }
-
-        # To test if the active instrument already was processed.
-        is_act_doc_stored = collection.find_one(query)
-
-        if is_act_doc_stored is None:
-
-            creation_dt = datetime.fromtimestamp(
-                            (int(item['creation_timestamp']) / 1000.0))
-            expiration_dt = datetime.fromtimestamp(
-                            (int(item['expiration_timestamp']) / 1000.0))
-
-            document = {
-                'instrument_id': int(item['instrument_id']),
-                'instrument_name': item['instrument_name'],
-                'is_active': item['is_active'],
-                'strike': float(item['strike']),
-                'tick_size': float(item['tick_size']),
-                'settlement_period': item['settlement_period'],
-                'creation_datetime': creation_dt,
-                'expiration_datetime': expiration_dt,
-                'creation_unix_timestamp': int(item['creation_timestamp']),
-                'expiration_unix_timestamp': int(item['expiration_timestamp']),
-                'base_currency': item['base_currency'],
-                'counter_currency': item['counter_currency'],
-                'quote_currency': item['quote_currency'],
-                'settlement_currency': item['settlement_currency'],
-                'price_index': item['price_index'],
-                'contract_size': int(item['contract_size']),
-                'min_trade_amount': float(item['min_trade_amount']),
-                'kind': item['kind'],
-                'option_type': item['option_type'],
-                'maker_commission': float(item['maker_commission']),
-                'taker_commission': float(item['taker_commission']),
-                }
-
-            # Stores the new active instrument data.
-            collection.insert_one(document)
-
-            print(item['instrument_id'], 
-                  item['instrument_name'], 
-                  item['is_active'])
-        
-            c_act += 1
-
-print(f"Updated/Created expired docs: {c_exp} | Created active docs: {c_act}.")
-
-
-
-
-
-
-
+# Loads all known instruments (and their state) with one query.
+known = {document['instrument_id']: document.get('is_active')
+         for document in collection.find({}, {'instrument_id': 1,
+                                              'is_active': 1,
+                                              '_id': 0})}
+known_active = {i_id for i_id, is_active in known.items() if is_active}
+
+# Gets the expired and the active instrument lists.
+expired = get_instruments(hist_base_url, expired=True)
+active = get_instruments(prod_base_url, expired=False)
+
+operations = []
+
+# New expired instruments and active -> expired transitions.
+c_exp = 0
+c_trans = 0
+if expired is not None:
+    for i_id in expired.keys() - known.keys():
+        operations.append(InsertOne(get_instrument_document(expired[i_id])))
+        c_exp += 1
+    for i_id in expired.keys() & known_active:
+        operations.append(UpdateOne({'instrument_id': i_id},
+                                    {'$set': get_instrument_document(
+                                                            expired[i_id])}))
+        c_trans += 1
+
+# New active instruments.
+c_act = 0
+if active is not None:
+    for i_id in active.keys() - known.keys() - (expired or {}).keys():
+        operations.append(InsertOne(get_instrument_document(active[i_id])))
+        c_act += 1
+
+# Applies all the changes with one bulk write.
+if operations:
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        print(f"Write errors: {len(e.details.get('writeErrors', []))}")
+
+print(deribit.report())
+print(f"Created expired docs: {c_exp} | Expired (updated) docs: {c_trans} | "
+      f"Created active docs: {c_act}.")
@@ -12,15 +12,18 @@
 
 import datetime
 import time
-import requests
 import json
 from pymongo import MongoClient, DESCENDING, ASCENDING
+from deribit_client import DeribitClient
 
 
 # API definitions.
 hist_base_url = "https://history.deribit.com/api/v2/public/"
 endpoint = f"get_last_trades_by_currency_and_time"
 
+# API client.
+deribit = DeribitClient()
+
 # DB access.
 client = MongoClient('mongodb://localhost:27017/')
 db = client['deribit_btc_options']
@@ -59,17 +62,17 @@ while i_date <= f_date:
               'count': 1,                         
               }
 
-    response = requests.get(f"{hist_base_url}{endpoint}", params=params)
+    data = deribit.get(f"{hist_base_url}{endpoint}", params=params)
     
-    if response.status_code == 200:
-
-        data = response.json()
+    if data is not None:
 
         # Handles errors if there aren't trades within the time range.
         try:
             iv = float(data['result']['trades'][0]['iv'])
         except:
             iv = None
+    else:
+        iv = None
     
     document = {
                 'datetime': i_date,
@@ -86,4 +89,5 @@ while i_date <= f_date:
     # Sets a new hourly cycle.
     i_date += datetime.timedelta(minutes=5)
 
+print(deribit.report())
 print("The database is up to date!")
@@ -3,122 +3,485 @@
 ###
 
 ## NOTES:
-## The 'datetime' fields from 'btc_trade_history_5min' collection are 
-## relative to 'São Paulo -3 GMT local time'. As the Deribit's BTC options 
-## (daily, weekly and monthly) contracts expires at 8:00 AM GMT (5:00 AM at 
+## The 'datetime' fields from 'btc_trade_history_5min' collection are
+## relative to 'São Paulo -3 GMT local time'. As the Deribit's BTC options
+## (daily, weekly and monthly) contracts expires at 8:00 AM GMT (5:00 AM at
 ## São Paulo -3 GMT local time). Unix time are in miliseconds.
+##
+## The trades are fetched in adaptive spans: a span widens (up to 
+## '--max-span' minutes) while it returns few trades and narrows when it is
+## busy. A span that saturates the 'count' limit is split in halves and a 
+## saturated 5-minute window is paginated, so no trade is truncated. The 
+## coverage is recorded per 5-minute 'dt_control' bucket (with its trade count)
+## in 'btc_trade_history_5min_coverage', also to the empty buckets.
+##
+## The inserts are idempotent: trades are buffered and inserted in bulk
+## (unordered) against a unique index on the trade 'id' (and the coverage 
+## against a unique index on 'dt_control'), so a rerun or an overlapping 
+## window only counts duplicate key skips. The coverage writes are always 
+## flushed after the trades they cover.
+##
+## The spans are fetched concurrently (see "deribit_fetcher.py"), on a 
+## keep-alive connection pool and under a rate limit, but they are committed
+## in order: the run stops at the first span that fails, so the resume point
+## (the last covered bucket) never skips a window.
+##
+## Re-derivation: with '--from-archive' the collection is rebuilt from the
+## trade pages of a raw-response archive (see "deribit_archive.py"), with no
+## network access. The trades are upserted by 'id' (so a new field of
+## 'get_trade_document' reaches the stored trades, keeping the fields added
+## by the calc/fill scripts) and the windows covered by the pages get their
+## coverage records. A saturated page only covers the windows before the one
+## of its last trade (the rest of its range is covered by the next pages).
 
+## USAGE:
+##     python build_hist_btc_options_trades_5min.py --concurrency 8 --rate 20
+##
+## One request per 5-minute window (the former behavior):
+##     python build_hist_btc_options_trades_5min.py --max-span 5
+##
+## To record the responses to a cassette, and to test against a local
+## stand-in server that replays it (see "deribit_client.py" and
+## "deribit_stand_in.py"):
+##     DERIBIT_RECORD=trades.jsonl.gz \
+##         python build_hist_btc_options_trades_5min.py
+##     python build_hist_btc_options_trades_5min.py \
+##         --base-url http://localhost:8080/api/v2/public/
+##
+## To archive every raw page, and to re-derive the collection from it:
+##     DERIBIT_ARCHIVE=archive python build_hist_btc_options_trades_5min.py
+##     python build_hist_btc_options_trades_5min.py --from-archive archive \
+##         --since 2024-01-01
+
+import argparse
+import asyncio
 import datetime
 import time
-import requests
-import json
-from pymongo import MongoClient, DESCENDING, ASCENDING
+from pymongo import MongoClient, DESCENDING, ASCENDING, InsertOne, UpdateOne
+from pymongo.errors import OperationFailure
+from bulk_writer import BulkWriter
+from deribit_archive import iter_archive
+from deribit_client import DeribitClient
+from deribit_fetcher import AsyncFetcher, run_ordered
+
+
+##
+## Support functions
+##
+
+def floor_window(dt):
+    """
+    Returns the start of the 5-minute window of a datetime.
+    """
+    return dt.replace(minute=dt.minute - dt.minute % 5, second=0, 
+                      microsecond=0)
+
+
+def to_unix(dt):
+    """
+    Returns the Unix time of a (local) datetime, in miliseconds.
+    """
+    return int(time.mktime(dt.timetuple()) * 1000)
+
+
+def get_params(start, end, start_ts=None):
+    """
+    Returns the query parameters to the trades from 'start' (or from the 
+    Unix time 'start_ts') to just before 'end'.
+    """
+    return {
+            'currency': "BTC",
+            'kind': "option",
+            'start_timestamp': start_ts if start_ts else to_unix(start),
+            'end_timestamp': to_unix(end) - 1, # Up to x:x4:59.999.
+            'count': max_count,
+            'sorting': "asc",
+            }
+
+
+def is_saturated(result):
+    """
+    Tests if a response was truncated by the 'count' limit.
+    """
+    return (result.get('has_more', False) or 
+            len(result.get('trades', [])) >= max_count)
+
+
+def plan_spans(i_date, f_date, state):
+    """
+    Yields the (start, end) spans from 'i_date' to the end of the window 
+    'f_date'. The size of each span is read from 'state' when it is planned.
+    """
+    start = i_date
+    end_all = f_date + window
+    while start < end_all:
+        end = min(start + state['span'], end_all)
+        yield start, end
+        start = end
+
+
+def next_span(span, n_trades, elapsed, max_span):
+    """
+    Returns the next span size, aiming at 'target_trades' trades per request:
+    grows at most 2x per step and stays a multiple of 5 minutes.
+    """
+    if n_trades:
+        proposed = elapsed * target_trades / n_trades
+    else:
+        proposed = max_span
+    proposed = min(proposed, 2 * span, max_span)
+    return max(window, (proposed // window) * window)
+
+
+async def fetch_span(fetcher, url, start, end):
+    """
+    Fetches all the trades of a span, splitting it while it saturates the 
+    'count' limit and paginating a saturated 5-minute window. Returns the 
+    trades and the raw (params, data) pages, or None if a request fails.
+    """
+    params = get_params(start, end)
+    data = await fetcher.get(url, params)
+    if data is None:
+        return None
+    result = data.get('result', {})
+    trades = result.get('trades', [])
+    pages = [(params, data)]
+
+    if not is_saturated(result):
+        return trades, pages
+
+    # Splits a saturated span in halves.
+    if end - start > window:
+        mid = start + ((end - start) // window // 2) * window
+        halves = await asyncio.gather(fetch_span(fetcher, url, start, mid),
+                                      fetch_span(fetcher, url, mid, end))
+        if None in halves:
+            return None
+        return halves[0][0] + halves[1][0], halves[0][1] + halves[1][1]
+
+    # Paginates a saturated 5-minute window (from the last timestamp, as
+    # several trades can share it).
+    seen = {trade['trade_id'] for trade in trades}
+    while is_saturated(result):
+        params = get_params(start, end, start_ts=trades[-1]['timestamp'])
+        data = await fetcher.get(url, params)
+        if data is None:
+            return None
+        result = data.get('result', {})
+        pages.append((params, data))
+
+        new_trades = [trade for trade in result.get('trades', []) 
+                      if trade['trade_id'] not in seen]
+        if not new_trades:
+            print(f"Can't paginate beyond {trades[-1]['timestamp']} "
+                  f"(window {start}).")
+            break
+        seen.update(trade['trade_id'] for trade in new_trades)
+        trades += new_trades
+
+    return trades, pages
+
+
+def get_trade_document(trade):
+    """
+    Returns the document of a trade to the 'btc_trade_history_5min'
+    collection.
+    """
+    trade_dt = datetime.datetime.fromtimestamp(trade['timestamp'] / 1000)
+
+    return {
+            'id': trade['trade_id'],
+            'trade_seq': trade['trade_seq'],
+            'dt_control': floor_window(trade_dt),
+            'date_time': trade_dt,
+            'unix_time': trade['timestamp'],
+            'instrument_name': trade['instrument_name'],
+            'price': trade['price'],
+            'mark_price': trade['mark_price'],
+            'amount': trade['amount'],
+            'direction': trade['direction'],
+            'tick_direction': trade['tick_direction'],
+            'liquidation': trade.get('direction'), # As in the stored history.
+            'block_trade_id': trade.get('block_trade_id'),
+            'index_price': trade['index_price'],
+            'iv': trade['iv'],
+            }
+
+
+def get_coverage_documents(start, end, documents):
+    """
+    Returns the coverage documents (one to each 5-minute window) of a span.
+    """
+    counts = {}
+    for document in documents:
+        counts[document['dt_control']] = counts.get(document['dt_control'], 
+                                                    0) + 1
+    coverage = []
+    dt_control = start
+    while dt_control < end:
+        coverage.append({'dt_control': dt_control, 
+                         'n_trades': counts.get(dt_control, 0)})
+        dt_control += window
+    return coverage
+
+
+def ensure_unique_index(collection, field):
+    """
+    Creates a unique index on a field. Returns False if it can't be created
+    (ex.: the collection already has duplicates).
+    """
+    try:
+        collection.create_index([(field, ASCENDING)], unique=True)
+        return True
+    except OperationFailure as e:
+        print(f"No unique index on '{collection.name}.{field}' "
+              f"(duplicates are not skipped): {e}")
+        return False
+
+
+async def build_history(collection, coverage_collection, i_date, f_date, 
+                        args):
+    """
+    Fetches the spans concurrently and inserts their trades and coverage in 
+    order. Returns the number of covered windows, trades and requests.
+    """
+    fetcher = AsyncFetcher(DeribitClient(pool_size=args.concurrency), 
+                           concurrency=args.concurrency, 
+                           rate=args.rate)
+    url = f"{args.base_url}{endpoint_a}"
+    max_span = datetime.timedelta(minutes=args.max_span)
+    state = {'span': window}
+
+    # Coverage is flushed after the trades it covers.
+    trades_writer = BulkWriter(collection, max_ops=5000)
+    coverage_writer = BulkWriter(coverage_collection, 
+                                 max_ops=5000, 
+                                 flush_first=[trades_writer])
 
+    async def fetch(span):
+        return await fetch_span(fetcher, url, *span)
+
+    n_windows = 0
+    n_trades = 0
+    try:
+        async for (start, end), fetched in run_ordered(
+                                            fetch, 
+                                            plan_spans(i_date, f_date, state), 
+                                            lookahead=2 * args.concurrency):
+
+            # Stops at a failed span (or after failed trade writes, whose
+            # coverage is dropped) to keep the resume point correct.
+            if fetched is None:
+                print(f"Failed span: {start} - {end}. Stopping.")
+                break
+            if trades_writer.n_errors:
+                print(f"Failed trade writes before {start}. Stopping.")
+                break
+            trades, pages = fetched
+
+            documents = [get_trade_document(trade) for trade in trades]
+            for document in documents:
+                trades_writer.add(InsertOne(document))
+            for coverage in get_coverage_documents(start, end, documents):
+                coverage_writer.add(InsertOne(coverage))
+
+            n_windows += (end - start) // window
+            n_trades += len(documents)
+
+            # Adapts the size of the next planned spans.
+            state['span'] = next_span(state['span'], len(documents), 
+                                      end - start, max_span)
+
+            # Shows the job execution on terminal.
+            print(start, end, len(documents), len(pages))
+    finally:
+        coverage_writer.close()
+        print(fetcher.client.report())
+        print(trades_writer.report())
+        print(coverage_writer.report())
+        fetcher.close()
+
+    return n_windows, n_trades, fetcher.n_requests
+
+
+def rederive_history(collection, coverage_collection, archive, since=None):
+    """
+    Rebuilds the trades and the coverage from the archived trade pages (from
+    the date 'since'). Returns the number of pages, covered windows and
+    trades.
+    """
+    trades_writer = BulkWriter(collection, max_ops=5000)
+    coverage_writer = BulkWriter(coverage_collection,
+                                 max_ops=5000,
+                                 flush_first=[trades_writer])
+
+    n_pages = 0
+    n_trades = 0
+    covered = set()
+    try:
+        for params, data in iter_archive(archive, endpoint_a, start=since):
+
+            # Only the trade pages (not the samples of the index/IV builder).
+            if params.get('sorting') != "asc":
+                continue
+
+            result = data.get('result', {})
+            for trade in result.get('trades', []):
+                document = get_trade_document(trade)
+                trades_writer.add(UpdateOne({'id': document['id']},
+                                            {'$set': document},
+                                            upsert=True))
+                n_trades += 1
+
+            # Windows covered by the page (a saturated page is truncated at
+            # the window of its last trade).
+            start_dt = datetime.datetime.fromtimestamp(
+                                    int(params['start_timestamp']) / 1000)
+            end_dt = datetime.datetime.fromtimestamp(
+                                    (int(params['end_timestamp']) + 1) / 1000)
+            if is_saturated(result):
+                trades = result.get('trades', [])
+                end_dt = (floor_window(datetime.datetime.fromtimestamp(
+                                        trades[-1]['timestamp'] / 1000))
+                          if trades else start_dt)
+            dt_control = floor_window(start_dt)
+            while dt_control < end_dt:
+                covered.add(dt_control)
+                dt_control += window
+            n_pages += 1
+
+            if n_pages % 1000 == 0:
+                print(f"{n_pages} pages | {n_trades} trades")
+
+        # Counts the stored trades of the covered windows (no coverage is
+        # rebuilt if a trade write failed).
+        trades_writer.flush()
+        if trades_writer.n_errors:
+            print("Failed trade writes: the coverage isn't rebuilt.")
+            covered = set()
+        counts = {}
+        if covered:
+            for row in collection.aggregate([
+                    {'$match': {'dt_control': {'$gte': min(covered),
+                                               '$lte': max(covered)}}},
+                    {'$group': {'_id': '$dt_control', 'n': {'$sum': 1}}},
+                    ]):
+                counts[row['_id']] = row['n']
+        for dt_control in sorted(covered):
+            coverage_writer.add(UpdateOne({'dt_control': dt_control},
+                                          {'$set': {'n_trades': counts.get(
+                                                            dt_control, 0)}},
+                                          upsert=True))
+    finally:
+        coverage_writer.close()
+        print(trades_writer.report())
+        print(coverage_writer.report())
+
+    return n_pages, len(covered), n_trades
+
+
+##
+## Main script
+##
 
 # API definitions.
 hist_base_url = "https://history.deribit.com/api/v2/public/"
 endpoint_a = f"get_last_trades_by_currency_and_time"
 # endpoint_b = f"get_last_trades_by_instrument" # An alternative source.
 
-# DB access.
-client = MongoClient('mongodb://localhost:27017/')
-db = client['deribit_btc_options']
-collection = db['btc_trade_history_5min']
-
-# Finds the document with the most recent date value.
-last_document = collection.find_one(sort=[('date_time', -1)])
-
-# Iteration interval - Initial value.
-if last_document is None:
-    # To (re)build the entire database.
-    collection.create_index([('date_time', ASCENDING)])
-    collection.create_index([('date_time', DESCENDING)])
-    i_date = datetime.datetime(2017, 1, 1, 0, 0, 0)
-else:
-    # To update the database.
-    i_date = (last_document['dt_control'] + datetime.timedelta(minutes=5))
-
-# Iteration interval - Final value.
-td = datetime.datetime.now()
-td -= datetime.timedelta(hours=1)
-f_date = datetime.datetime(td.year, td.month, td.day, td.hour, 55, 0)
-
-# Iterates historical daily orders to extract the hourly index price.
-while i_date <= f_date:
-
-    # Query interval (in miliseconds).
-    i_ts_unix = int(time.mktime(i_date.timetuple()) * 1000)
-    f_ts_unix = i_ts_unix + 299999 #  + 4min59.999sec
-
-    params_a = {
-                'currency': "BTC",               
-                'kind': "option",               
-                'start_timestamp': i_ts_unix,      
-                'end_timestamp': f_ts_unix,        
-                'count': 10000,                         
-                }
-
-    # Parameters to an alternative endpoint.
-    # params_b = {
-    #             'instrument_name': "BTC-PERPETUAL", 
-    #             #'start_timestamp': i_ts_unix,      
-    #             'end_timestamp': f_ts_unix,          
-    #             'count': 1,                           
-    #             }
-
-    response = requests.get(f"{hist_base_url}{endpoint_a}", params=params_a)
-    
-    if response.status_code == 200:
-
-        data = response.json()
-
-        for t_num in range(10000):
-
-            # Handles errors if there aren't trades within the time range.
-            try:
-                trade = data['result']['trades'][t_num]
-
-                trade_dt = datetime.datetime.fromtimestamp(
-                                                    trade['timestamp'] / 1000)
-                try:
-                    liquidation = trade['direction']
-                except:
-                    liquidation = None
-
-                try:
-                    block_trade_id = trade['block_trade_id']
-                except:
-                    block_trade_id = None
-
-                document = {
-                            'id': trade['trade_id'],
-                            'trade_seq': trade['trade_seq'],
-                            'dt_control': i_date,
-                            'date_time': trade_dt,
-                            'unix_time': trade['timestamp'],
-                            'instrument_name': trade['instrument_name'],
-                            'price': trade['price'],
-                            'mark_price': trade['mark_price'],
-                            'amount': trade['amount'],
-                            'direction': trade['direction'],
-                            'tick_direction': trade['tick_direction'],
-                            'liquidation': liquidation,
-                            'block_trade_id': block_trade_id,
-                            'index_price': trade['index_price'],
-                            'iv': trade['iv'],
-                            }
-
-                # Insert the trade into the collection
-                #print(trade['trade_id'])
-                collection.insert_one(document)
-
-            except:
-                break
-    
-    # Shows the job execution on terminal.
-    print(i_date)
+# Window and span settings.
+window = datetime.timedelta(minutes=5)
+max_count = 10000    # Trades per request (API limit).
+target_trades = 2500 # Aimed trades per span.
+
+
+def main():
+    """
+    Updates the trade history database up to the last closed hour.
+    """
+    parser = argparse.ArgumentParser(
+                description="Builds the BTC trade history database.")
+    parser.add_argument("--base-url",
+                        default=hist_base_url,
+                        help="API base URL (ex.: a local stand-in server)")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=8,
+                        help="maximum requests in flight")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=20,
+                        help="maximum requests per second")
+    parser.add_argument("--max-span",
+                        type=int,
+                        default=1440,
+                        help="maximum span per request (minutes, from 5)")
+    parser.add_argument("--from-archive",
+                        help="re-derives the collection from an archive")
+    parser.add_argument("--since",
+                        help="first archive date (YYYY-MM-DD) to re-derive")
+    args = parser.parse_args()
+
+    # DB access.
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+    collection = db['btc_trade_history_5min']
+    coverage_collection = db['btc_trade_history_5min_coverage']
+    ensure_unique_index(collection, 'id')
+    ensure_unique_index(coverage_collection, 'dt_control')
+
+    # Re-derivation mode (no network access).
+    if args.from_archive:
+        if collection.find_one() is None:
+            collection.create_index([('date_time', ASCENDING)])
+            collection.create_index([('date_time', DESCENDING)])
+        since = (datetime.datetime.strptime(args.since, "%Y-%m-%d").date()
+                 if args.since else None)
+        start = time.monotonic()
+        n_pages, n_windows, n_trades = rederive_history(collection,
+                                                        coverage_collection,
+                                                        args.from_archive,
+                                                        since)
+        print(f"{n_pages} pages | {n_windows} windows | {n_trades} trades | "
+              f"{time.monotonic() - start:.1f} s")
+        print("The database is re-derived!")
+        return
+
+    # Finds the last covered window (or, to a history built before the 
+    # coverage records, the window of the most recent trade).
+    last_coverage = coverage_collection.find_one(sort=[('dt_control', -1)])
+    last_document = collection.find_one(sort=[('date_time', -1)])
+
+    # Iteration interval - Initial value.
+    if last_coverage is not None:
+        # To update the database.
+        i_date = last_coverage['dt_control'] + window
+    elif last_document is not None:
+        i_date = last_document['dt_control'] + window
+    else:
+        # To (re)build the entire database.
+        collection.create_index([('date_time', ASCENDING)])
+        collection.create_index([('date_time', DESCENDING)])
+        i_date = datetime.datetime(2017, 1, 1, 0, 0, 0)
+
+    # Iteration interval - Final value.
+    td = datetime.datetime.now()
+    td -= datetime.timedelta(hours=1)
+    f_date = datetime.datetime(td.year, td.month, td.day, td.hour, 55, 0)
+
+    start = time.monotonic()
+    n_windows, n_trades, n_requests = asyncio.run(
+                                        build_history(collection, 
+                                                      coverage_collection, 
+                                                      i_date, 
+                                                      f_date, 
+                                                      args))
+    elapsed = time.monotonic() - start
+
+    print(f"{n_windows} windows | {n_trades} trades | {n_requests} requests | "
+          f"{n_windows / elapsed if elapsed else 0:.1f} windows/s")
+    print("The database is up to date!")
 
-    # Sets a new hourly cycle.
-    i_date += datetime.timedelta(minutes=5)
 
-print("The database is up to date!")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+###
+### Builds the z lookup surface used by the 'surface' z approach.
+###
+
+## NOTES:
+## The surface is a table of ln(z) over a log-spaced (x, y) grid, stored as a
+## ".npy" file (memory-mapped on load) plus a ".json" file with the grid 
+## bounds. It only needs to be rebuilt when the grid or the solver changes.
+
+from z_solvers import build_z_surface, Z_SURFACE_PATH
+
+
+# Builds and stores the surface.
+n_solved = build_z_surface(Z_SURFACE_PATH)
+
+print(f"Surface stored at {Z_SURFACE_PATH} ({n_solved} solved nodes).")
+print("The job is done!")
@@ -0,0 +1,148 @@
+###
+### A buffered bulk writer shared by the per-document update scripts.
+###
+
+## NOTES:
+## Accumulates write operations (UpdateOne, InsertOne, ...) and sends them
+## with one 'bulk_write(ordered=False)' round trip, when the buffer reaches
+## 'max_ops' operations or when 'max_seconds' have passed since the last
+## flush. Flush latency and write failures (including the operations of a
+## failed round trip) are counted and can be reported. Duplicate key errors
+## (against a unique index) are counted as skips, so idempotent inserts can
+## be rerun. With 'flush_first' other writers are
+## flushed before each flush of this one (ex.: a watermark collection that
+## must never be ahead of the data it covers). If one of them had a write
+## failure since the last flush, the buffered operations of this one are
+## dropped (counted as skipped) instead of written, as they could cover the
+## lost writes.
+
+import time
+from pymongo.errors import BulkWriteError, PyMongoError
+
+
+class BulkWriter:
+    """
+    Buffers write operations to a collection and flushes them in bulk.
+
+    Example usage:
+    with BulkWriter(collection) as writer:
+        for doc in docs:
+            writer.add(UpdateOne({"_id": doc["_id"]}, {"$set": new_fields}))
+    print(writer.report())
+    """
+
+    def __init__(self, collection, max_ops=1000, max_seconds=5.0, 
+                 flush_first=None):
+        self.collection = collection
+        self.max_ops = max_ops
+        self.max_seconds = max_seconds
+        self.flush_first = flush_first or []
+        self.seen_errors = [writer.n_errors for writer in self.flush_first]
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+        # Counters.
+        self.n_ops = 0
+        self.n_flushes = 0
+        self.n_errors = 0
+        self.n_duplicates = 0
+        self.n_skipped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+
+    def add(self, operation):
+        """
+        Adds a write operation to the buffer, flushing it if it is full or
+        if it is too old.
+        """
+        self.buffer.append(operation)
+        if ((len(self.buffer) >= self.max_ops) or
+            (time.monotonic() - self.last_flush >= self.max_seconds)):
+            self.flush()
+
+
+    def flush(self):
+        """
+        Sends the buffered operations with one unordered bulk write. Returns
+        False if a write failed (other than a duplicate key) or if the 
+        operations were dropped after a failure of a 'flush_first' writer.
+        """
+        for writer in self.flush_first:
+            writer.flush()
+
+        # Drops the operations that could cover failed writes.
+        n_errors = [writer.n_errors for writer in self.flush_first]
+        if n_errors != self.seen_errors:
+            self.seen_errors = n_errors
+            if self.buffer:
+                print(f"Skipped {len(self.buffer)} writes to "
+                      f"'{self.collection.name}' (failed writes before).")
+            self.n_skipped += len(self.buffer)
+            self.buffer = []
+            self.last_flush = time.monotonic()
+            return False
+
+        if not self.buffer:
+            self.last_flush = time.monotonic()
+            return True
+
+        operations = self.buffer
+        self.buffer = []
+
+        ok = True
+        start = time.monotonic()
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Counts duplicate keys (code 11000) apart from other failures.
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == 11000:
+                    self.n_duplicates += 1
+                else:
+                    self.n_errors += 1
+                    ok = False
+                    print(f"Write error: {error.get('errmsg')}")
+        except PyMongoError as e:
+            # A failed round trip (ex.: a network error) loses all the batch.
+            self.n_errors += len(operations)
+            ok = False
+            print(f"Bulk write failed ({len(operations)} ops): {e}")
+        latency = time.monotonic() - start
+
+        self.n_ops += len(operations)
+        self.n_flushes += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.last_flush = time.monotonic()
+        return ok
+
+
+    def close(self):
+        """
+        Flushes the remaining operations. Returns False on a failure (see 
+        'flush').
+        """
+        return self.flush()
+
+
+    def report(self):
+        """
+        Returns a summary of the writes.
+        """
+        avg_latency = (self.total_latency / self.n_flushes 
+                       if self.n_flushes else 0)
+        return (f"Bulk writes to '{self.collection.name}': "
+                f"{self.n_ops} ops in {self.n_flushes} flushes | "
+                f"avg flush: {avg_latency * 1000:.1f} ms | "
+                f"max flush: {self.max_latency * 1000:.1f} ms | "
+                f"duplicates: {self.n_duplicates} | errors: {self.n_errors} | "
+                f"skipped: {self.n_skipped}")
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -17,7 +17,8 @@
 import math
 import pandas as pd
 from datetime import datetime
-from pymongo import MongoClient, DESCENDING, ASCENDING
+from pymongo import MongoClient, DESCENDING, ASCENDING, UpdateOne
+from bulk_writer import BulkWriter
 
 
 ##
@@ -44,7 +45,8 @@ client = MongoClient('mongodb://localhost:27017/')
 db = client['deribit_btc_options']
 collection = db['btc_avg_index_price_daily']
 
-cursor = collection.find().sort("datetime", ASCENDING)
+# Gets all documents (without the price lists).
+cursor = collection.find({}, {'prices': 0}).sort("datetime", ASCENDING)
 documents = list(cursor)
 
 if documents:
@@ -74,10 +76,11 @@ if documents:
     df['moving_avg_365d'] = df['avg_index_price_daily'].rolling(window=365).mean()
 
 
-    # Updates each document.
+    # Updates each document (buffered bulk writes).
+    writer = BulkWriter(collection)
     for index, row in df.iterrows():    
 
-        collection.update_one(
+        writer.add(UpdateOne(
             {'_id': row['_id']}, 
             {'$set': {
                 'moving_avg_30d': is_number(row['moving_avg_30d']),
@@ -88,10 +91,12 @@ if documents:
                 'moving_avg_200d': is_number(row['moving_avg_200d']),
                 'moving_avg_365d': is_number(row['moving_avg_365d']),
             }}
-        )
+        ))
 
         print(f"id: {row['_id']} | mov_avg_30: {row['moving_avg_30d']}")
 
+    writer.close()
+    print(writer.report())
     print("The job is done!")
 
 else:
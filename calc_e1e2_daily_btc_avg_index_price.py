@@ -15,7 +15,8 @@
 
 
 import numpy as np
-from pymongo import MongoClient, DESCENDING, ASCENDING
+from pymongo import MongoClient, DESCENDING, ASCENDING, UpdateOne
+from bulk_writer import BulkWriter
 from datetime import datetime, timedelta
 
 
@@ -67,12 +68,15 @@ collection = db['btc_avg_index_price_daily']
 # Defines iteration windows length (in days).
 windows_len_list = [30, 90,]
 
-# Gets all documents.
-cursor = collection.find().sort("datetime", ASCENDING)
+# Gets all documents (without the price lists).
+cursor = collection.find({}, {'prices': 0}).sort("datetime", ASCENDING)
 documents = list(cursor)
 
 if documents:
 
+    # Buffers the updates to the source collection.
+    writer = BulkWriter(collection)
+
     for n in windows_len_list:
 
         print(f"Iterating with {str(n)} days windows:")
@@ -101,10 +105,8 @@ if documents:
                          }
 
             # Updates the source collection.
-            collection.update_one(
-                                  {"_id": documents[i]["_id"]}, 
-                                  {"$set": new_fields}
-                                 )
+            writer.add(UpdateOne({"_id": documents[i]["_id"]}, 
+                                 {"$set": new_fields}))
 
             # Shows the job execution on terminal.
             id_doc = str(documents[i]["_id"])
@@ -113,6 +115,8 @@ if documents:
                   f" | e1_{str(n)}: {str(e1)} | e2_{str(n)}: {str(e2)}"
                  )
 
+    writer.close()
+    print(writer.report())
     print("The job is done!")
 
 else:
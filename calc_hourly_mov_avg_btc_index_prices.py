@@ -17,7 +17,8 @@
 import math
 import pandas as pd
 from datetime import datetime
-from pymongo import MongoClient, DESCENDING, ASCENDING
+from pymongo import MongoClient, DESCENDING, ASCENDING, UpdateOne
+from bulk_writer import BulkWriter
 
 
 ##
@@ -44,7 +45,8 @@ client = MongoClient('mongodb://localhost:27017/')
 db = client['deribit_btc_options']
 collection = db['btc_avg_index_price_hourly']
 
-cursor = collection.find().sort("datetime", ASCENDING)
+# Gets all documents (without the price lists).
+cursor = collection.find({}, {'prices': 0}).sort("datetime", ASCENDING)
 documents = list(cursor)
 
 if documents:
@@ -69,10 +71,11 @@ if documents:
     df['moving_avg_72h'] = df['avg_index_price_hourly'].rolling(window=72).mean()
     df['moving_avg_144h'] = df['avg_index_price_hourly'].rolling(window=144).mean()
 
-    # Updates each document.
+    # Updates each document (buffered bulk writes).
+    writer = BulkWriter(collection)
     for index, row in df.iterrows():    
 
-        collection.update_one(
+        writer.add(UpdateOne(
             {'_id': row['_id']}, 
             {'$set': {
                 'moving_avg_8h': is_number(row['moving_avg_8h']),
@@ -80,10 +83,12 @@ if documents:
                 'moving_avg_72h': is_number(row['moving_avg_72h']),
                 'moving_avg_144h': is_number(row['moving_avg_144h']),
             }}
-        )
+        ))
 
         print(f"id: {row['_id']} | mov_avg_24h: {row['moving_avg_24h']}")
 
+    writer.close()
+    print(writer.report())
     print("The job is done!")
 
 else:
@@ -19,7 +19,8 @@
 
 
 import datetime
-from pymongo import MongoClient, DESCENDING, ASCENDING
+from pymongo import MongoClient, DESCENDING, ASCENDING, UpdateOne
+from bulk_writer import BulkWriter
 
 
 # DB access.
@@ -32,6 +33,9 @@ instr_collection = db['btc_inverse_options_offering']
 invt_filter = {"inv_t": {"$exists": False}}
 trades = trades_collection.find(invt_filter)
 
+# Buffers the updates to the trade collection.
+writer = BulkWriter(trades_collection)
+
 if trades:
 
     # Computes and stores 't' to each historical trade.
@@ -65,14 +69,13 @@ if trades:
                          }
 
             # Updates the trade collection.
-            trades_collection.update_one(
-                                         {"_id": trade["_id"]}, 
-                                         {"$set": new_fields},
-                                        )
+            writer.add(UpdateOne({"_id": trade["_id"]}, {"$set": new_fields}))
 
             # Shows the job execution on terminal.
             print(f"id: {str(trade['id'])} | inv_t: {str(inv_t)}")
-        
+
+    writer.close()
+    print(writer.report())
     print("The job is done!")
 
 else:
@@ -1,404 +1,457 @@
 ###
-### Calculates z for each historical trade using four different approaches.
+### Calculates z for each historical trade using different approaches.
 ###
 
 ## IMPORTANT: 
 ## Is recommended to update the BTC trade history database, by running the 
 ## "build_hist_btc_options_trades_5min.py" script before to execute this script.
 
-import math # bisect
-import numpy as np # dual annealing
-from pymongo import MongoClient, DESCENDING, ASCENDING
-from scipy.optimize import fsolve # fsolve
-from scipy.optimize import brentq # brentq
-from scipy.optimize import bisect # bisect
-from scipy.optimize import dual_annealing # dual annealing
+## USAGE:
+## The approaches to compute in a run are selected by name (see 'Z_METHODS' in
+## "z_solvers.py"). Skipped approaches cost nothing and their fields stay 
+## untouched, so they can be backfilled later in a separate run. Ex.:
+##     python calc_zs_btc_options_trades.py --methods fsolve brentq
+##
+## With '--order instrument' the trades are grouped by 'instrument_name' and
+## sorted by 'unix_time', so each solve is seeded from (or bracketed around) 
+## the previous z of the same instrument (only to the approaches in 
+## 'Z_SEEDED'). '--compare' also runs the cursor order warm start on the same
+## trades and reports the function evaluations and failure rates of both. 
+## Ex.:
+##     python calc_zs_btc_options_trades.py --methods fsolve --order instrument
+##
+## With '--cache-size N' each approach is wrapped by a LRU cache of up to N
+## (x, y) pairs, so repeated inputs (block trades, fills of the same order) are
+## served without a new solve.
+##
+## Each stored result is tagged with its solver version ('z_<name>_version',
+## see 'Z_VERSIONS' in "z_solvers.py") and with the fingerprint of the inputs
+## it was computed from ('z_<name>_inputs': [price, index_price]). With
+## '--recompute' the run also takes the trades whose version is stale or whose
+## inputs changed (per approach), instead of only the trades without results.
+## Ex.:
+##     python calc_zs_btc_options_trades.py --methods newton --recompute
+##
+## With '--workers N' the unprocessed trades are split into 'unix_time' shards
+## (balanced by trade count) and run on a pool of N processes, each one with 
+## its own MongoClient. The shard plan is stored in the 
+## 'btc_trade_history_5min_z_shards' collection, so an interrupted run resumes
+## only the unfinished shards. Ex.:
+##     python calc_zs_btc_options_trades.py --methods newton --workers 16
+
+import argparse
+import math
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pymongo import MongoClient, DESCENDING, ASCENDING, UpdateOne
+from bulk_writer import BulkWriter
+from z_solvers import (Z_METHODS, Z_SEEDED, Z_VERSIONS, ZCache, funz_batch, 
+                       add_stats)
 
 
 ##
 ## Support functions
 ##
 
-def calculate_z_fsolve(x, y, z_initial=1.0, tolerance=1e-10):
+def is_number(num):
     """
-    FSOLVE APPROACH
-
-    Calculates the value of z for the given x and y based on the equation:
-        y(z) = (1 + x^z)^(1/z) - 1
-
-    Parameters:
-    x (float): the value of x in the equation
-    y (float): the target value of y(z)
-    z_initial (float): an initial guess for the value of z
-    tolerance: a value to accept an approximation of zero
+    Tests if 'num' is a float/integer number.
+    If true, returns the number as float. If not, returns 'None'.
+    """
+    if num is None or (isinstance(num, (int, float)) and math.isnan(num)):
+        return None
+    else:
+        return float(num)
 
-    Returns:
-    float: the calculated value of z
 
-    Example usage:
-    x = 1
-    y = 3
-    z = calculate_z_fsolve(x, y)
+def extract_strike(string):
     """
-
-    # Defines the object function to find its root.
-    #
-    # Y = option price
-    # X = BTC price
-    # S = Strike price
-    #
-    # y = Y/S
-    # x = X/S
-    #
-    # y(z) = (1 + x^z)^(1/z) - 1
-    #
-    # z = k1/t + k2E1 + k3E2 + k4x + k5 + error
-    #
-    # t = time to expiration (days)
-    #
-    # E1 = E1 is the slope of least squares line fitted to logarithms of the 
-    # monthly mean price for common stock for the previus eleven months.
-    #
-    # E2 = E2 is the standard deviation of natural logarithms of the monthly 
-    # mean price for the commos stock for the previous eleven months.
-    def func(z, x, y):
-        return ((1 + x**z)**(1/z)) - 1 - y
-
-    # Uses 'fsolve' with the generalized Newton-Raphson method and the 
-    # Levenberg-Marquardt algorithm.
-    root, info, ier, msg = fsolve(func,
-                                  z_initial,
-                                  args=(x, y), 
-                                  xtol=tolerance, 
-                                  full_output=True)
-    
-    # Check if the solution has converged (ier = 1)
-    if ier == 1:
-        return root[0]
+    Extracts the strike price from a Deribit's instrument name.
+    """
+    parts = string.split('-')
+    if len(parts) >= 3:
+        return parts[-2]  # Returns the second-to-last item.
     else:
         return None
 
 
-def calculate_z_brentq(x, y):
+def get_solver(method, args):
     """
-    BRENTQ APPROACH
-
-    Calculates the value of z for the given x and y based on the equation:
-        y(z) = (1 + x^z)^(1/z) - 1
-
-    Parameters:
-    x (float): the value of x in the equation
-    y (float): the target value of y(z)
-    z_initial (float): an initial guess for the value of z
-
-    Returns:
-    float: the calculated value of z
-
-    Example usage:
-    x = 1
-    y = 3
-    z = calculate_z_brentq(x, y)
+    Returns the registry approach to a method, wrapped by its z cache if the 
+    run uses caching. Caches are kept per process and method.
     """
+    if not args.cache_size:
+        return Z_METHODS[method]
 
-    # Defines the object function to find its root.
-    #
-    # Y = option price
-    # X = BTC price
-    # S = Strike price
-    #
-    # y = Y/S
-    # x = X/S
-    #
-    # y(z) = (1 + x^z)^(1/z) - 1
-    #
-    # z = k1/t + k2E1 + k3E2 + k4x + k5 + error
-    #
-    # t = time to expiration (days)
-    #
-    # E1 = E1 is the slope of least squares line fitted to logarithms of the 
-    # monthly mean price for common stock for the previus eleven months.
-    #
-    # E2 = E2 is the standard deviation of natural logarithms of the monthly 
-    # mean price for the commos stock for the previous eleven months.
-    def func(z, x, y):
-        return ((1 + x**z)**(1/z)) - 1 - y
-
-
-    def find_interval(x, y, z_init=1.0, step=1.0, max_limit=1000000.0):
-        """
-        Finds a valid interval to use Brent's method.
-        """
-        z1 = z_init
-        z2 = z1 + step
-
-        while z2 <= max_limit:
-            # Change of sign indicates root in the interval.
-            if func(z1, x, y) * func(z2, x, y) < 0:
-                return z1, z2
-
-            z1 = z2
-            z2 += step
-
-        # returns 'None' if it does not find a valid interval.
-        z1 = None
-        z2 = None
-        return z1, z2
-
-
-    # Uses Brent's method. It is more flexible and works well for finding roots 
-    # of non-linear functions even if the derivative is not available.
-    try:
-        z1, z2 = find_interval(x, y)
-        return brentq(func, z1, z2, args=(x, y), maxiter=10000)
-    except:
-        return None
+    if method not in z_caches:
+        z_caches[method] = ZCache(max_size=args.cache_size)
+    return z_caches[method].wrap(Z_METHODS[method])
 
 
-def calculate_z_bisect(x, y, z_lower=1, z_upper=1000, tolerance=1e-10):
+def process_batch(writer, batch, args, stats, seeds):
+    """
+    Computes and stores 'z' to the selected approaches to a batch of 
+    historical trades. Only the approaches still missing in each trade are 
+    computed. Solver counters are added to 'stats', and the warm start 
+    solutions are kept in 'seeds' (per approach) to the next batch.
+    """
+    # Extracts the strike prices.
+    strikes = [float(extract_strike(trade['instrument_name'])) 
+               for trade in batch]
+
+    # Gets x and y.
+    x = np.array([trade['index_price'] / strike 
+                  for trade, strike in zip(batch, strikes)])
+    y = np.array([(trade['price'] * trade['index_price']) / strike 
+                  for trade, strike in zip(batch, strikes)]) # Note: In USD.
+
+    new_fields = [
+                  {
+                   "strike": strikes[i],
+                   "x": float(x[i]),
+                   "y": float(y[i]),
+                  }
+                  for i in range(len(batch))
+                 ]
+
+    # Calculates z to each selected approach, only to the trades without it.
+    summary = []
+    for method in args.methods:
+
+        todo = [i for i, trade in enumerate(batch) 
+                if needs_z(trade, method, args.recompute)]
+        if not todo:
+            continue
+
+        # Groups the trades by instrument to seed each solve.
+        groups = None
+        if args.order == "instrument":
+            groups = [batch[i]['instrument_name'] for i in todo]
+
+        method_stats = stats.setdefault(method, {})
+        z = get_solver(method, args)(x[todo], y[todo], groups=groups, 
+                                     stats=method_stats, 
+                                     seeds=seeds.setdefault(method, {}))
+        fz = funz_batch(z, x[todo], y[todo])
+        add_stats(method_stats, 'trades', len(todo))
+        add_stats(method_stats, 'failures', int(np.sum(np.isnan(z))))
+
+        # Runs the cursor order warm start to compare (results discarded),
+        # on the same trades in 'unix_time' order.
+        if args.compare and groups is not None:
+            base_name = f"{method} (cursor order)"
+            base_stats = stats.setdefault(base_name, {})
+            order = sorted(todo, key=lambda i: batch[i]['unix_time'])
+            z_base = Z_METHODS[method](x[order], y[order], stats=base_stats, 
+                                       seeds=seeds.setdefault(base_name, {}))
+            add_stats(base_stats, 'trades', len(todo))
+            add_stats(base_stats, 'failures', int(np.sum(np.isnan(z_base))))
+
+        for j, i in enumerate(todo):
+            new_fields[i][f"z_{method}"] = is_number(z[j])
+            new_fields[i][f"fz_{method}"] = is_number(fz[j])
+            new_fields[i][f"z_{method}_version"] = Z_VERSIONS[method]
+            new_fields[i][f"z_{method}_inputs"] = get_z_inputs(batch[i])
+
+        summary.append(f"{method}: {int(np.sum(~np.isnan(z)))}/{len(todo)}")
+
+    # Updates the source collection (buffered bulk writes).
+    for trade, fields in zip(batch, new_fields):
+        writer.add(UpdateOne({"_id": trade["_id"]}, {"$set": fields}))
+
+    # Shows the job execution on terminal.
+    print(f"ut: {batch[0]['unix_time']}-{batch[-1]['unix_time']} | " + 
+          " | ".join(summary))
+
+
+def process_trades(collection, z_filter, args):
+    """
+    Reads the trades in batches, so the batch approaches solve them at once.
+    Returns the number of processed trades, the solver counters and if all 
+    the updates were written.
+    """
+    if args.order == "instrument":
+        sort = [('instrument_name', ASCENDING), ('unix_time', ASCENDING)]
+    else:
+        sort = [('unix_time', ASCENDING)] if args.workers > 1 else None
+    trades = collection.find(z_filter, sort=sort)
+
+    batch = []
+    count = 0
+    stats = {}
+    seeds = {}
+    with BulkWriter(collection) as writer:
+        for trade in trades:
+            batch.append(trade)
+            if len(batch) >= args.batch_size:
+                process_batch(writer, batch, args, stats, seeds)
+                count += len(batch)
+                batch = []
+
+        if batch:
+            process_batch(writer, batch, args, stats, seeds)
+            count += len(batch)
+        is_written = writer.close() and (writer.n_errors == 0)
+
+    print(writer.report())
+    for method, cache in z_caches.items():
+        print(f"{method} {cache.report()}")
+
+    return count, stats, is_written
+
+
+def merge_stats(total, stats):
+    """
+    Adds the solver counters of 'stats' to 'total'.
     """
-    BISECT APPROACH
+    for name, counters in stats.items():
+        for key, n in counters.items():
+            add_stats(total.setdefault(name, {}), key, n)
 
-    Calculates the value of z for the given x and y based on the equation:
-        y(z) = (1 + x^z)^(1/z) - 1
 
-    Parameters:
-    x (float): the value of x in the equation
-    y (float): the target value of y(z)
-    z_initial (float): an initial guess for the value of z
+def print_stats(stats):
+    """
+    Shows the failure rate and function evaluations per trade to each 
+    approach on terminal.
+    """
+    for name, counters in sorted(stats.items()):
+        trades = counters.get('trades', 0)
+        if not trades:
+            continue
+        fail_rate = counters.get('failures', 0) / trades
+        evals = counters.get('evaluations', 0) / trades
+        print(f"{name}: {trades} trades | failure rate: {fail_rate:.4%} | " + 
+              f"evaluations per trade: {evals:.2f}")
 
-    Returns:
-    float: the calculated value of z
 
-    Example usage:
-    x = 1
-    y = 3
-    z = calculate_z_bisect(x, y)
+def get_z_inputs(trade):
     """
-
-    # Defines the object function to find its root.
-    #
-    # Y = option price
-    # X = BTC price
-    # S = Strike price
-    #
-    # y = Y/S
-    # x = X/S
-    #
-    # y(z) = (1 + x^z)^(1/z) - 1
-    #
-    # z = k1/t + k2E1 + k3E2 + k4x + k5 + error
-    #
-    # t = time to expiration (days)
-    #
-    # E1 = E1 is the slope of least squares line fitted to logarithms of the 
-    # monthly mean price for common stock for the previus eleven months.
-    #
-    # E2 = E2 is the standard deviation of natural logarithms of the monthly 
-    # mean price for the commos stock for the previous eleven months.
-    def func(z, x, y):
-        # Use logarithm to avoid errors due to calculations with very large 
-        # numbers.
-        try:
-            log_term = z * math.log(x)
-            exp_term = math.exp(log_term)
-            log_expression = math.log(1 + exp_term)
-            result = math.exp(log_expression / z) - 1 - y
-            return result
-        except:
-            # If there is a big number.
-            return float('inf') 
-
-    # Tests if there is a signal change between z_lower and z_upper. If there is
-    # no signal change, expands the interval.
-    if func(z_lower, x, y) * func(z_upper, x, y) > 0:
-        
-        # Expands the interval.
-        while func(z_lower, x, y) * func(z_upper, x, y) > 0 and z_lower > 1:
-            z_lower -= 10  # Decrements it until to find a signal change.
-            if z_lower <= 1:
-                z_lower = 1
-                break
-
-        # Returns 'None' if a valid interval is not found.
-        if func(z_lower, x, y) * func(z_upper, x, y) > 0:
-            return None
-
-    # Applies the bisection method to the valid interval.
-    root = bisect(func, z_lower, z_upper, args=(x, y), xtol=tolerance)
-    return root
-
-
-def calculate_z_d_annealing(x, y):
+    Returns the input fingerprint of a trade (the strike is fixed by the 
+    instrument name).
     """
-    DUAL ANNEALING APPROACH
+    return [trade['price'], trade['index_price']]
 
-    Calculates the value of z for the given x and y based on the equation:
-        y(z) = (1 + x^z)^(1/z) - 1
 
-    Parameters:
-    x (float): the value of x in the equation
-    y (float): the target value of y(z)
-    z_initial (float): an initial guess for the value of z
-    tolerance: a value to accept an approximation of zero
+def needs_z(trade, method, recompute=False):
+    """
+    Tests if a trade needs a (new) 'z' to a method: if it has no result or, 
+    in the recompute mode, if its result version is stale or the inputs of
+    its result changed.
+    """
+    if f"z_{method}" not in trade:
+        return True
+    if recompute:
+        return ((trade.get(f"z_{method}_version") != Z_VERSIONS[method]) or 
+                (trade.get(f"z_{method}_inputs") != get_z_inputs(trade)))
+    return False
 
-    Returns:
-    float: the calculated value of z
 
-    Example usage:
-    x = 1
-    y = 3
-    z = calculate_z_d_annealing(x, y)
+def get_z_filter(methods, recompute=False):
     """
+    Returns a filter to the trades that miss any 'z_...' field of the given
+    methods or, in the recompute mode, that have a stale version or changed 
+    inputs.
+    """
+    if not recompute:
+        return {"$or": [{f"z_{method}": {"$exists": False}} 
+                        for method in methods]}
 
-    # Defines the object function to find its root.
-    #
-    # Y = option price
-    # X = BTC price
-    # S = Strike price
-    #
-    # y = Y/S
-    # x = X/S
-    #
-    # y(z) = (1 + x^z)^(1/z) - 1
-    #
-    # z = k1/t + k2E1 + k3E2 + k4x + k5 + error
-    #
-    # t = time to expiration (days)
-    #
-    # E1 = E1 is the slope of least squares line fitted to logarithms of the 
-    # monthly mean price for common stock for the previus eleven months.
-    #
-    # E2 = E2 is the standard deviation of natural logarithms of the monthly 
-    # mean price for the commos stock for the previous eleven months.
-    def func(z, x, y):
-        """
-        The object function to find the 'z' value.
-        """
-        try:
-            return (((1 + x**z)**(1/z)) - 1 - y) ** 2
-        except:
-            print(f"Overflow encountered with x={x}, z={z}")
-            return np.inf
-
-    # Uses 'dual_annealing' method.
-    try:
-        bounds = [(1, 1000)]
-        result = dual_annealing(func, bounds, args=(x, y))
-        return result.x[0] if result.success else None
-    except:
-        return None
+    return {"$or": [{f"z_{method}_version": {"$ne": Z_VERSIONS[method]}} 
+                    for method in methods] + 
+                   [{"$expr": {"$ne": [f"$z_{method}_inputs", 
+                                       ["$price", "$index_price"]]}}
+                    for method in methods]}
 
 
-def funz(z, x, y):
+def plan_shards(collection, shards_collection, methods, n_shards, recompute):
     """
-    Returns the computed 'zero' to given x, y and z values.
+    Returns the unfinished shards of a previous run to the same methods, or 
+    splits the unprocessed trades into 'n_shards' new 'unix_time' shards with 
+    a similar number of trades.
     """
-    if z:
-        return ((1 + x**z)**(1/z)) - 1 - y
-    else:
-        return None
-
-
-def extract_strike(string):
+    methods_key = sorted(methods)
+
+    # Resumes an interrupted run.
+    shards = list(shards_collection.find({"methods": methods_key, 
+                                          "recompute": recompute, 
+                                          "is_done": False}))
+    if shards:
+        print(f"Resuming {len(shards)} unfinished shards.")
+        return shards
+
+    # Balances the shards by trade count.
+    pipeline = [
+        {'$match': get_z_filter(methods, recompute)},
+        {'$bucketAuto': {'groupBy': '$unix_time', 'buckets': n_shards}},
+    ]
+    buckets = list(collection.aggregate(pipeline))
+
+    shards_collection.delete_many({"methods": methods_key, 
+                                   "recompute": recompute})
+    shards = []
+    for i, bucket in enumerate(buckets):
+        # Each shard goes up to the start of the next one.
+        if i + 1 < len(buckets):
+            end_ut = buckets[i + 1]['_id']['min']
+        else:
+            end_ut = bucket['_id']['max'] + 1
+        shards.append({
+                       "methods": methods_key,
+                       "recompute": recompute,
+                       "shard": i,
+                       "start_unix_time": bucket['_id']['min'],
+                       "end_unix_time": end_ut,
+                       "is_done": False,
+                       "count": 0,
+                      })
+
+    if shards:
+        shards_collection.insert_many(shards)
+
+    return shards
+
+
+def process_shard(shard, args):
     """
-    Extracts the strike price from a Deribit's instrument name.
+    Computes 'z' to the trades of a 'unix_time' shard in a worker process, 
+    with its own DB access. Marks the shard as done when all its updates are
+    written (a failed shard is retried by the next run).
     """
-    parts = string.split('-')
-    if len(parts) >= 3:
-        return parts[-2]  # Returns the second-to-last item.
-    else:
-        return None
+    # DB access (one client per process).
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+    collection = db['btc_trade_history_5min']
+    shards_collection = db['btc_trade_history_5min_z_shards']
+
+    z_filter = {
+                "$and": [
+                         get_z_filter(args.methods, args.recompute),
+                         {"unix_time": {"$gte": shard["start_unix_time"], 
+                                        "$lt": shard["end_unix_time"]}},
+                        ]
+               }
+    count, stats, is_written = process_trades(collection, z_filter, args)
+
+    if is_written:
+        shards_collection.update_one({"_id": shard["_id"]}, 
+                                     {"$set": {"is_done": True}, 
+                                      "$inc": {"count": count}})
+    client.close()
+
+    return shard["shard"], count, stats, is_written
 
 
 ##
 ## Main script
 ##
 
-# DB access.
-client = MongoClient('mongodb://localhost:27017/')
-db = client['deribit_btc_options']
-collection = db['btc_trade_history_5min']
-
-# An initial guess for z_fsolve. Note: z is in 1 <= z < infinite interval.
-z_init_fsolve = 1.0 
-
-# Gets all documents that don't have a 'z_fsolve' field.
-#z_filter = {"$or": [{"z_": {"$exists": False}}, {"z": None}]}
-z_filter = {"z_fsolve": {"$exists": False}}
-trades = collection.find(z_filter)
-
-if trades:
-
-    # Computes and stores 'z' to all approaches to each historical trade.
-    for trade in trades:
-
-        # Extracts the strike price.
-        strike = float(extract_strike(trade['instrument_name']))
-        
-        # Gets x and y.
-        x = (trade['index_price'] / strike)
-        y = ((trade['price'] * trade['index_price']) / strike) # Note: In USD.
-
-        # FSOLVE - Calculates z.
-        z_fsolve = calculate_z_fsolve(x, y, z_init_fsolve)
-        # Tries to calculate 'z_fsolve' with 'z_init_fsolve = 1.0'.
-        if (not z_fsolve) and (z_init_fsolve != 1.0):
-            z_init_fsolve = 1.0
-            z_fsolve = calculate_z_fsolve(x, y, z_init_fsolve)
-        fz_fsolve = funz(z_fsolve, x, y)
-
-        # BRENTQ - Calculates z.
-        z_brentq = calculate_z_brentq(x, y)
-        fz_brentq = funz(z_brentq, x, y)
-
-        # BISECT - Calculates z.
-        z_bisect = calculate_z_bisect(x, y)
-        fz_bisect = funz(z_bisect, x, y)
-
-        # DUAL ANNEALING - Calculates z.
-        z_d_annealing = calculate_z_d_annealing(x, y)
-        fz_d_annealing = funz(z_d_annealing, x, y)
-
-        new_fields = {
-                      "strike": strike,
-                      "x": x,
-                      "y": y,
-                      "z_fsolve": z_fsolve,
-                      "fz_fsolve": fz_fsolve,
-                      "z_brentq": z_brentq,
-                      "fz_brentq": fz_brentq,
-                      "z_bisect": z_bisect,
-                      "fz_bisect": fz_bisect,
-                      "z_d_annealing": z_d_annealing,
-                      "fz_d_annealing": fz_d_annealing,
-                     }
-
-        # Updates the source collection.
-        collection.update_one({"_id": trade["_id"]}, {"$set": new_fields})
-
-        # Shows the job execution on terminal.
-        print(f"id: {str(trade['id'])} | z_da: {str(z_d_annealing)} | f_da: {str(fz_d_annealing)}")
-
-        # Sets a new value to 'z_init_fsolve'.
-        if z_fsolve:
-            z_init_fsolve = z_fsolve
-
-    print("The job is done!")
-
-else:
-
-    print("There is nothing to do...")
-
-
-
-
-
-
+# Default approaches to compute (all of them, as the older runs).
+z_methods = ["fsolve", "brentq", "bisect", "d_annealing", "newton"]
 
+# Number of trades solved at once by the batch approaches.
+batch_size = 10000
 
+# The z caches of this process (per method), when '--cache-size' is set.
+z_caches = {}
 
 
+def main():
+    """
+    Computes 'z' to the selected approaches to each historical trade.
+    """
+    parser = argparse.ArgumentParser(description="Calculates z to trades.")
+    parser.add_argument("--methods", 
+                        nargs="+", 
+                        choices=list(Z_METHODS), 
+                        default=z_methods,
+                        help="z approaches to compute in this run")
+    parser.add_argument("--batch-size", type=int, default=batch_size)
+    parser.add_argument("--workers", 
+                        type=int, 
+                        default=1, 
+                        help="number of worker processes (sharded mode)")
+    parser.add_argument("--shards", 
+                        type=int, 
+                        default=None, 
+                        help="number of shards (default: 4 per worker)")
+    parser.add_argument("--order", 
+                        choices=["cursor", "instrument"], 
+                        default="cursor", 
+                        help="warm start from the previous trade (cursor) " + 
+                             "or from the previous trade of the instrument")
+    parser.add_argument("--cache-size", 
+                        type=int, 
+                        default=0, 
+                        help="max (x, y) pairs in each z cache (0: no cache)")
+    parser.add_argument("--recompute", 
+                        action="store_true", 
+                        help="also recomputes stale versions and changed "
+                             "inputs")
+    parser.add_argument("--compare", 
+                        action="store_true", 
+                        help="also runs the cursor order to compare")
+    args = parser.parse_args()
+
+    # Only some approaches are seeded by instrument (see 'Z_SEEDED').
+    if args.order == "instrument":
+        unseeded = [method for method in args.methods 
+                    if method not in Z_SEEDED]
+        if unseeded:
+            parser.error(f"'--order instrument' doesn't seed "
+                         f"{', '.join(unseeded)} (only {', '.join(Z_SEEDED)})")
+
+    # DB access.
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+    collection = db['btc_trade_history_5min']
+
+    if args.order == "instrument":
+        collection.create_index([('instrument_name', ASCENDING), 
+                                 ('unix_time', ASCENDING)])
+
+    if args.workers <= 1:
+
+        # Streams all trades in a single process.
+        count, stats, _ = process_trades(collection, 
+                                         get_z_filter(args.methods, 
+                                                      args.recompute), 
+                                         args)
 
+    else:
 
+        # Splits the trades into 'unix_time' shards to a pool of processes.
+        collection.create_index([('unix_time', ASCENDING)])
+        shards_collection = db['btc_trade_history_5min_z_shards']
+        n_shards = args.shards or (args.workers * 4)
+        shards = plan_shards(collection, 
+                             shards_collection, 
+                             args.methods, 
+                             n_shards, 
+                             args.recompute)
+
+        count = 0
+        stats = {}
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(process_shard, shard, args) 
+                       for shard in shards]
+            for future in as_completed(futures):
+                (shard_num, shard_count, shard_stats, 
+                 is_written) = future.result()
+                count += shard_count
+                merge_stats(stats, shard_stats)
+                if is_written:
+                    print(f"Shard {shard_num} is done "
+                          f"({shard_count} trades).")
+                else:
+                    print(f"Shard {shard_num} failed to write its updates "
+                          f"(it is retried by the next run).")
+
+    if count:
+        print_stats(stats)
+        print("The job is done!")
+    else:
+        print("There is nothing to do...")
 
 
+if __name__ == "__main__":
+    main()
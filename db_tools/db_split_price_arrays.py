@@ -0,0 +1,62 @@
+###
+### Moves the price lists of the hourly and daily average collections to
+### their detail collections.
+###
+
+## NOTES:
+## The average builders no longer store the 'prices' list in the stats
+## documents, but in a detail collection ('<collection>_prices', with the
+## 'datetime' and the 'prices'). This tool moves the lists of the former
+## documents (one '$merge' per collection, then one '$unset'). It can be
+## rerun. Run "db_recompact_database.py" afterwards to release the space.
+
+
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import OperationFailure
+
+##
+## Support functions.
+##
+
+def split_price_arrays(db, collection_name):
+    """
+    Moves the 'prices' field of a collection to its detail collection.
+    """
+    collection = db[collection_name]
+    prices_collection = db[f"{collection_name}_prices"]
+    prices_collection.create_index([('datetime', ASCENDING)], unique=True)
+
+    try:
+        # Copies the lists to the detail collection.
+        collection.aggregate([
+            {'$match': {'prices': {'$exists': True}}},
+            {'$project': {'_id': 0, 'datetime': 1, 'prices': 1}},
+            {'$merge': {
+                'into': prices_collection.name,
+                'on': 'datetime',
+                'whenMatched': 'replace',
+                'whenNotMatched': 'insert',
+            }},
+        ], allowDiskUse=True)
+
+        # Removes the lists from the stats documents.
+        result = collection.update_many({'prices': {'$exists': True}},
+                                        {'$unset': {'prices': ""}})
+        print(f"'{collection_name.upper()}': {result.modified_count} "
+              f"price lists moved to '{prices_collection.name.upper()}'.")
+
+    except OperationFailure as e:
+        print(f"There was an error on processing "
+              f"'{collection_name.upper()}': {e}")
+
+
+##
+## Main script.
+##
+
+client = MongoClient("mongodb://localhost:27017/")
+db = client["deribit_btc_options"]
+
+for collection_name in ['btc_avg_index_price_hourly',
+                        'btc_avg_index_price_daily']:
+    split_price_arrays(db, collection_name)
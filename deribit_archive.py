@@ -0,0 +1,245 @@
+###
+### A date-partitioned archive of the raw Deribit's API responses.
+###
+
+## NOTES:
+## The build scripts keep a subset of the fields of each response, so a new
+## field (ex.: the 'mark_iv' or the 'combo_id' of a trade) would need the
+## whole history to be downloaded again. With an archive (the 'archive'
+## argument of the shared client, or the 'DERIBIT_ARCHIVE' environment
+## variable, see "deribit_client.py") every raw response is also appended to
+## a gzip compressed JSONL segment of its date partition:
+##     <archive>/<endpoint>/<YYYY-MM>/<YYYY-MM-DD>.<run_id>.jsonl.gz
+## The date is the one of the queried data ('start_timestamp', or
+## 'end_timestamp'), or the fetch date to the requests without a time range
+## (ex.: the instrument lists). Each writer (run) has its own 'run_id' (its
+## start time and process id), so it only appends to its own segments. The
+## lines have the cassette format (see "deribit_cassette.py"), so each
+## segment is also a cassette. The former '<YYYY-MM-DD>.jsonl.gz' files are
+## still read (before the segments of their date).
+##
+## Re-derivation, with no network access:
+##     - any build script replays an archive as a cassette (a partition is
+##       loaded when a request needs it):
+##           DERIBIT_REPLAY=archive/ python build_hist_...py
+##     - the trade history is rebuilt from the archived pages, whatever the
+##       spans that fetched them ('--from-archive', see
+##       "build_hist_btc_options_trades_5min.py").
+## The segments are append-only. A crash can only truncate the last gzip
+## member of the segments of its own run: the reader stops there (and
+## reports it), without losing the segments of the other runs.
+
+import atexit
+import datetime
+import gzip
+import itertools
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from deribit_cassette import open_cassette, response_key
+
+
+def partition_date(params):
+    """
+    Returns the date of the data queried by a request, or None if it has no
+    time range.
+    """
+    ts = params.get('start_timestamp', params.get('end_timestamp'))
+    if ts is None:
+        return None
+    return datetime.datetime.fromtimestamp(int(ts) / 1000).date()
+
+
+def partition_path(root, endpoint, date, run_id):
+    """
+    Returns the segment file of a run in an archive partition.
+    """
+    return os.path.join(root, endpoint, f"{date:%Y-%m}",
+                        f"{date:%Y-%m-%d}.{run_id}.jsonl.gz")
+
+
+def list_partitions(root, endpoint, date=None):
+    """
+    Returns the (date, path) of the segments of an endpoint (of a date, if
+    given), by date and run (the former single files first).
+    """
+    partitions = []
+    endpoint_path = os.path.join(root, endpoint)
+    if date is not None:
+        months = [f"{date:%Y-%m}"]
+    elif os.path.isdir(endpoint_path):
+        months = os.listdir(endpoint_path)
+    else:
+        months = []
+    for month in months:
+        month_path = os.path.join(endpoint_path, month)
+        if not os.path.isdir(month_path):
+            continue
+        for name in os.listdir(month_path):
+            if not name.endswith('.jsonl.gz'):
+                continue
+            name_date = datetime.datetime.strptime(name[:10],
+                                                   "%Y-%m-%d").date()
+            if date is None or name_date == date:
+                is_segment = name != f"{name_date:%Y-%m-%d}.jsonl.gz"
+                partitions.append((name_date, is_segment,
+                                   os.path.join(month_path, name)))
+    return [(name_date, path) for name_date, _, path in sorted(partitions)]
+
+
+def read_records(path):
+    """
+    Yields the records of a segment (up to a truncated tail, if any).
+    """
+    try:
+        with open_cassette(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    except (EOFError, gzip.BadGzipFile, zlib.error,
+            json.JSONDecodeError) as e:
+        print(f"Truncated segment ({path}): {e}")
+
+
+def iter_archive(root, endpoint, start=None, end=None):
+    """
+    Yields the (params, response) of the archived responses of an endpoint,
+    by partition date and run (from the date 'start' to the date 'end').
+
+    Example usage:
+    for params, data in iter_archive("archive", endpoint):
+        ...
+    """
+    for date, path in list_partitions(root, endpoint):
+        if (start and date < start) or (end and date > end):
+            continue
+        for record in read_records(path):
+            yield record['params'], record['response']
+
+
+# Distinguishes the writers of a process.
+writer_ids = itertools.count()
+
+
+class ArchiveWriter:
+    """
+    Appends responses to the partitions of an archive, in segments of its
+    own run (thread safe).
+
+    Example usage:
+    with ArchiveWriter("archive") as archive:
+        archive.record(endpoint, params, response)
+    """
+
+    def __init__(self, root, max_open=16):
+        self.root = root
+        self.max_open = max_open
+        self.run_id = (f"{datetime.datetime.now():%Y%m%dT%H%M%S}-"
+                       f"{os.getpid()}-{next(writer_ids)}")
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.n_records = 0
+
+        # The scripts without an explicit close still get complete files.
+        atexit.register(self.close)
+
+
+    def record(self, endpoint, params, response):
+        """
+        Appends a response to its partition (segment of the run).
+        """
+        date = partition_date(params) or datetime.date.today()
+        path = partition_path(self.root, endpoint, date, self.run_id)
+        line = json.dumps({"endpoint": endpoint,
+                           "params": params,
+                           "response": response}) + "\n"
+        with self.lock:
+            if self.closed:
+                return
+            f = self.files.pop(path, None)
+            if f is None:
+                # Keeps a few segments open (the requests go by date).
+                if len(self.files) >= self.max_open:
+                    self.files.popitem(last=False)[1].close()
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = open_cassette(path, 'at')
+            self.files[path] = f
+            f.write(line)
+            self.n_records += 1
+
+
+    def close(self):
+        """
+        Closes the open partitions.
+        """
+        with self.lock:
+            self.closed = True
+            while self.files:
+                self.files.popitem()[1].close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ArchiveReader:
+    """
+    Serves the responses of an archive by cassette key (as the dict of a
+    loaded cassette), loading the partitions (all their segments) on demand
+    (thread safe).
+
+    Example usage:
+    responses = ArchiveReader("archive")
+    data = responses.get(response_key(endpoint, params))
+    """
+
+    def __init__(self, root, max_loaded=8):
+        self.root = root
+        self.max_loaded = max_loaded
+        self.loaded = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def load(self, endpoint, date):
+        """
+        Returns the responses of a partition, by key (the newest run wins).
+        """
+        responses = self.loaded.pop((endpoint, date), None)
+        if responses is None:
+            if len(self.loaded) >= self.max_loaded:
+                self.loaded.popitem(last=False)
+            responses = {}
+            for _, path in list_partitions(self.root, endpoint, date):
+                for record in read_records(path):
+                    key = response_key(record['endpoint'], record['params'])
+                    responses[key] = record['response']
+        self.loaded[(endpoint, date)] = responses
+        return responses
+
+
+    def get(self, key, default=None):
+        """
+        Returns the archived response of a key. A request without a time
+        range gets its newest archived response.
+        """
+        endpoint, params = key
+        date = partition_date(dict(params))
+        with self.lock:
+            if date is not None:
+                dates = [date]
+            else:
+                dates = sorted({partition[0] for partition in
+                                list_partitions(self.root, endpoint)},
+                               reverse=True)
+            for date in dates:
+                response = self.load(endpoint, date).get(key)
+                if response is not None:
+                    return response
+        return default
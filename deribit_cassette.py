@@ -0,0 +1,100 @@
+###
+### Record/replay cassettes of the Deribit's API responses.
+###
+
+## NOTES:
+## A cassette is a JSONL file (gzip compressed if its name ends with ".gz")
+## with one '{"endpoint": ..., "params": {...}, "response": {...}}' object per
+## line. The responses are keyed by the endpoint and the parameter values as
+## strings (as they travel in a query string), so a replay matches a recorded
+## request regardless of the parameter types. Cassettes are appended (a gzip
+## file gets a new member per run), and a later record of the same key
+## overrides the former one on load.
+##
+## The shared client (see "deribit_client.py") records and replays cassettes
+## and the stand-in server (see "deribit_stand_in.py") serves them.
+
+import atexit
+import gzip
+import json
+import threading
+
+
+def response_key(endpoint, params):
+    """
+    Returns the lookup key of a response.
+    """
+    return (endpoint,
+            tuple(sorted((k, str(v)) for k, v in (params or {}).items())))
+
+
+def open_cassette(path, mode='rt'):
+    """
+    Opens a cassette as a text file (gzip compressed if it ends with ".gz").
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def load_cassette(path):
+    """
+    Loads the responses of a cassette into a dict.
+    """
+    responses = {}
+    with open_cassette(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                key = response_key(record['endpoint'], record['params'])
+                responses[key] = record['response']
+    return responses
+
+
+class CassetteWriter:
+    """
+    Appends responses to a cassette (thread safe).
+
+    Example usage:
+    with CassetteWriter("responses.jsonl.gz") as cassette:
+        cassette.record(endpoint, params, response)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open_cassette(path, 'at')
+        self.lock = threading.Lock()
+        self.n_records = 0
+
+        # The scripts without an explicit close still get a complete file.
+        atexit.register(self.close)
+
+
+    def record(self, endpoint, params, response):
+        """
+        Appends a response.
+        """
+        line = json.dumps({"endpoint": endpoint,
+                           "params": params,
+                           "response": response}) + "\n"
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(line)
+                self.n_records += 1
+
+
+    def close(self):
+        """
+        Closes the cassette.
+        """
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
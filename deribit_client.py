@@ -0,0 +1,217 @@
+###
+### A shared HTTP client to the Deribit's API.
+###
+
+## NOTES:
+## Keeps one keep-alive 'requests.Session' (with a connection pool, so the
+## TLS handshake is done once per connection) and asks for gzip responses.
+## Every request has a (connect, read) timeout, and connection errors,
+## timeouts, 429 (rate limit) and 5xx responses are retried with exponential
+## backoff (or after the 'Retry-After' header). Other responses (ex.: 400)
+## aren't retried. The JSON is decoded with 'orjson' when it is installed.
+## Request count, errors, latency and bytes are counted per endpoint and can
+## be reported. The client is thread safe (see "deribit_fetcher.py").
+##
+## Record/replay (see "deribit_cassette.py"): with 'record' (or the
+## 'DERIBIT_RECORD' environment variable) every response is appended to a
+## cassette; with 'replay' (or 'DERIBIT_REPLAY') the responses are served
+## from a cassette, with no network access (a request without a recorded
+## response fails). With 'base_url' (or 'DERIBIT_BASE_URL') the requests go
+## to another server, as the local stand-in (see "deribit_stand_in.py"), with
+## the same endpoint paths. So any build script can be recorded, replayed or
+## load tested without changes, ex.:
+##     DERIBIT_RECORD=trades.jsonl.gz python build_hist_...py
+##     DERIBIT_REPLAY=trades.jsonl.gz python build_hist_...py
+##     DERIBIT_BASE_URL=http://localhost:8080 python build_hist_...py
+##
+## Archive (see "deribit_archive.py"): with 'archive' (or 'DERIBIT_ARCHIVE')
+## every response is also appended to a date-partitioned archive directory,
+## which can be replayed as a cassette ('DERIBIT_REPLAY=<archive dir>').
+
+## USAGE:
+##     deribit = DeribitClient()
+##     data = deribit.get(f"{hist_base_url}{endpoint}", params=params)
+##     if data is not None:
+##         ...
+##     print(deribit.report())
+
+import json
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from deribit_archive import ArchiveReader, ArchiveWriter
+from deribit_cassette import CassetteWriter, load_cassette, response_key
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+# API base URLs.
+hist_base_url = "https://history.deribit.com/api/v2/public/"
+prod_base_url = "https://www.deribit.com/api/v2/public/"
+
+
+class DeribitClient:
+    """
+    A pooled HTTP client with timeouts, retries and per-endpoint counters.
+
+    Example usage:
+    deribit = DeribitClient()
+    data = deribit.get(f"{prod_base_url}get_index_price",
+                       params={'index_name': "btc_usd"})
+    """
+
+    def __init__(self, pool_size=10, timeout=(5, 30), retries=5,
+                 backoff=0.5, max_backoff=30, record=None, replay=None,
+                 base_url=None, archive=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+        # Counters per endpoint.
+        self.lock = threading.Lock()
+        self.counters = {}
+
+        # Record/replay, archive and redirection.
+        record = record or os.environ.get("DERIBIT_RECORD")
+        replay = replay or os.environ.get("DERIBIT_REPLAY")
+        archive = archive or os.environ.get("DERIBIT_ARCHIVE")
+        self.cassette = CassetteWriter(record) if record else None
+        if replay and os.path.isdir(replay):
+            self.replay = ArchiveReader(replay)
+        else:
+            self.replay = load_cassette(replay) if replay else None
+        self.archive = ArchiveWriter(archive) if archive else None
+        self.base_url = base_url or os.environ.get("DERIBIT_BASE_URL")
+
+
+    def count(self, endpoint, latency, n_bytes, error):
+        """
+        Updates the counters of an endpoint.
+        """
+        with self.lock:
+            counter = self.counters.setdefault(endpoint,
+                                               {"requests": 0,
+                                                "errors": 0,
+                                                "latency": 0.0,
+                                                "max_latency": 0.0,
+                                                "bytes": 0})
+            counter["requests"] += 1
+            counter["errors"] += int(error)
+            counter["latency"] += latency
+            counter["max_latency"] = max(counter["max_latency"], latency)
+            counter["bytes"] += n_bytes
+
+
+    def wait(self, attempt, response=None):
+        """
+        Sleeps before a retry: 'Retry-After' seconds, if the response has it,
+        or an exponential backoff with jitter.
+        """
+        delay = None
+        if response is not None:
+            try:
+                delay = float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                delay = None
+        if delay is None:
+            delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+        time.sleep(min(delay, self.max_backoff))
+
+
+    def get(self, url, params=None):
+        """
+        Sends a GET request and returns the decoded JSON, or None if it fails
+        (after the retries).
+        """
+        endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+
+        if self.replay is not None:
+            data = self.replay.get(response_key(endpoint, params))
+            self.count(endpoint, 0.0, 0, data is None)
+            if data is None:
+                print(f"Not recorded ({endpoint}): {params}")
+            return data
+
+        if self.base_url:
+            url = f"{self.base_url.rstrip('/')}/{url.split('/', 3)[-1]}"
+
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                response = self.session.get(url, params=params,
+                                            timeout=self.timeout)
+            except requests.RequestException as e:
+                self.count(endpoint, time.monotonic() - start, 0, True)
+                print(f"Request error ({endpoint}): {e}")
+                if attempt < self.retries:
+                    self.wait(attempt)
+                continue
+
+            content = response.content
+            ok = response.status_code == 200
+            self.count(endpoint, time.monotonic() - start, len(content),
+                       not ok)
+
+            if ok:
+                try:
+                    data = json_loads(content)
+                except ValueError as e:
+                    print(f"Invalid JSON ({endpoint}): {e}")
+                    return None
+                if self.cassette:
+                    self.cassette.record(endpoint, params or {}, data)
+                if self.archive:
+                    self.archive.record(endpoint, params or {}, data)
+                return data
+
+            print(f"HTTP {response.status_code} ({endpoint}): {params}")
+            if response.status_code != 429 and response.status_code < 500:
+                return None
+            if attempt < self.retries:
+                self.wait(attempt, response)
+
+        return None
+
+
+    def close(self):
+        """
+        Closes the pooled connections (and the cassette and the archive).
+        """
+        self.session.close()
+        if self.cassette:
+            self.cassette.close()
+            self.cassette = None
+        if self.archive:
+            self.archive.close()
+            self.archive = None
+
+
+    def report(self):
+        """
+        Returns a summary of the requests per endpoint.
+        """
+        lines = []
+        with self.lock:
+            for endpoint, counter in sorted(self.counters.items()):
+                n = counter["requests"]
+                lines.append(f"API '{endpoint}': {n} requests | "
+                             f"errors: {counter['errors']} | "
+                             f"avg: {counter['latency'] / n * 1000:.1f} ms | "
+                             f"max: {counter['max_latency'] * 1000:.1f} ms | "
+                             f"{counter['bytes'] / 1e6:.1f} MB")
+        return "\n".join(lines) if lines else "API: no requests."
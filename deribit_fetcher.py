@@ -0,0 +1,122 @@
+###
+### Concurrent fetcher to the Deribit's history API windows.
+###
+
+## NOTES:
+## The HTTP calls run on the shared client (see "deribit_client.py"), from 
+## worker threads driven by asyncio: at most 'concurrency' requests are in
+## flight and a token bucket limits the request rate. The results are yielded
+## in the order of the windows (not in the order of the responses), so the
+## caller can commit them in order and keep its watermark ('dt_control')
+## correct.
+
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    """
+    Limits the request rate to 'rate' requests per second, with bursts of up
+    to 'burst' requests.
+
+    Example usage:
+    bucket = TokenBucket(rate=20, burst=20)
+    await bucket.acquire()
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst else max(1, rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+
+    async def acquire(self):
+        """
+        Waits for a token.
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncFetcher:
+    """
+    Sends GET requests from worker threads, with at most 'concurrency'
+    requests in flight and at most 'rate' requests per second.
+
+    Example usage:
+    fetcher = AsyncFetcher(DeribitClient(pool_size=8), concurrency=8, rate=20)
+    data = await fetcher.get(url, params)
+    fetcher.close()
+    """
+
+    def __init__(self, client, concurrency=8, rate=20):
+        self.client = client
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.n_requests = 0
+
+
+    async def get(self, url, params):
+        """
+        Returns the decoded JSON of a GET request, or None if it fails.
+        """
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            await self.bucket.acquire()
+            self.n_requests += 1
+            return await loop.run_in_executor(self.executor, self.client.get, 
+                                              url, params)
+
+
+    def close(self):
+        """
+        Stops the worker threads and closes the client.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.client.close()
+
+
+async def run_ordered(fetch, items, lookahead=16):
+    """
+    Runs the coroutine 'fetch(item)' to each item, with up to 'lookahead' 
+    items scheduled ahead, and yields (item, result) pairs in the order of 
+    'items'. 'items' can be a lazy iterator (it is advanced as the results 
+    are consumed).
+
+    Example usage:
+    async for params, data in run_ordered(fetch, params_list):
+        ...
+    """
+    items = iter(items)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append((item, asyncio.ensure_future(fetch(item))))
+            if len(pending) >= lookahead:
+                break
+
+        while pending:
+            item, task = pending.popleft()
+            result = await task
+            yield item, result
+            next_item = next(items, None)
+            if next_item is not None:
+                pending.append((next_item, 
+                                asyncio.ensure_future(fetch(next_item))))
+    finally:
+        for _, task in pending:
+            task.cancel()
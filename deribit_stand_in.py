@@ -0,0 +1,241 @@
+###
+### A local stand-in to the Deribit's API, which replays recorded responses.
+###
+
+## NOTES:
+## Serves 'GET /api/v2/public/<endpoint>?<params>' from a cassette of
+## recorded responses (see "deribit_cassette.py"; a cassette is recorded by
+## any build script with 'DERIBIT_RECORD=<file>'). Requests without a
+## recorded response get an empty trade list, as a window without trades.
+##
+## With '--trades FILE' (a JSONL file of trades, gzip compressed if it ends
+## with ".gz") the trade endpoint is served from that list to any time range,
+## with the 'count', 'sorting' and 'has_more' semantics of the API, to test
+## windows of any size.
+##
+## To load tests, '--latency' (plus a random '--jitter') delays every
+## response and '--rate' limits the requests per second of the server: the
+## excess requests get a 429 with a 'Retry-After' header, as the production
+## API. So the ingestion throughput can be measured deterministically,
+## without the production API.
+
+## USAGE:
+##     python deribit_stand_in.py trades.jsonl.gz --port 8080 \
+##         --latency 80 --jitter 40 --rate 20
+##     python deribit_stand_in.py --trades trades.jsonl --port 8080
+##     DERIBIT_BASE_URL=http://localhost:8080 \
+##         python build_hist_btc_options_trades_5min.py
+
+import argparse
+import bisect
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+from deribit_cassette import load_cassette, open_cassette, response_key
+
+
+##
+## Support functions
+##
+
+def load_trades(path):
+    """
+    Loads the trades of a JSONL file (gzip compressed if it ends with ".gz"),
+    sorted by timestamp.
+    """
+    with open_cassette(path, 'rt') as f:
+        trades = [json.loads(line) for line in f if line.strip()]
+    return sorted(trades, key=lambda trade: trade['timestamp'])
+
+
+def query_trades(trades, timestamps, params):
+    """
+    Answers a 'get_last_trades_by_currency_and_time' query from a sorted
+    trade list.
+    """
+    start = int(params.get('start_timestamp', 0))
+    end = int(params.get('end_timestamp', 2 ** 62))
+    count = int(params.get('count', 10))
+
+    selected = trades[bisect.bisect_left(timestamps, start):
+                      bisect.bisect_right(timestamps, end)]
+    if params.get('sorting') == 'asc':
+        page = selected[:count]
+    else:
+        page = selected[::-1][:count]
+
+    return {"jsonrpc": "2.0",
+            "result": {"trades": page, "has_more": len(selected) > count}}
+
+
+class RateLimiter:
+    """
+    A thread safe token bucket of the server (None rate: no limit).
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst if burst else max(1, rate or 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def allow(self):
+        """
+        Takes a token, if there is one.
+        """
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Replays the recorded responses of the server.
+    """
+
+    protocol_version = "HTTP/1.1" # Keep-alive connections.
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        endpoint = url.path.rstrip('/').rsplit('/', 1)[-1]
+        params = dict(parse_qsl(url.query))
+
+        with server.lock:
+            server.n_requests += 1
+
+        # Simulated network and server latency.
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.random() * server.jitter)
+
+        if not server.limiter.allow():
+            with server.lock:
+                server.n_limited += 1
+            self.send_json(429, {"jsonrpc": "2.0",
+                                 "error": {"code": 10028,
+                                           "message": "too_many_requests"}},
+                           {"Retry-After": "1"})
+            return
+
+        response = server.responses.get(response_key(endpoint, params))
+        if ((response is None) and (server.trades is not None) and
+            (endpoint == "get_last_trades_by_currency_and_time")):
+            response = query_trades(server.trades, server.timestamps, params)
+        if response is None:
+            response = {"jsonrpc": "2.0",
+                        "result": {"trades": [], "has_more": False}}
+
+        self.send_json(200, response)
+
+
+    def send_json(self, status, response, headers=None):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(responses, port=0, trades=None, latency=0.0, jitter=0.0,
+                 rate=None, burst=None):
+    """
+    Starts the stand-in server on a thread, with 'latency' and 'jitter' in
+    seconds and a 'rate' limit in requests per second. Returns the server
+    and its base URL.
+
+    Example usage:
+    server, base_url = start_server(load_cassette("trades.jsonl.gz"))
+    ...
+    server.shutdown()
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.responses = responses
+    server.trades = trades
+    server.timestamps = ([trade['timestamp'] for trade in trades]
+                         if trades is not None else None)
+    server.latency = latency
+    server.jitter = jitter
+    server.limiter = RateLimiter(rate, burst)
+    server.n_requests = 0
+    server.n_limited = 0
+    server.lock = threading.Lock()
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server, f"http://127.0.0.1:{server.server_port}/api/v2/public/"
+
+
+##
+## Main script
+##
+
+def main():
+    """
+    Runs the stand-in server until interrupted.
+    """
+    parser = argparse.ArgumentParser(
+                description="Replays recorded Deribit API responses.")
+    parser.add_argument("cassette",
+                        nargs="?",
+                        help="a cassette (JSONL, or gzip JSONL)")
+    parser.add_argument("--trades", help="a JSONL file of trades")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.0,
+                        help="delay of each response (ms)")
+    parser.add_argument("--jitter",
+                        type=float,
+                        default=0.0,
+                        help="maximum random extra delay (ms)")
+    parser.add_argument("--rate",
+                        type=float,
+                        help="maximum requests per second (429 beyond it)")
+    parser.add_argument("--burst",
+                        type=int,
+                        help="burst of requests above the rate")
+    args = parser.parse_args()
+
+    responses = load_cassette(args.cassette) if args.cassette else {}
+    trades = load_trades(args.trades) if args.trades else None
+    server, base_url = start_server(responses,
+                                    args.port,
+                                    trades,
+                                    latency=args.latency / 1000,
+                                    jitter=args.jitter / 1000,
+                                    rate=args.rate,
+                                    burst=args.burst)
+    print(f"Serving {len(responses)} responses at {base_url}")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"{server.n_requests} requests served "
+              f"({server.n_limited} rate limited).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+###
+### A local stand-in to the Deribit's WebSocket API, which replays recorded
+### trade messages.
+###
+
+## NOTES:
+## Replays the subscription messages recorded by "stream_btc_options_trades.py"
+## ('--record FILE'; JSONL, gzip compressed if the name ends with ".gz"). Each
+## connection gets a reply to 'public/set_heartbeat' and 'public/subscribe'
+## (any channel), then the recorded messages, one every '--interval' ms.
+##
+## To test the reconnection and the backfill, '--drop-after N' closes each
+## connection after N messages, and '--skip K' drops K messages after each
+## closed connection (the gap to backfill from the history stand-in, see
+## "deribit_stand_in.py"). The replay position is shared by the connections,
+## so a reconnected client resumes the stream.
+
+## USAGE:
+##     python deribit_ws_stand_in.py messages.jsonl.gz --port 8765 \
+##         --interval 10 --drop-after 500 --skip 50
+##     python stream_btc_options_trades.py --url ws://localhost:8765
+
+import argparse
+import asyncio
+import json
+from websockets.asyncio.server import serve
+from deribit_cassette import open_cassette
+
+
+##
+## Support functions
+##
+
+def load_messages(path):
+    """
+    Loads the recorded subscription messages of a file.
+    """
+    with open_cassette(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class WSStandIn:
+    """
+    Replays the recorded messages to the connected clients.
+
+    Example usage:
+    stand_in = WSStandIn(load_messages("messages.jsonl.gz"), drop_after=500)
+    async with serve(stand_in.handler, "127.0.0.1", 8765):
+        ...
+    """
+
+    def __init__(self, messages, interval=0.0, drop_after=None, skip=0):
+        self.messages = messages
+        self.interval = interval
+        self.drop_after = drop_after
+        self.skip = skip
+        self.position = 0
+        self.n_connections = 0
+        self.n_sent = 0
+
+
+    async def handler(self, ws):
+        """
+        Serves one connection.
+        """
+        self.n_connections += 1
+
+        # Answers the requests until subscribed.
+        async for message in ws:
+            request = json.loads(message)
+            if request.get('method') == "public/subscribe":
+                result = request['params']['channels']
+            else:
+                result = "ok"
+            await ws.send(json.dumps({"jsonrpc": "2.0",
+                                      "id": request.get('id'),
+                                      "result": result}))
+            if request.get('method') == "public/subscribe":
+                break
+
+        # Replays the messages.
+        n_sent = 0
+        while self.position < len(self.messages):
+            if (self.drop_after is not None) and (n_sent >= self.drop_after):
+                self.position += self.skip
+                break
+            await ws.send(self.messages[self.position])
+            self.position += 1
+            self.n_sent += 1
+            n_sent += 1
+            if self.interval:
+                await asyncio.sleep(self.interval)
+
+
+async def serve_forever(stand_in, port):
+    """
+    Runs the server until interrupted.
+    """
+    async with serve(stand_in.handler, "127.0.0.1", port) as server:
+        print(f"Serving {len(stand_in.messages)} messages at "
+              f"ws://127.0.0.1:{port}")
+        await server.serve_forever()
+
+
+##
+## Main script
+##
+
+def main():
+    """
+    Runs the stand-in server until interrupted.
+    """
+    parser = argparse.ArgumentParser(
+                description="Replays recorded Deribit WebSocket messages.")
+    parser.add_argument("messages", help="recorded messages (JSONL)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interval",
+                        type=float,
+                        default=0.0,
+                        help="delay between messages (ms)")
+    parser.add_argument("--drop-after",
+                        type=int,
+                        help="closes each connection after N messages")
+    parser.add_argument("--skip",
+                        type=int,
+                        default=0,
+                        help="messages lost after each dropped connection")
+    args = parser.parse_args()
+
+    stand_in = WSStandIn(load_messages(args.messages),
+                         interval=args.interval / 1000,
+                         drop_after=args.drop_after,
+                         skip=args.skip)
+    try:
+        asyncio.run(serve_forever(stand_in, args.port))
+    except KeyboardInterrupt:
+        print(f"{stand_in.n_sent} messages sent to "
+              f"{stand_in.n_connections} connections.")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ db = client['deribit_btc_options']
 collection = db['btc_avg_index_price_daily']
 
 # Buscar todos os documentos da collection
-documents = collection.find()
+documents = collection.find({}, {"prices": 0})
 
 # Lista para armazenar as razões
 ratios = []
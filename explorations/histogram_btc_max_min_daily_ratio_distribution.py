@@ -24,7 +24,7 @@ db = client['deribit_btc_options']
 collection = db['btc_avg_index_price_daily']
 
 # Retrieves the data.
-documents = collection.find()
+documents = collection.find({}, {"prices": 0})
 
 # An empty list to store the computed ratios.
 ratios = []
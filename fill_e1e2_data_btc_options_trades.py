@@ -19,7 +19,8 @@
 
 
 from datetime import datetime, timedelta
-from pymongo import MongoClient, DESCENDING, ASCENDING
+from pymongo import MongoClient, DESCENDING, ASCENDING, UpdateOne
+from bulk_writer import BulkWriter
 
 
 ##
@@ -89,6 +90,9 @@ instr_filter = {"$and": [
                         ]}
 trades = trades_collection.find(instr_filter)
 
+# Buffers the updates to the trade collection.
+writer = BulkWriter(trades_collection)
+
 if trades:
 
     period = "settlement_period" # A short alias. 
@@ -138,10 +142,8 @@ if trades:
 
             if new_fields:
                 # Updates the trade collection.
-                trades_collection.update_one(
-                                             {"_id": trade["_id"]}, 
-                                             {"$set": new_fields},
-                                            )
+                writer.add(UpdateOne({"_id": trade["_id"]}, 
+                                     {"$set": new_fields}))
 
                 # Shows the job execution on terminal.
                 print(f"id: {str(trade['id'])} | e1_24h: {str(new_fields['e1_24h'])}")
@@ -186,10 +188,8 @@ if trades:
 
             if new_fields:
                 # Updates the trade collection.
-                trades_collection.update_one(
-                                             {"_id": trade["_id"]}, 
-                                             {"$set": new_fields},
-                                            )
+                writer.add(UpdateOne({"_id": trade["_id"]}, 
+                                     {"$set": new_fields}))
 
                 # Shows the job execution on terminal.
                 print(f"id: {str(trade['id'])} | e1_30d: {str(new_fields['e1_30d'])}")
@@ -199,7 +199,9 @@ if trades:
         else:
             continue
 
-        
+
+    writer.close()
+    print(writer.report())
     print("The job is done!")
 
 else:
@@ -0,0 +1,360 @@
+###
+### Finds and refetches the missing 5-minute buckets of the BTC series.
+###
+
+## NOTES:
+## The 5-minute builders resume from their most recent document, so a hole
+## left by a crashed run or a failed request (a window stored with a None
+## 'index_price' or 'iv') is never revisited. This script scans the three
+## series with one aggregation over their time indexes:
+##     - 'btc_index_price_5min' ('datetime', 'index_price'),
+##     - 'btc_iv_implied_volatility_5min' ('datetime', 'iv'),
+##     - 'btc_trade_history_5min', through its per-window coverage records
+##       ('btc_trade_history_5min_coverage', 'dt_control'), as a window
+##       without trades is not a gap.
+## The series are unioned and each document is compared with the previous
+## one of its series ('$setWindowFields' + '$shift'), so only the anomalies
+## (a jump over 5 minutes or a null value) leave the server.
+##
+## Only the gaps between the first and the last document of each series are
+## found: the builders still extend the series. The gap buckets are then
+## refetched concurrently (see "deribit_fetcher.py"):
+##     - the index price and the IV with one request per window (as in
+##       "build_hist_btc_index_price_iv_5min.py"), upserted by 'datetime';
+##     - the trades in spans of consecutive missing windows (as in
+##       "build_hist_btc_options_trades_5min.py"), inserted against the
+##       unique trade 'id' index, with their coverage records.
+## The refetched index prices are also merged, as late points, into the
+## rollup buckets already built (see "build_hist_btc_index_price_rollups.py").
+## A window that still has no trade keeps its None value and is flagged
+## 'checked: True', so the next scans skip it (a failed request leaves it
+## unflagged, to be retried). Requires MongoDB 5.0+.
+
+## USAGE:
+##     python fill_gaps_btc_5min_series.py --dry-run
+##     python fill_gaps_btc_5min_series.py --since 2024-01-01 \
+##         --concurrency 8 --rate 20
+
+import argparse
+import asyncio
+import datetime
+import time
+from pymongo import MongoClient, InsertOne, UpdateOne
+from bulk_writer import BulkWriter
+from deribit_client import DeribitClient
+from deribit_fetcher import AsyncFetcher, run_ordered
+from build_hist_btc_index_price_iv_5min import get_trade_value, get_windows
+from build_hist_btc_index_price_rollups import (get_watermark,
+                                                resolutions,
+                                                update_rollups)
+from build_hist_btc_options_trades_5min import (ensure_unique_index,
+                                                endpoint_a,
+                                                fetch_span,
+                                                get_coverage_documents,
+                                                get_trade_document,
+                                                hist_base_url,
+                                                window)
+
+
+##
+## Support functions
+##
+
+def series_pipeline(name, time_field, value_field, since):
+    """
+    Returns the stages that map the documents of a series to
+    '{series, t, ok}' ('ok': the value is not null, or it was confirmed 
+    empty).
+    """
+    match = {time_field: {'$gte': since}} if since else {}
+    if value_field:
+        ok = {'$or': [
+                      {'$gt': [f"${value_field}", None]}, # False to null.
+                      {'$eq': ['$checked', True]},
+                      ]}
+    else:
+        ok = {'$literal': True}
+
+    return [
+            {'$match': match},
+            {'$project': {
+                          '_id': 0,
+                          'series': {'$literal': name},
+                          't': f"${time_field}",
+                          'ok': ok,
+                          }},
+            ]
+
+
+def scan_gaps(db, since=None):
+    """
+    Returns the gap buckets (missing or null) of each series, by series
+    name, with one aggregation.
+    """
+    (first_name, first_collection, time_field, value_field), *others = series
+    pipeline = series_pipeline(first_name, time_field, value_field, since)
+    for name, collection, time_field, value_field in others:
+        pipeline.append({'$unionWith': {
+                            'coll': collection,
+                            'pipeline': series_pipeline(name, time_field,
+                                                        value_field, since),
+                            }})
+    pipeline += [
+                 {'$setWindowFields': {
+                    'partitionBy': '$series',
+                    'sortBy': {'t': 1},
+                    'output': {'prev': {'$shift': {'output': '$t',
+                                                   'by': -1}}},
+                    }},
+                 {'$match': {'$or': [
+                    {'ok': False},
+                    {'$expr': {'$gt': [{'$subtract': ['$t', '$prev']},
+                                       window_ms]}},
+                    ]}},
+                 ]
+
+    gaps = {name: set() for name, *_ in series}
+    for row in db[first_collection].aggregate(pipeline, allowDiskUse=True):
+        buckets = gaps[row['series']]
+        if not row['ok']:
+            buckets.add(row['t'])
+        if (row.get('prev') is not None) and (row['t'] - row['prev'] > window):
+            bucket = row['prev'] + window
+            while bucket < row['t']:
+                buckets.add(bucket)
+                bucket += window
+
+    return {name: sorted(buckets) for name, buckets in gaps.items()}
+
+
+def group_spans(buckets, max_span):
+    """
+    Returns the (start, end) spans of consecutive buckets, up to 'max_span'
+    each.
+    """
+    spans = []
+    for bucket in buckets:
+        if (spans and spans[-1][1] == bucket and
+            bucket + window - spans[-1][0] <= max_span):
+            spans[-1][1] = bucket + window
+        else:
+            spans.append([bucket, bucket + window])
+    return [tuple(span) for span in spans]
+
+
+async def fill_index_iv(index_writer, iv_writer, gaps, args):
+    """
+    Refetches the index price and IV gap windows (one request to both).
+    Returns the number of filled windows and the refetched index price
+    points.
+    """
+    index_gaps = set(gaps['index_price'])
+    iv_gaps = set(gaps['iv'])
+    windows = (window_params
+               for bucket in sorted(index_gaps | iv_gaps)
+               for window_params in get_windows(bucket, bucket))
+
+    fetcher = AsyncFetcher(DeribitClient(pool_size=args.concurrency),
+                           concurrency=args.concurrency,
+                           rate=args.rate)
+    url = f"{args.base_url}{endpoint_a}"
+
+    async def fetch(window_params):
+        return await fetcher.get(url, window_params[2])
+
+    n_filled = 0
+    index_points = []
+    try:
+        async for (i_date, i_ts_unix, _), data in run_ordered(
+                                            fetch,
+                                            windows,
+                                            lookahead=2 * args.concurrency):
+            if data is None:
+                print(f"Failed window: {i_date}.")
+                continue
+
+            index_price = get_trade_value(data, 'index_price')
+            iv = get_trade_value(data, 'iv')
+
+            # A window still without trades is flagged as checked.
+            if i_date in index_gaps:
+                fields = {'unix_time': i_ts_unix, 'index_price': index_price}
+                if index_price is None:
+                    fields['checked'] = True
+                index_writer.add(UpdateOne({'datetime': i_date},
+                                           {'$set': fields},
+                                           upsert=True))
+                index_points.append((i_date, index_price))
+            if i_date in iv_gaps:
+                fields = {'unix_time': i_ts_unix, 'iv': iv}
+                if iv is None:
+                    fields['checked'] = True
+                iv_writer.add(UpdateOne({'datetime': i_date},
+                                        {'$set': fields},
+                                        upsert=True))
+            n_filled += 1
+
+            # Shows the job execution on terminal.
+            print(i_date, index_price, iv)
+    finally:
+        print(fetcher.client.report())
+        fetcher.close()
+
+    return n_filled, index_points
+
+
+async def fill_trades(trades_writer, coverage_writer, buckets, args):
+    """
+    Refetches the trades of the uncovered windows, in spans. Returns the
+    number of filled windows and trades.
+    """
+    spans = group_spans(buckets, datetime.timedelta(minutes=args.max_span))
+
+    fetcher = AsyncFetcher(DeribitClient(pool_size=args.concurrency),
+                           concurrency=args.concurrency,
+                           rate=args.rate)
+    url = f"{args.base_url}{endpoint_a}"
+
+    async def fetch(span):
+        return await fetch_span(fetcher, url, *span)
+
+    n_windows = 0
+    n_trades = 0
+    try:
+        async for (start, end), fetched in run_ordered(
+                                            fetch,
+                                            spans,
+                                            lookahead=2 * args.concurrency):
+            if fetched is None:
+                print(f"Failed span: {start} - {end}.")
+                continue
+            trades, _ = fetched
+
+            documents = [get_trade_document(trade) for trade in trades]
+            for document in documents:
+                trades_writer.add(InsertOne(document))
+            for coverage in get_coverage_documents(start, end, documents):
+                coverage_writer.add(InsertOne(coverage))
+
+            n_windows += (end - start) // window
+            n_trades += len(documents)
+
+            # Shows the job execution on terminal.
+            print(start, end, len(documents))
+    finally:
+        print(fetcher.client.report())
+        fetcher.close()
+
+    return n_windows, n_trades
+
+
+##
+## Main script
+##
+
+# The scanned series: (name, collection, time field, value field).
+series = [
+          ('index_price', 'btc_index_price_5min', 'datetime', 'index_price'),
+          ('iv', 'btc_iv_implied_volatility_5min', 'datetime', 'iv'),
+          ('trades', 'btc_trade_history_5min_coverage', 'dt_control', None),
+          ]
+window_ms = int(window.total_seconds() * 1000)
+
+
+def main():
+    """
+    Scans the gaps of the 5-minute series and refetches them.
+    """
+    parser = argparse.ArgumentParser(
+                description="Fills the gaps of the BTC 5-minute series.")
+    parser.add_argument("--since",
+                        help="scans from a date (YYYY-MM-DD) on")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="only reports the gaps")
+    parser.add_argument("--base-url",
+                        default=hist_base_url,
+                        help="API base URL (ex.: a local stand-in server)")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=8,
+                        help="maximum requests in flight")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=20,
+                        help="maximum requests per second")
+    parser.add_argument("--max-span",
+                        type=int,
+                        default=1440,
+                        help="maximum trade span per request (minutes)")
+    args = parser.parse_args()
+
+    # DB access.
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+
+    since = (datetime.datetime.strptime(args.since, "%Y-%m-%d")
+             if args.since else None)
+
+    start = time.monotonic()
+    gaps = scan_gaps(db, since)
+    print(f"Scanned in {time.monotonic() - start:.1f} s.")
+    for name, buckets in gaps.items():
+        print(f"{name}: {len(buckets)} gap windows"
+              + (f" ({buckets[0]} - {buckets[-1]})" if buckets else ""))
+
+    if args.dry_run:
+        return
+
+    # Index price and IV.
+    if gaps['index_price'] or gaps['iv']:
+        with BulkWriter(db['btc_index_price_5min']) as index_writer, \
+             BulkWriter(db['btc_iv_implied_volatility_5min']) as iv_writer:
+            n_filled, index_points = asyncio.run(fill_index_iv(index_writer,
+                                                               iv_writer,
+                                                               gaps,
+                                                               args))
+        print(index_writer.report())
+        print(iv_writer.report())
+        print(f"Index price / IV: {n_filled} windows refetched.")
+
+        # Merges the late index prices into the rollups.
+        rollups = db['btc_index_price_rollups']
+        with BulkWriter(rollups) as rollup_writer:
+            watermarks = {resolution: get_watermark(rollups, resolution)
+                          for resolution in resolutions}
+            n_buckets = update_rollups(rollup_writer,
+                                       index_points,
+                                       watermarks,
+                                       late=True)
+        print(f"Rollups: {n_buckets} buckets updated.")
+
+    # Trades (the coverage is flushed after the trades it covers).
+    if gaps['trades']:
+        ensure_unique_index(db['btc_trade_history_5min'], 'id')
+        ensure_unique_index(db['btc_trade_history_5min_coverage'],
+                            'dt_control')
+        trades_writer = BulkWriter(db['btc_trade_history_5min'],
+                                   max_ops=5000)
+        coverage_writer = BulkWriter(db['btc_trade_history_5min_coverage'],
+                                     max_ops=5000,
+                                     flush_first=[trades_writer])
+        try:
+            n_windows, n_trades = asyncio.run(fill_trades(trades_writer,
+                                                          coverage_writer,
+                                                          gaps['trades'],
+                                                          args))
+        finally:
+            coverage_writer.close()
+        print(trades_writer.report())
+        print(coverage_writer.report())
+        print(f"Trades: {n_windows} windows | {n_trades} trades refetched.")
+        if coverage_writer.n_skipped:
+            print("Some trade writes failed: their windows are left uncovered "
+                  "(rescanned on the next run).")
+
+    print("The gaps are filled!")
+
+
+if __name__ == "__main__":
+    main()
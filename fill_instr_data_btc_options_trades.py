@@ -17,7 +17,8 @@
 ## All Unix time fields are in miliseconds.
 
 
-from pymongo import MongoClient, DESCENDING, ASCENDING
+from pymongo import MongoClient, DESCENDING, ASCENDING, UpdateOne
+from bulk_writer import BulkWriter
 
 
 # DB access.
@@ -30,6 +31,9 @@ instr_collection = db['btc_inverse_options_offering']
 instr_filter = {"settlement_period": {"$exists": False}}
 trades = trades_collection.find(instr_filter)
 
+# Buffers the updates to the trade collection.
+writer = BulkWriter(trades_collection)
+
 if trades:
 
     # Retrieves and stores respective instrument data to each historical trade.
@@ -52,14 +56,13 @@ if trades:
                          }
 
             # Updates the trade collection.
-            trades_collection.update_one(
-                                         {"_id": trade["_id"]}, 
-                                         {"$set": new_fields},
-                                        )
+            writer.add(UpdateOne({"_id": trade["_id"]}, {"$set": new_fields}))
 
             # Shows the job execution on terminal.
             print(f"id: {str(trade['id'])}")
-        
+
+    writer.close()
+    print(writer.report())
     print("The job is done!")
 
 else:
@@ -13,9 +13,12 @@
 
 import datetime
 import time
-import requests
 import json
 from pymongo import MongoClient, DESCENDING, ASCENDING
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from deribit_client import DeribitClient
 import math
 import numpy as np
 from mpmath import mp
@@ -36,6 +39,9 @@ prod_base_url = "https://deribit.com/api/v2/public/"
 order_book_endpoint = f"get_order_book"
 index_price_endpoint = f"get_index_price"
 
+## Deribit API client (see "deribit_client.py").
+deribit = DeribitClient()
+
 ## Local DB access.
 client = MongoClient('mongodb://localhost:27017/')
 db = client['deribit_btc_options']
@@ -62,11 +68,10 @@ td_00h_unix = int(td_00h.timestamp() * 1000) # In miliseconds
 
 ### Gets the base index price.
 index_price_params = {'index_name': "btc_usd"}
-response = requests.get(f"{prod_base_url}{index_price_endpoint}", 
-                        params=index_price_params)
+data = deribit.get(f"{prod_base_url}{index_price_endpoint}", 
+                   params=index_price_params)
 
-if response.status_code == 200:
-    data = response.json()
+if data is not None:
     base_index_price = float(data['result']['index_price'])
 
 
@@ -290,11 +295,9 @@ for instrument in active_instruments:
                 'depth': 1 # [1, 5, 10, 20, 50, 100, 1000, 10000]                      
                 }
 
-    m_response = requests.get(f"{prod_base_url}{order_book_endpoint}", 
-                            params=m_order_book_params)
-
-    if m_response.status_code == 200:
-        m_current_order_book = m_response.json()
+    m_current_order_book = deribit.get(
+        f"{prod_base_url}{order_book_endpoint}",
+        params=m_order_book_params)
 
     ## Gets the current opened bid and ask data to main instrument:
     try:
@@ -318,11 +321,9 @@ for instrument in active_instruments:
                     'depth': 1 # [1, 5, 10, 20, 50, 100, 1000, 10000]                      
                     }
 
-        s_response = requests.get(f"{prod_base_url}{order_book_endpoint}", 
-                                params=s_order_book_params)
-
-        if s_response.status_code == 200:
-            s_current_order_book = s_response.json()
+        s_current_order_book = deribit.get(
+            f"{prod_base_url}{order_book_endpoint}",
+            params=s_order_book_params)
 
         try:
             s_markp = float(s_current_order_book['result']['mark_price'])
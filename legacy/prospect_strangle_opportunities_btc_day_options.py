@@ -13,9 +13,12 @@
 
 import datetime
 import time
-import requests
 import json
 from pymongo import MongoClient, DESCENDING, ASCENDING
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from deribit_client import DeribitClient
 import math
 import numpy as np
 from mpmath import mp
@@ -37,6 +40,9 @@ prod_base_url = "https://deribit.com/api/v2/public/"
 order_book_endpoint = f"get_order_book"
 index_price_endpoint = f"get_index_price"
 
+## Deribit API client (see "deribit_client.py").
+deribit = DeribitClient()
+
 ## Local DB access.
 client = MongoClient('mongodb://localhost:27017/')
 db = client['deribit_btc_options']
@@ -56,11 +62,10 @@ td_00h_unix = int(td_00h.timestamp() * 1000) # In miliseconds
 
 ### Gets the base index price.
 index_price_params = {'index_name': "btc_usd"}
-response = requests.get(f"{prod_base_url}{index_price_endpoint}", 
-                        params=index_price_params)
+data = deribit.get(f"{prod_base_url}{index_price_endpoint}", 
+                   params=index_price_params)
 
-if response.status_code == 200:
-    data = response.json()
+if data is not None:
     base_index_price = float(data['result']['index_price'])
 
 
@@ -175,11 +180,9 @@ for exp_time in expiration_time_list:
                         'depth': 1 # [1, 5, 10, 20, 50, 100, 1000, 10000]                      
                         }
 
-            c_response = requests.get(f"{prod_base_url}{order_book_endpoint}", 
-                                    params=c_order_book_params)
-
-            if c_response.status_code == 200:
-                c_current_order_book = c_response.json()
+            c_current_order_book = deribit.get(
+                f"{prod_base_url}{order_book_endpoint}",
+                params=c_order_book_params)
 
             ## Gets the current opened bid to CALL instrument:
             try:
@@ -198,11 +201,9 @@ for exp_time in expiration_time_list:
                         'depth': 1 # [1, 5, 10, 20, 50, 100, 1000, 10000]                      
                         }
 
-            p_response = requests.get(f"{prod_base_url}{order_book_endpoint}", 
-                                    params=p_order_book_params)
-
-            if p_response.status_code == 200:
-                p_current_order_book = p_response.json()
+            p_current_order_book = deribit.get(
+                f"{prod_base_url}{order_book_endpoint}",
+                params=p_order_book_params)
 
             try:
                 p_markp = float(p_current_order_book['result']['mark_price'])
@@ -11,6 +11,7 @@ import os
 r_path = '/Users/dradicchi/Documents/Projects/python_work/deribit_btc_options/'
 env_path = os.path.join(r_path, 'deribit_btc_options_env/')
 scripts_path = os.path.join(r_path, 'v1')
+archive_path = os.path.join(r_path, 'archive/') # Raw API responses.
 
 # Sets the execution base commands.
 activate_env = os.path.join(env_path, 'bin/activate')
@@ -24,11 +25,14 @@ python_exec = 'python3'
 # Sets an ordered (FIFO) list of scripts:
 scripts = [
            # Build scripts - To create and update databases.
-           'build_hist_btc_index_price_5min.py',
-           'build_hist_btc_iv_implied_volatility_5min.py',
+           'build_hist_btc_index_candles_5min.py',
+           'build_hist_btc_index_price_iv_5min.py',
+           'fill_gaps_btc_5min_series.py',
+           'build_hist_btc_dvol_volatility_index.py',
            'build_hist_btc_delivery_price_daily.py',
            'build_hist_btc_daily_avg_index_price.py',
            'build_hist_btc_hourly_avg_index_price.py',
+           'build_hist_btc_index_price_rollups.py',
            'build_hist_btc_inverse_options_offering.py',
            'build_hist_btc_options_trades_5min.py',
 
@@ -51,7 +55,8 @@ scripts = [
 # Tries to execute each script in the defined order.
 for script in scripts:
 
-    command = (f"source {activate_env} && {python_exec}"+ 
+    command = (f"source {activate_env} && "+
+               f"DERIBIT_ARCHIVE={archive_path} {python_exec}"+
                f" {os.path.join(scripts_path, script)}")
 
     try:
@@ -0,0 +1,302 @@
+###
+### Streams the BTC option trades to the trade history database (real time).
+###
+
+## NOTES:
+## A long-running ingestor: subscribes to the BTC option trade channel of the
+## Deribit's WebSocket API and writes the trades in micro-batches (every
+## '--batch-size' trades or '--flush-seconds' seconds) into
+## 'btc_trade_history_5min', with the same schema and 'dt_control' (the start
+## of the 5-minute window) as "build_hist_btc_options_trades_5min.py".
+##
+## On each (re)connection, the gap since the last stored trade (up to
+## '--max-backfill' hours) is backfilled from the history API. Trades are
+## inserted against the unique trade 'id' index, so the overlaps between the
+## stream, the backfill and the 5-minute builder are only counted as
+## duplicates. The connection is retried with exponential backoff.
+##
+## The stream doesn't write the 5-minute coverage records: the 5-minute
+## builder still closes the windows (and fills anything the stream missed).
+
+## USAGE:
+##     python stream_btc_options_trades.py
+##
+## To record the raw messages, and to test against a local WebSocket stand-in
+## that replays them (see "deribit_ws_stand_in.py"):
+##     python stream_btc_options_trades.py --record messages.jsonl.gz
+##     python stream_btc_options_trades.py --url ws://localhost:8765 \
+##         --base-url http://localhost:8080/api/v2/public/
+
+import argparse
+import asyncio
+import datetime
+import json
+import time
+import websockets
+from pymongo import MongoClient, InsertOne
+from bulk_writer import BulkWriter
+from deribit_cassette import open_cassette
+from deribit_client import DeribitClient
+from deribit_fetcher import AsyncFetcher
+from build_hist_btc_options_trades_5min import (ensure_unique_index,
+                                                endpoint_a,
+                                                fetch_span,
+                                                floor_window,
+                                                get_trade_document,
+                                                hist_base_url,
+                                                window)
+
+
+##
+## Support functions
+##
+
+def rpc(method, params, request_id):
+    """
+    Returns a JSON-RPC request message.
+    """
+    return json.dumps({"jsonrpc": "2.0",
+                       "id": request_id,
+                       "method": method,
+                       "params": params})
+
+
+class TradeStream:
+    """
+    Streams the trades of a channel into the trade collection, with
+    reconnection and backfill.
+
+    Example usage:
+    stream = TradeStream(collection, args)
+    asyncio.run(stream.run())
+    """
+
+    def __init__(self, collection, args):
+        self.args = args
+        self.writer = BulkWriter(collection,
+                                 max_ops=args.batch_size,
+                                 max_seconds=args.flush_seconds)
+        self.record_file = (open_cassette(args.record, 'at')
+                            if args.record else None)
+
+        # Resumes from the most recent stored trade.
+        last_document = collection.find_one(sort=[('unix_time', -1)])
+        self.last_ts = last_document['unix_time'] if last_document else None
+
+        # Counters.
+        self.n_streamed = 0
+        self.n_backfilled = 0
+        self.n_connections = 0
+
+
+    def add(self, trade):
+        """
+        Buffers a trade.
+        """
+        self.writer.add(InsertOne(get_trade_document(trade)))
+        if (self.last_ts is None) or (trade['timestamp'] > self.last_ts):
+            self.last_ts = trade['timestamp']
+
+
+    async def backfill(self, since_ts):
+        """
+        Fetches the trades since 'since_ts' (Unix time, in miliseconds) from
+        the history API.
+        """
+        now = datetime.datetime.now()
+        start = datetime.datetime.fromtimestamp(since_ts / 1000)
+        start = floor_window(max(start, now - datetime.timedelta(
+                                            hours=self.args.max_backfill)))
+        end = floor_window(now) + window
+
+        fetcher = AsyncFetcher(DeribitClient(pool_size=4),
+                               concurrency=4,
+                               rate=self.args.rate)
+        try:
+            fetched = await fetch_span(fetcher,
+                                       f"{self.args.base_url}{endpoint_a}",
+                                       start,
+                                       end)
+        finally:
+            fetcher.close()
+
+        if fetched is None:
+            print(f"Backfill failed: {start} - {end}.")
+            return
+        trades, _ = fetched
+        for trade in trades:
+            if trade['timestamp'] >= since_ts:
+                self.add(trade)
+                self.n_backfilled += 1
+        print(f"Backfilled {start} - {end}: {len(trades)} trades.")
+
+
+    async def session(self):
+        """
+        Runs one WebSocket connection until it is closed.
+        """
+        async with websockets.connect(self.args.url,
+                                      ping_interval=20,
+                                      max_size=2 ** 24) as ws:
+            self.n_connections += 1
+            gap_ts = self.last_ts
+            backfill_task = None
+
+            await ws.send(rpc("public/set_heartbeat", {"interval": 30}, 1))
+            await ws.send(rpc("public/subscribe",
+                              {"channels": [self.args.channel]}, 2))
+
+            try:
+                while True:
+                    try:
+                        message = await asyncio.wait_for(
+                                            ws.recv(),
+                                            timeout=self.args.flush_seconds)
+                    except asyncio.TimeoutError:
+                        # Flushes the micro-batch of a quiet period.
+                        self.writer.flush()
+                        continue
+
+                    msg = json.loads(message)
+
+                    # Answers the heartbeats.
+                    if msg.get('method') == "heartbeat":
+                        if msg['params'].get('type') == "test_request":
+                            await ws.send(rpc("public/test", {}, 3))
+
+                    # Backfills the gap once subscribed.
+                    elif msg.get('id') == 2:
+                        if 'error' in msg:
+                            raise RuntimeError(f"Subscription error: "
+                                               f"{msg['error']}")
+                        print(f"Subscribed: {msg.get('result')}")
+                        if gap_ts is not None:
+                            backfill_task = asyncio.ensure_future(
+                                                    self.backfill(gap_ts))
+
+                    # Trades.
+                    elif msg.get('method') == "subscription":
+                        if self.record_file:
+                            self.record_file.write(message + "\n")
+                        for trade in msg['params']['data']:
+                            self.add(trade)
+                            self.n_streamed += 1
+            finally:
+                if backfill_task is not None:
+                    await backfill_task
+                self.writer.flush()
+
+
+    async def run(self):
+        """
+        Keeps the stream connected, reconnecting with exponential backoff.
+        """
+        delay = 1
+        n_reconnects = 0
+        while True:
+            start = time.monotonic()
+            try:
+                await self.session()
+            except websockets.ConnectionClosedOK:
+                print("Connection closed by the server.")
+            except Exception as e:
+                # Any failure of a session (connection, parsing, database) 
+                # only ends that session. 'KeyboardInterrupt' and 
+                # 'asyncio.CancelledError' aren't caught and stop the stream.
+                print(f"Connection error ({type(e).__name__}): {e}")
+
+            # Resets the backoff after a long session.
+            if time.monotonic() - start > 60:
+                delay = 1
+            n_reconnects += 1
+            if (self.args.max_reconnects is not None and
+                n_reconnects > self.args.max_reconnects):
+                break
+
+            print(self.report())
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+
+    def close(self):
+        """
+        Flushes the buffered trades and closes the record file.
+        """
+        self.writer.close()
+        if self.record_file:
+            self.record_file.close()
+
+
+    def report(self):
+        """
+        Returns a summary of the stream.
+        """
+        return (f"Connections: {self.n_connections} | "
+                f"streamed: {self.n_streamed} | "
+                f"backfilled: {self.n_backfilled}\n{self.writer.report()}")
+
+
+##
+## Main script
+##
+
+# API definitions.
+ws_url = "wss://www.deribit.com/ws/api/v2"
+trades_channel = "trades.option.BTC.100ms"
+
+
+def main():
+    """
+    Streams the trades until interrupted.
+    """
+    parser = argparse.ArgumentParser(
+                description="Streams the BTC option trades.")
+    parser.add_argument("--url",
+                        default=ws_url,
+                        help="WebSocket API URL (ex.: a local stand-in)")
+    parser.add_argument("--base-url",
+                        default=hist_base_url,
+                        help="history API base URL to the backfills")
+    parser.add_argument("--channel", default=trades_channel)
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=500,
+                        help="trades per micro-batch")
+    parser.add_argument("--flush-seconds",
+                        type=float,
+                        default=2.0,
+                        help="maximum age of a micro-batch")
+    parser.add_argument("--max-backfill",
+                        type=float,
+                        default=2.0,
+                        help="maximum gap to backfill (hours)")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=10,
+                        help="maximum backfill requests per second")
+    parser.add_argument("--max-reconnects",
+                        type=int,
+                        help="stops after N reconnections (default: never)")
+    parser.add_argument("--record",
+                        help="appends the raw trade messages to a file")
+    args = parser.parse_args()
+
+    # DB access.
+    client = MongoClient('mongodb://localhost:27017/')
+    db = client['deribit_btc_options']
+    collection = db['btc_trade_history_5min']
+    ensure_unique_index(collection, 'id')
+
+    stream = TradeStream(collection, args)
+    try:
+        asyncio.run(stream.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream.close()
+        print(stream.report())
+        print("The job is done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1064 @@
+###
+### Z solvers (per trade and vectorized) shared by the z calculation scripts.
+###
+
+## NOTES:
+## Solves y(z) = (1 + x^z)^(1/z) - 1 for whole arrays of (x, y) at once. The
+## equation is rewritten in the log domain as:
+##
+##     h(z) = ln(1 + x^z) / z - ln(1 + y) = 0
+##
+## where ln(1 + x^z) is evaluated as a stable softplus of z*ln(x). For x > 0
+## the (1 + x^z)^(1/z) term is a z-norm and decreases monotonically with z, so
+## the root is unique and can be bracketed. Each element takes a Halley step
+## with the analytic derivatives and falls back to a (geometric) bisection
+## step whenever the Halley step leaves the current bracket.
+##
+## The per trade (scipy) approaches also live here, so that every z solver can
+## be selected by name through the 'Z_METHODS' registry.
+##
+## A precomputed lookup surface of ln(z) over a log-spaced (x, w) grid, where
+## w = y - max(0, x - 1) is the option time value, gives an interpolated z
+## that only needs one or two Halley polish steps. The surface is built by
+## "build_z_lookup_surface.py" and memory-mapped on load.
+##
+## Repeated inputs (same strike, price tick and index price) can be served by
+## a bounded LRU cache of z keyed on (x, y) quantized to the solver tolerance.
+
+import json # lookup surface
+import math # bisect
+import os # lookup surface
+from collections import OrderedDict # z cache
+import numpy as np # dual annealing and batch approach
+from scipy.optimize import fsolve # fsolve
+from scipy.optimize import brentq # brentq
+from scipy.optimize import bisect # bisect
+from scipy.optimize import dual_annealing # dual annealing
+
+
+## Per-element convergence status codes.
+Z_CONVERGED = 0     # The root was found within the tolerance.
+Z_MAX_ITER = 1      # The iteration limit was reached.
+Z_NO_ROOT = 2       # y is out of the (max(0, x - 1), x] root range.
+Z_INVALID = 3       # x or y is not a finite (positive) number.
+
+
+def add_stats(stats, key, n):
+    """
+    Adds 'n' to a solver counter, if a 'stats' dict was given.
+    """
+    if stats is not None:
+        stats[key] = stats.get(key, 0) + n
+
+
+##
+## Per trade approaches
+##
+
+def calculate_z_fsolve(x, y, z_initial=1.0, tolerance=1e-10, stats=None):
+    """
+    FSOLVE APPROACH
+
+    Calculates the value of z for the given x and y based on the equation:
+        y(z) = (1 + x^z)^(1/z) - 1
+
+    Parameters:
+    x (float): the value of x in the equation
+    y (float): the target value of y(z)
+    z_initial (float): an initial guess for the value of z
+    tolerance: a value to accept an approximation of zero
+    stats (dict): counts the function 'evaluations' (optional)
+
+    Returns:
+    float: the calculated value of z
+
+    Example usage:
+    x = 1
+    y = 3
+    z = calculate_z_fsolve(x, y)
+    """
+
+    # Defines the object function to find its root.
+    #
+    # Y = option price
+    # X = BTC price
+    # S = Strike price
+    #
+    # y = Y/S
+    # x = X/S
+    #
+    # y(z) = (1 + x^z)^(1/z) - 1
+    #
+    # z = k1/t + k2E1 + k3E2 + k4x + k5 + error
+    #
+    # t = time to expiration (days)
+    #
+    # E1 = E1 is the slope of least squares line fitted to logarithms of the 
+    # monthly mean price for common stock for the previus eleven months.
+    #
+    # E2 = E2 is the standard deviation of natural logarithms of the monthly 
+    # mean price for the commos stock for the previous eleven months.
+    def func(z, x, y):
+        return ((1 + x**z)**(1/z)) - 1 - y
+
+    # Uses 'fsolve' with the generalized Newton-Raphson method and the 
+    # Levenberg-Marquardt algorithm.
+    root, info, ier, msg = fsolve(func,
+                                  z_initial,
+                                  args=(x, y), 
+                                  xtol=tolerance, 
+                                  full_output=True)
+    add_stats(stats, 'evaluations', info['nfev'])
+    
+    # Check if the solution has converged (ier = 1)
+    if ier == 1:
+        return root[0]
+    else:
+        return None
+
+
+def calculate_z_brentq(x, y, z_lower=None, z_upper=None, stats=None):
+    """
+    BRENTQ APPROACH
+
+    Calculates the value of z for the given x and y based on the equation:
+        y(z) = (1 + x^z)^(1/z) - 1
+
+    Parameters:
+    x (float): the value of x in the equation
+    y (float): the target value of y(z)
+    z_lower (float): a lower bound to try as the interval (optional)
+    z_upper (float): an upper bound to try as the interval (optional)
+    stats (dict): counts the function 'evaluations' (optional)
+
+    Returns:
+    float: the calculated value of z
+
+    Example usage:
+    x = 1
+    y = 3
+    z = calculate_z_brentq(x, y)
+    """
+
+    # Defines the object function to find its root.
+    #
+    # Y = option price
+    # X = BTC price
+    # S = Strike price
+    #
+    # y = Y/S
+    # x = X/S
+    #
+    # y(z) = (1 + x^z)^(1/z) - 1
+    #
+    # z = k1/t + k2E1 + k3E2 + k4x + k5 + error
+    #
+    # t = time to expiration (days)
+    #
+    # E1 = E1 is the slope of least squares line fitted to logarithms of the 
+    # monthly mean price for common stock for the previus eleven months.
+    #
+    # E2 = E2 is the standard deviation of natural logarithms of the monthly 
+    # mean price for the commos stock for the previous eleven months.
+    def func(z, x, y):
+        add_stats(stats, 'evaluations', 1)
+        return ((1 + x**z)**(1/z)) - 1 - y
+
+
+    def find_interval(x, y, z_init=1.0, step=1.0, max_limit=1000000.0):
+        """
+        Finds a valid interval to use Brent's method.
+        """
+        z1 = z_init
+        z2 = z1 + step
+
+        while z2 <= max_limit:
+            # Change of sign indicates root in the interval.
+            if func(z1, x, y) * func(z2, x, y) < 0:
+                return z1, z2
+
+            z1 = z2
+            z2 += step
+
+        # returns 'None' if it does not find a valid interval.
+        z1 = None
+        z2 = None
+        return z1, z2
+
+
+    # Uses Brent's method. It is more flexible and works well for finding roots 
+    # of non-linear functions even if the derivative is not available.
+    try:
+        # Tries the given interval (ex.: around a neighbouring solution) 
+        # before to scan for one.
+        if ((z_lower is not None) and (z_upper is not None) and 
+            (func(z_lower, x, y) * func(z_upper, x, y) < 0)):
+            z1, z2 = z_lower, z_upper
+        else:
+            z1, z2 = find_interval(x, y)
+        return brentq(func, z1, z2, args=(x, y), maxiter=10000)
+    except:
+        return None
+
+
+def calculate_z_bisect(x, y, z_lower=1, z_upper=1000, tolerance=1e-10):
+    """
+    BISECT APPROACH
+
+    Calculates the value of z for the given x and y based on the equation:
+        y(z) = (1 + x^z)^(1/z) - 1
+
+    Parameters:
+    x (float): the value of x in the equation
+    y (float): the target value of y(z)
+    z_initial (float): an initial guess for the value of z
+
+    Returns:
+    float: the calculated value of z
+
+    Example usage:
+    x = 1
+    y = 3
+    z = calculate_z_bisect(x, y)
+    """
+
+    # Defines the object function to find its root.
+    #
+    # Y = option price
+    # X = BTC price
+    # S = Strike price
+    #
+    # y = Y/S
+    # x = X/S
+    #
+    # y(z) = (1 + x^z)^(1/z) - 1
+    #
+    # z = k1/t + k2E1 + k3E2 + k4x + k5 + error
+    #
+    # t = time to expiration (days)
+    #
+    # E1 = E1 is the slope of least squares line fitted to logarithms of the 
+    # monthly mean price for common stock for the previus eleven months.
+    #
+    # E2 = E2 is the standard deviation of natural logarithms of the monthly 
+    # mean price for the commos stock for the previous eleven months.
+    def func(z, x, y):
+        # Use logarithm to avoid errors due to calculations with very large 
+        # numbers.
+        try:
+            log_term = z * math.log(x)
+            exp_term = math.exp(log_term)
+            log_expression = math.log(1 + exp_term)
+            result = math.exp(log_expression / z) - 1 - y
+            return result
+        except:
+            # If there is a big number.
+            return float('inf') 
+
+    # Tests if there is a signal change between z_lower and z_upper. If there is
+    # no signal change, expands the interval.
+    if func(z_lower, x, y) * func(z_upper, x, y) > 0:
+        
+        # Expands the interval.
+        while func(z_lower, x, y) * func(z_upper, x, y) > 0 and z_lower > 1:
+            z_lower -= 10  # Decrements it until to find a signal change.
+            if z_lower <= 1:
+                z_lower = 1
+                break
+
+        # Returns 'None' if a valid interval is not found.
+        if func(z_lower, x, y) * func(z_upper, x, y) > 0:
+            return None
+
+    # Applies the bisection method to the valid interval.
+    root = bisect(func, z_lower, z_upper, args=(x, y), xtol=tolerance)
+    return root
+
+
+def calculate_z_d_annealing(x, y):
+    """
+    DUAL ANNEALING APPROACH
+
+    Calculates the value of z for the given x and y based on the equation:
+        y(z) = (1 + x^z)^(1/z) - 1
+
+    Parameters:
+    x (float): the value of x in the equation
+    y (float): the target value of y(z)
+    z_initial (float): an initial guess for the value of z
+    tolerance: a value to accept an approximation of zero
+
+    Returns:
+    float: the calculated value of z
+
+    Example usage:
+    x = 1
+    y = 3
+    z = calculate_z_d_annealing(x, y)
+    """
+
+    # Defines the object function to find its root.
+    #
+    # Y = option price
+    # X = BTC price
+    # S = Strike price
+    #
+    # y = Y/S
+    # x = X/S
+    #
+    # y(z) = (1 + x^z)^(1/z) - 1
+    #
+    # z = k1/t + k2E1 + k3E2 + k4x + k5 + error
+    #
+    # t = time to expiration (days)
+    #
+    # E1 = E1 is the slope of least squares line fitted to logarithms of the 
+    # monthly mean price for common stock for the previus eleven months.
+    #
+    # E2 = E2 is the standard deviation of natural logarithms of the monthly 
+    # mean price for the commos stock for the previous eleven months.
+    def func(z, x, y):
+        """
+        The object function to find the 'z' value.
+        """
+        try:
+            return (((1 + x**z)**(1/z)) - 1 - y) ** 2
+        except:
+            print(f"Overflow encountered with x={x}, z={z}")
+            return np.inf
+
+    # Uses 'dual_annealing' method.
+    try:
+        bounds = [(1, 1000)]
+        result = dual_annealing(func, bounds, args=(x, y))
+        return result.x[0] if result.success else None
+    except:
+        return None
+
+
+def funz(z, x, y):
+    """
+    Returns the computed 'zero' to given x, y and z values.
+    """
+    if z:
+        return ((1 + x**z)**(1/z)) - 1 - y
+    else:
+        return None
+
+
+##
+## Batch approach
+##
+
+def softplus(t):
+    """
+    Returns ln(1 + exp(t)) without overflowing to large 't' values.
+    """
+    return np.maximum(t, 0.0) + np.log1p(np.exp(-np.abs(t)))
+
+
+def log_h(z, log_x, log_1y):
+    """
+    Returns the log domain objective h(z) = ln(1 + x^z) / z - ln(1 + y).
+    """
+    return softplus(z * log_x) / z - log_1y
+
+
+def log_h_derivatives(z, log_x, log_1y):
+    """
+    Returns h(z) and its analytic first and second derivatives.
+    """
+    t = z * log_x
+    sp = softplus(t)
+    sig = np.exp(t - sp)
+    num = log_x * sig * z - sp
+    h = sp / z - log_1y
+    h1 = num / z**2
+    h2 = (log_x**2 * sig * (1 - sig)) / z - 2 * num / z**3
+    return h, h1, h2
+
+
+def halley_step(h, h1, h2):
+    """
+    Returns the Halley step (or the Newton step, if the Halley correction is 
+    degenerated) to the given h(z) and derivatives.
+    """
+    newton = h / h1
+    denom = 1 - 0.5 * newton * h2 / h1
+    return np.where(np.abs(denom) > 0.1, newton / denom, newton)
+
+
+def funz_batch(z, x, y):
+    """
+    Returns the computed 'zero' to given x, y and z arrays, as the 'funz'
+    function does for a single trade. Elements with a NaN 'z' return NaN.
+    """
+    z = np.asarray(z, dtype=float)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    with np.errstate(all='ignore'):
+        return np.exp(softplus(z * np.log(x)) / z) - 1 - y
+
+
+def solve_z_batch(x,
+                  y,
+                  z_init=None,
+                  z_lower=None,
+                  z_upper=None,
+                  tolerance=1e-10,
+                  max_iter=100,
+                  z_max=1000000.0):
+    """
+    BATCH NEWTON/HALLEY APPROACH
+
+    Calculates the value of z for each given (x, y) pair based on the equation:
+        y(z) = (1 + x^z)^(1/z) - 1
+
+    Parameters:
+    x (array-like): the values of x in the equation
+    y (array-like): the target values of y(z)
+    z_init (float or array-like): an initial guess for z (optional)
+    z_lower (float or array-like): a lower bound for the bracket (optional)
+    z_upper (float or array-like): an upper bound for the bracket (optional)
+    tolerance: the relative step size to accept the approximation
+    max_iter: the maximum number of iterations
+    z_max: the upper limit to search the bracket (as the brentq approach)
+
+    Returns:
+    tuple: the z values (NaN if not solved), the residuals of the original
+    equation, the status codes (Z_CONVERGED, Z_MAX_ITER, Z_NO_ROOT or
+    Z_INVALID) and the number of iterations for each element.
+
+    Example usage:
+    x = np.array([1.02, 0.98])
+    y = np.array([0.05, 0.01])
+    z, fz, status, n_iter = solve_z_batch(x, y)
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    y = np.atleast_1d(np.asarray(y, dtype=float))
+    n = x.shape[0]
+
+    z = np.full(n, np.nan)
+    status = np.full(n, Z_INVALID, dtype=np.int8)
+    n_iter = np.zeros(n, dtype=np.int32)
+
+    with np.errstate(all='ignore'):
+
+        # Discards non-finite and non-positive inputs.
+        valid = np.isfinite(x) & np.isfinite(y) & (x > 0) & (y >= 0)
+
+        log_x = np.where(valid, np.log(x), 0.0)
+        log_1y = np.where(valid, np.log1p(y), 0.0)
+
+        # As z is in 1 <= z < infinite, y(z) goes from x (at z = 1) down to
+        # max(0, x - 1) (as z -> infinite). Any y out of it has no root.
+        has_root = valid & (y <= x) & (log_1y > np.maximum(log_x, 0.0))
+        status[valid & ~has_root] = Z_NO_ROOT
+
+        # Initial bracket [lo, hi], with h(lo) >= 0 and h(hi) < 0.
+        lo = np.ones(n)
+        hi = np.full(n, 2.0)
+        if z_lower is not None:
+            lo = np.maximum(np.broadcast_to(z_lower, (n,)).astype(float), 1.0)
+            lo = np.where(np.isfinite(lo), lo, 1.0)
+            lo = np.where(log_h(lo, log_x, log_1y) >= 0, lo, 1.0)
+        if z_upper is not None:
+            hi = np.broadcast_to(z_upper, (n,)).astype(float)
+            hi = np.where(np.isfinite(hi) & (hi > lo), hi, 2.0 * lo)
+        hi = np.maximum(hi, lo * 2.0)
+
+        # Expands the upper bound until a signal change is found.
+        expand = np.nonzero(has_root & (log_h(hi, log_x, log_1y) >= 0))[0]
+        while expand.size:
+            lo[expand] = hi[expand]
+            hi[expand] = np.minimum(hi[expand] * 4.0, z_max)
+            keep = ((log_h(hi[expand], log_x[expand], log_1y[expand]) >= 0) & 
+                    (lo[expand] < z_max))
+            expand = expand[keep]
+        has_root &= log_h(hi, log_x, log_1y) < 0
+        status[valid & ~has_root & (status == Z_INVALID)] = Z_NO_ROOT
+
+        # Initial guess (inside the bracket).
+        if z_init is None:
+            zc = np.sqrt(lo * hi)
+        else:
+            zc = np.broadcast_to(z_init, (n,)).astype(float)
+            inside = np.isfinite(zc) & (zc > lo) & (zc < hi)
+            zc = np.where(inside, zc, np.sqrt(lo * hi))
+
+        active = has_root.copy()
+        status[active] = Z_MAX_ITER
+
+        for _ in range(max_iter):
+
+            if not active.any():
+                break
+
+            idx = np.nonzero(active)[0]
+            zi = zc[idx]
+
+            # h(z) and its analytic derivatives.
+            h, h1, h2 = log_h_derivatives(zi, log_x[idx], log_1y[idx])
+
+            # Shrinks the bracket with the signal of h.
+            pos = h >= 0
+            lo[idx] = np.where(pos, zi, lo[idx])
+            hi[idx] = np.where(pos, hi[idx], zi)
+
+            # Halley step (Newton step if the correction is degenerated).
+            z_new = zi - halley_step(h, h1, h2)
+
+            # Geometric bisection when the step leaves the bracket.
+            out = ~np.isfinite(z_new) | (z_new <= lo[idx]) | (z_new >= hi[idx])
+            z_new = np.where(out, np.sqrt(lo[idx] * hi[idx]), z_new)
+            z_new = np.where(h == 0, zi, z_new)
+
+            zc[idx] = z_new
+            n_iter[idx] += 1
+
+            # Convergence test (relative step and bracket width).
+            done = ((np.abs(z_new - zi) <= tolerance * np.maximum(1.0, zi)) |
+                    ((hi[idx] - lo[idx]) <= tolerance * np.maximum(1.0, zi)))
+            status[idx[done]] = Z_CONVERGED
+            active[idx[done]] = False
+
+        z = np.where(status == Z_CONVERGED, zc, np.nan)
+        fz = funz_batch(z, x, y)
+
+    return z, fz, status, n_iter
+
+
+##
+## Lookup surface approach
+##
+
+# Default location of the lookup surface files (table and grid metadata).
+Z_SURFACE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                              'z_lookup_surface.npy')
+
+
+def build_z_surface(path=Z_SURFACE_PATH,
+                    x_range=(0.5, 2.0),
+                    w_range=(1e-10, 2.0),
+                    nx=1024,
+                    ny=2048):
+    """
+    Builds the ln(z) lookup surface over a log-spaced (x, w) grid and stores
+    it to disk, where w = y - max(0, x - 1) is the time value. As z grows 
+    without limit when w goes to zero, this axis keeps ln(z) smooth to the 
+    interpolation. Grid nodes with y > x (z < 1) are stored as z = 1.
+
+    Returns the number of grid nodes with a solved z.
+    """
+    log_x = np.linspace(math.log(x_range[0]), math.log(x_range[1]), nx)
+    log_w = np.linspace(math.log(w_range[0]), math.log(w_range[1]), ny)
+    grid_x, grid_w = np.meshgrid(np.exp(log_x), np.exp(log_w), indexing='ij')
+    grid_y = grid_w + np.maximum(0.0, grid_x - 1)
+
+    z, _, status, _ = solve_z_batch(grid_x.ravel(), 
+                                    grid_y.ravel(), 
+                                    z_max=1e300)
+    with np.errstate(all='ignore'):
+        log_z = np.log(np.where(status == Z_CONVERGED, z, 1.0))
+
+    np.save(path, log_z.reshape(nx, ny))
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump({
+                   'log_x_min': float(log_x[0]),
+                   'log_x_max': float(log_x[-1]),
+                   'log_w_min': float(log_w[0]),
+                   'log_w_max': float(log_w[-1]),
+                  }, f)
+
+    return int(np.sum(status == Z_CONVERGED))
+
+
+class ZSurface:
+    """
+    A memory-mapped ln(z) lookup surface with interpolation and polish steps.
+
+    Example usage:
+    surface = ZSurface()
+    z = surface.solve_one(1.02, 0.05)
+    z, fz, status, n_iter = surface.solve(x_array, y_array)
+    """
+
+    def __init__(self, path=Z_SURFACE_PATH):
+        self.log_z = np.load(path, mmap_mode='r')
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            meta = json.load(f)
+
+        self.nx, self.ny = self.log_z.shape
+        self.log_x_min = meta['log_x_min']
+        self.log_w_min = meta['log_w_min']
+        self.dx = (meta['log_x_max'] - self.log_x_min) / (self.nx - 1)
+        self.dw = (meta['log_w_max'] - self.log_w_min) / (self.ny - 1)
+
+
+    def lookup(self, x, y):
+        """
+        Returns the bilinear interpolated z to arrays of (x, y), or NaN when a
+        point lies off the grid.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        with np.errstate(all='ignore'):
+            u = (np.log(x) - self.log_x_min) / self.dx
+            v = (np.log(y - np.maximum(0.0, x - 1)) - self.log_w_min) / self.dw
+
+        on_grid = ((u >= 0) & (u <= self.nx - 1) & 
+                   (v >= 0) & (v <= self.ny - 1))
+        u = np.where(on_grid, u, 0.0)
+        v = np.where(on_grid, v, 0.0)
+
+        i = np.minimum(u.astype(np.intp), self.nx - 2)
+        j = np.minimum(v.astype(np.intp), self.ny - 2)
+        fu = u - i
+        fv = v - j
+
+        log_z = ((1 - fu) * (1 - fv) * self.log_z[i, j] + 
+                 fu * (1 - fv) * self.log_z[i + 1, j] + 
+                 (1 - fu) * fv * self.log_z[i, j + 1] + 
+                 fu * fv * self.log_z[i + 1, j + 1])
+
+        return np.where(on_grid, np.exp(log_z), np.nan)
+
+
+    def solve(self, x, y, tolerance=1e-10, polish_steps=2):
+        """
+        Solves arrays of (x, y) with the interpolated z and 'polish_steps' 
+        Halley steps. Points off the grid, or not polished within the 
+        tolerance, fall back to the full batch solver.
+
+        Returns the same tuple as 'solve_z_batch'.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+
+        z = self.lookup(x, y)
+        n_iter = np.zeros(len(x), dtype=np.int32)
+        done = np.zeros(len(x), dtype=bool)
+
+        # Polish steps (Halley). The last evaluation only checks (and applies)
+        # the remaining step.
+        with np.errstate(all='ignore'):
+            log_x = np.log(x)
+            log_1y = np.log1p(y)
+            for k in range(polish_steps + 1):
+                active = ~done & np.isfinite(z)
+                if not active.any():
+                    break
+                step = halley_step(*log_h_derivatives(z[active], 
+                                                      log_x[active], 
+                                                      log_1y[active]))
+                z_new = z[active] - step
+                n_iter[active] += 1
+                conv = (np.abs(step) <= tolerance * np.maximum(1.0, z_new))
+                if k < polish_steps:
+                    z[active] = z_new
+                else:
+                    z[active] = np.where(conv, z_new, z[active])
+                done[active] = conv & (z_new >= 1)
+
+        status = np.where(done, Z_CONVERGED, Z_MAX_ITER).astype(np.int8)
+
+        # Falls back to the full solver.
+        if not done.all():
+            idx = np.nonzero(~done)[0]
+            z_fb, _, status_fb, n_iter_fb = solve_z_batch(x[idx], 
+                                                          y[idx], 
+                                                          z_init=z[idx], 
+                                                          tolerance=tolerance)
+            z[idx] = z_fb
+            status[idx] = status_fb
+            n_iter[idx] += n_iter_fb
+
+        z = np.where(status == Z_CONVERGED, z, np.nan)
+        return z, funz_batch(z, x, y), status, n_iter
+
+
+    def solve_one(self, x, y, tolerance=1e-10, polish_steps=2):
+        """
+        Solves a single (x, y) pair with plain floats, to be used in live 
+        pricing loops. Returns 'None' if the pair has no root.
+        """
+        try:
+            u = (math.log(x) - self.log_x_min) / self.dx
+            v = (math.log(y - max(0.0, x - 1)) - self.log_w_min) / self.dw
+        except ValueError:
+            return None
+
+        z = None
+        if 0 <= u <= self.nx - 1 and 0 <= v <= self.ny - 1:
+
+            # Bilinear interpolation of ln(z).
+            i = min(int(u), self.nx - 2)
+            j = min(int(v), self.ny - 2)
+            fu = u - i
+            fv = v - j
+            log_z = ((1 - fu) * (1 - fv) * self.log_z.item(i, j) + 
+                     fu * (1 - fv) * self.log_z.item(i + 1, j) + 
+                     (1 - fu) * fv * self.log_z.item(i, j + 1) + 
+                     fu * fv * self.log_z.item(i + 1, j + 1))
+
+            if not math.isnan(log_z):
+
+                # Polish steps (Halley) on h(z). The last evaluation only 
+                # checks (and applies) the remaining step.
+                z = math.exp(log_z)
+                a = math.log(x)
+                c = math.log1p(y)
+                for k in range(polish_steps + 1):
+                    t = z * a
+                    sp = max(t, 0.0) + math.log1p(math.exp(-abs(t)))
+                    sig = math.exp(t - sp)
+                    num = a * sig * z - sp
+                    h = sp / z - c
+                    h1 = num / z**2
+                    h2 = (a**2 * sig * (1 - sig)) / z - 2 * num / z**3
+                    if h1 == 0:
+                        z = None
+                        break
+                    newton = h / h1
+                    denom = 1 - 0.5 * newton * h2 / h1
+                    step = newton / denom if abs(denom) > 0.1 else newton
+                    z -= step
+                    if abs(step) <= tolerance * max(1.0, z):
+                        break
+                else:
+                    z = None
+
+                if z is not None and z < 1:
+                    z = None
+
+        # Falls back to the full solver.
+        if z is None:
+            z_fb, _, status_fb, _ = solve_z_batch([x], [y], 
+                                                  tolerance=tolerance)
+            if status_fb[0] == Z_CONVERGED:
+                z = float(z_fb[0])
+
+        return z
+
+
+##
+## Z cache
+##
+
+class ZCache:
+    """
+    A bounded LRU cache of z values keyed on (x, y) quantized to the solver
+    tolerance (as significant digits). Failed solves are cached as NaN.
+
+    Example usage:
+    cache = ZCache(max_size=100000)
+    z = cache.get_or_solve(1.02, 0.05, lambda x, y: surface.solve_one(x, y))
+    solve = cache.wrap(Z_METHODS['newton'])
+    z = solve(x_array, y_array)
+    print(cache.report())
+    """
+
+    def __init__(self, max_size=1000000, tolerance=1e-10):
+        self.max_size = max_size
+        self.digits = max(1, int(round(-math.log10(tolerance))))
+        self.items = OrderedDict()
+
+        # Counters.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def key(self, x, y):
+        """
+        Returns the quantized (x, y) key.
+        """
+        return (float(f"{x:.{self.digits}g}"), float(f"{y:.{self.digits}g}"))
+
+
+    def get(self, key):
+        """
+        Returns the cached z to a key (or 'None'), counting hits and misses.
+        """
+        z = self.items.get(key)
+        if z is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.items.move_to_end(key)
+        return z
+
+
+    def put(self, key, z):
+        """
+        Stores z to a key, evicting the least recently used items.
+        """
+        self.items[key] = z
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+
+    def get_or_solve(self, x, y, solve):
+        """
+        Returns the cached z to a single (x, y) pair, or solves and caches it
+        with 'solve(x, y)' (which returns z or 'None').
+        """
+        key = self.key(x, y)
+        z = self.get(key)
+        if z is None:
+            z = solve(x, y)
+            self.put(key, math.nan if z is None else z)
+        return None if (z is None or math.isnan(z)) else z
+
+
+    def wrap(self, calculate_z_batch):
+        """
+        Wraps a registry approach, so that only the (distinct) not cached 
+        pairs of each call are solved.
+        """
+        def calculate_z_cached(x, y, groups=None, stats=None, seeds=None):
+            keys = [self.key(x_i, y_i) for x_i, y_i in zip(x, y)]
+            z = np.full(len(keys), np.nan)
+
+            # Serves the cached pairs and the repeated ones in this call.
+            first = {}
+            for i, key in enumerate(keys):
+                if key in first:
+                    self.hits += 1
+                    continue
+                z_i = self.get(key)
+                if z_i is None:
+                    first[key] = i
+                else:
+                    z[i] = z_i
+
+            # Solves the missing pairs at once.
+            if first:
+                idx = list(first.values())
+                if groups is not None:
+                    groups = [groups[i] for i in idx]
+                z_new = calculate_z_batch(np.asarray(x)[idx], 
+                                          np.asarray(y)[idx], 
+                                          groups=groups, 
+                                          stats=stats, 
+                                          seeds=seeds)
+                solved = {}
+                for i, z_i in zip(idx, z_new):
+                    solved[keys[i]] = float(z_i)
+                    self.put(keys[i], float(z_i))
+
+                for i, key in enumerate(keys):
+                    if key in solved:
+                        z[i] = solved[key]
+
+            return z
+
+        return calculate_z_cached
+
+
+    def report(self):
+        """
+        Returns a summary of the cache use.
+        """
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0
+        return (f"z cache: {self.hits} hits | {self.misses} misses | " + 
+                f"hit rate: {hit_rate:.2%} | size: {len(self.items)} | " + 
+                f"evictions: {self.evictions}")
+
+
+##
+## Solver registry
+##
+
+def per_trade(calculate_z):
+    """
+    Wraps a per trade approach to solve arrays of (x, y), returning NaN to the
+    trades without a solution.
+    """
+    def calculate_z_batch(x, y, groups=None, stats=None, seeds=None):
+        z = np.full(len(x), np.nan)
+        for i in range(len(x)):
+            z_i = calculate_z(float(x[i]), float(y[i]))
+            if z_i:
+                z[i] = z_i
+        return z
+
+    return calculate_z_batch
+
+
+def calculate_z_fsolve_batch(x, y, groups=None, stats=None, seeds=None):
+    """
+    Solves arrays of (x, y) with the fsolve approach, using the previous 
+    solution as the initial guess to the next trade. If 'groups' (ex.: the 
+    instrument names) are given, the guess is the previous solution of the 
+    same group. The 'seeds' dict keeps the guesses between calls.
+    """
+    # An initial guess for fsolve. Note: z is in 1 <= z < infinite interval.
+    seeds = {} if seeds is None else seeds
+    z = np.full(len(x), np.nan)
+
+    for i in range(len(x)):
+        key = groups[i] if groups is not None else None
+        z_init = seeds.get(key, 1.0)
+        z_i = calculate_z_fsolve(float(x[i]), float(y[i]), z_init, stats=stats)
+        # Tries to calculate 'z' again with 'z_init = 1.0'.
+        if (not z_i) and (z_init != 1.0):
+            z_init = 1.0
+            z_i = calculate_z_fsolve(float(x[i]), 
+                                     float(y[i]), 
+                                     z_init, 
+                                     stats=stats)
+        if z_i:
+            z[i] = z_i
+            seeds[key] = z_i
+
+    return z
+
+
+def calculate_z_brentq_batch(x, y, groups=None, stats=None, seeds=None):
+    """
+    Solves arrays of (x, y) with the brentq approach. If 'groups' are given,
+    it first tries an interval around the previous solution of the same group
+    (kept between calls in 'seeds') instead of scanning for one.
+    """
+    z_last = {} if seeds is None else seeds
+    z = np.full(len(x), np.nan)
+
+    for i in range(len(x)):
+        z_lower = z_upper = None
+        if groups is not None and groups[i] in z_last:
+            z_lower = max(1.0, z_last[groups[i]] / continuation_factor)
+            z_upper = z_last[groups[i]] * continuation_factor
+        z_i = calculate_z_brentq(float(x[i]), 
+                                 float(y[i]), 
+                                 z_lower, 
+                                 z_upper, 
+                                 stats=stats)
+        if z_i:
+            z[i] = z_i
+            if groups is not None:
+                z_last[groups[i]] = z_i
+
+    return z
+
+
+def calculate_z_newton_batch(x, y, groups=None, stats=None, seeds=None):
+    """
+    Solves arrays of (x, y) with the batch newton/halley approach. If 
+    'groups' are given, the trades are solved in 'continuation_stride' 
+    vectorized waves (by their position in the group), so each trade is 
+    seeded (initial guess and bracket) from the previous trade of its group,
+    except the first one of each wave cycle. The first trade of a group is 
+    seeded from the last solution of the previous call (kept in 'seeds').
+    """
+    if groups is None:
+        z, _, _, n_iter = solve_z_batch(x, y)
+        add_stats(stats, 'evaluations', int(np.sum(n_iter)))
+        return z
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    seeds = {} if seeds is None else seeds
+    n = len(x)
+
+    # Position of each trade in its group and its previous trade.
+    position = np.zeros(n, dtype=np.intp)
+    previous = np.full(n, -1, dtype=np.intp)
+    last = {}
+    for i, group in enumerate(groups):
+        if group in last:
+            previous[i] = last[group]
+            position[i] = position[last[group]] + 1
+        last[group] = i
+
+    z = np.full(n, np.nan)
+    for wave in range(continuation_stride):
+        idx = np.nonzero(position % continuation_stride == wave)[0]
+        if not idx.size:
+            continue
+        if wave > 0:
+            z_prev = z[previous[idx]]
+        else:
+            z_prev = np.array([seeds.get(groups[i], np.nan) 
+                               if position[i] == 0 else np.nan 
+                               for i in idx])
+        z[idx], _, _, n_iter = solve_z_batch(
+                                    x[idx], 
+                                    y[idx], 
+                                    z_init=z_prev, 
+                                    z_lower=z_prev / continuation_factor, 
+                                    z_upper=z_prev * continuation_factor)
+        add_stats(stats, 'evaluations', int(np.sum(n_iter)))
+
+    for i, group in enumerate(groups):
+        if np.isfinite(z[i]):
+            seeds[group] = z[i]
+
+    return z
+
+
+def calculate_z_surface_batch(x, y, groups=None, stats=None, seeds=None):
+    """
+    Solves arrays of (x, y) with the lookup surface approach. The surface is
+    loaded (memory-mapped) once, at the first call. Without a built surface,
+    it falls back to the batch newton/halley approach.
+    """
+    global z_surface
+
+    if z_surface is None:
+        if os.path.exists(Z_SURFACE_PATH):
+            z_surface = ZSurface()
+        else:
+            print("Run 'build_z_lookup_surface.py' to build the z surface.")
+            return calculate_z_newton_batch(x, y, stats=stats)
+
+    z, _, _, n_iter = z_surface.solve(x, y)
+    add_stats(stats, 'evaluations', int(np.sum(n_iter)))
+    return z
+
+
+# The lookup surface, loaded at the first use of the 'surface' approach.
+z_surface = None
+
+# The interval around a neighbouring solution is [z / factor, z * factor].
+continuation_factor = 1.5
+
+# Waves of the grouped batch newton/halley approach (a cold solve every
+# 'continuation_stride' trades of a group).
+continuation_stride = 8
+
+## Version of each approach. Bump it when an approach (or its tolerance, 
+## bounds, ...) changes, so that 'calc_zs_btc_options_trades.py --recompute'
+## updates only the results stored by an older version.
+Z_VERSIONS = {
+              "newton": "1",
+              "surface": "1",
+              "fsolve": "1",
+              "brentq": "1",
+              "bisect": "1",
+              "d_annealing": "1",
+             }
+
+## Registry of z approaches. Each one solves arrays of (x, y) and returns an 
+## array of z values (NaN if not solved). Results are stored as 'z_<name>' and
+## 'fz_<name>' fields. Optional 'groups' (one label per trade, in time order)
+## let the approaches in 'Z_SEEDED' seed each solve from the previous 
+## solution of the same group, an optional 'seeds' dict keeps those solutions
+## between calls (ex.: between the batches of a run), and an optional 'stats'
+## dict counts the function evaluations.
+Z_METHODS = {
+             "newton": calculate_z_newton_batch,
+             "surface": calculate_z_surface_batch,
+             "fsolve": calculate_z_fsolve_batch,
+             "brentq": calculate_z_brentq_batch,
+             "bisect": per_trade(calculate_z_bisect),
+             "d_annealing": per_trade(calculate_z_d_annealing),
+            }
+
+## Approaches that use the 'groups' (the others ignore them).
+Z_SEEDED = ["newton", "fsolve", "brentq"]